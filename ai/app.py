@@ -1,14 +1,40 @@
-from fastapi import FastAPI, HTTPException, File, UploadFile
+from fastapi import FastAPI, HTTPException, File, Form, Request, UploadFile
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
-from datetime import datetime
+from datetime import datetime, timedelta
 import uvicorn
-from typing import Dict, Optional
+from typing import Dict, List, Optional, Union
+import asyncio
+import base64
+import binascii
+import json
 import os
+import time
 from dotenv import load_dotenv
 
-from label_analyzer import LabelAnalyzer
+from feature_backends import BACKENDS
+from feature_store import ReturnHistoryStore
+from image_decoder import ImageDecoder, ImageTooLargeError
+from label_coordinates import LabelCoordinateStore
+from metrics import OUTCOME_HELP, VALUE_BUCKETS, MetricsRegistry, StageTimer, current_timer
+from model_reload import ModelValidationError, TrustModelReloader
+from photo_index import PhotoIndex
+from reference_store import ReferenceStore
+from result_cache import ResultCache, SharedResultCache, result_cache_key
+from scan_session import ScanSession, ScanSessionLimitError, ScanSessionStore
+from trust_batcher import TrustBatcher
+from trust_retrainer import BackgroundTrainer
 from trust_scorer import TrustScorer
+from vision_pool import (
+    VisionPool,
+    PoolBrokenError,
+    PoolSaturatedError,
+    PoolTimeoutError,
+    analyze_label_task,
+    enroll_reference_task,
+    scan_frame_task,
+)
 
 # Load environment variables
 load_dotenv()
@@ -29,14 +55,169 @@ app.add_middleware(
 )
 
 # Initialize components
-label_analyzer = LabelAnalyzer()
-trust_scorer = TrustScorer(model_path=os.getenv('TRUST_MODEL_PATH'))
+image_decoder = ImageDecoder()
+vision_pool = VisionPool()
+result_cache = (
+    SharedResultCache(os.getenv("RESULT_CACHE_PATH"))
+    if os.getenv("RESULT_CACHE_PATH") else ResultCache()
+)
+trust_history = ReturnHistoryStore()
+trust_scorer = TrustScorer(model_path=os.getenv('TRUST_MODEL_PATH'), history=trust_history)
+# Refits the trust model in a separate process from the returns it scores
+trust_retrainer = (
+    BackgroundTrainer(os.getenv('TRUST_MODEL_PATH'))
+    if os.getenv("TRUST_RETRAIN_ENABLED", "false").lower() == "true" and os.getenv('TRUST_MODEL_PATH') else None
+)
+trust_observer = trust_retrainer.submit if trust_retrainer is not None else None
+trust_batcher = TrustBatcher(trust_scorer, observer=trust_observer)
+# Perceptual hashes of submitted photos, to find photos reused across returns
+photo_index = PhotoIndex() if os.getenv("PHOTO_INDEX_ENABLED", "true").lower() == "true" else None
+# Open burst scans, each collecting the frames of one product
+scan_sessions = ScanSessionStore()
+# Expected label coordinates of products, cached from the backend's database
+label_coordinates = LabelCoordinateStore()
+# Read-only view of the vision workers' reference store, for result cache keys
+reference_store = ReferenceStore(os.getenv("REFERENCE_STORE_PATH")) if os.getenv("REFERENCE_STORE_PATH") else None
+
+def install_trust_scorer(scorer: TrustScorer):
+    """Serve all following trust requests with scorer; running ones finish on the old one."""
+    global trust_scorer
+    trust_scorer = scorer
+    trust_batcher.scorer = scorer
+
+trust_reloader = TrustModelReloader(
+    os.getenv('TRUST_MODEL_PATH'),
+    load=lambda path: TrustScorer(model_path=path, history=trust_history),
+    install=install_trust_scorer,
+    current=lambda: trust_scorer
+)
+
+# Prometheus metrics, served at /metrics
+metrics_enabled = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+metrics = MetricsRegistry()
+metrics.register_histogram("trust_batch_size", trust_batcher.batch_sizes,
+                           help="Requests per micro-batched trust model call")
+metrics.register_histogram("trust_queue_seconds", trust_batcher.wait_times,
+                           help="Time trust requests waited for their micro-batch")
+metrics.register_callback("vision_jobs_in_flight", "gauge", lambda: {(): vision_pool.in_flight},
+                          help="Vision jobs running or queued")
+metrics.register_callback(
+    "result_cache_total", "counter",
+    lambda: {(("outcome", outcome),): getattr(result_cache, outcome) for outcome in ("hits", "misses", "evictions")},
+    help="Label result cache lookups and evictions"
+)
+metrics.register_callback("trust_model_version", "gauge", lambda: {(): trust_reloader.version},
+                          help="Trust model version served by this worker")
+metrics.register_callback("scan_sessions_open", "gauge", lambda: {(): len(scan_sessions)},
+                          help="Burst scan sessions open")
+metrics.register_callback(
+    "label_coordinates_total", "counter",
+    lambda: {
+        (("outcome", outcome),): label_coordinates.stats()[key]
+        for outcome, key in (("hit", "hits"), ("negative_hit", "negativeHits"), ("miss", "misses"),
+                             ("query", "queries"), ("error", "errors"))
+    },
+    help="Label coordinate cache lookups and database queries"
+)
+if trust_retrainer is not None:
+    metrics.register_histogram("trust_retrain_seconds", trust_retrainer.train_times,
+                               help="Time taken by background trust model refits")
+    metrics.register_callback(
+        "trust_retrain_total", "counter",
+        lambda: {(("outcome", outcome),): trust_retrainer.status.get(outcome, 0)
+                 for outcome in ("saved", "rejected", "failed")},
+        help="Background trust model refits by outcome"
+    )
+    metrics.register_callback(
+        "trust_retrain_rows_total", "counter",
+        lambda: {(("outcome", "queued"),): trust_retrainer.submitted,
+                 (("outcome", "dropped"),): trust_retrainer.dropped},
+        help="Scored rows sent to the background trainer, or dropped while it was behind"
+    )
+    metrics.register_callback(
+        "trust_drift_psi", "gauge",
+        lambda: {(("feature", name),): psi for name, psi in (trust_retrainer.status.get("drift") or {}).items()},
+        help="Population stability index of each trust feature and the trust score since the last refit"
+    )
+if photo_index is not None:
+    metrics.register_callback("photo_index_entries", "gauge", lambda: {(): len(photo_index)},
+                              help="Photos in the near-duplicate photo index")
+
+class StageTimingMiddleware:
+    """
+    Times every request and records its stage timings in the metrics.
+
+    Handlers read the request's StageTimer from metrics.current_timer. With
+    an X-Debug-Timing request header, the stage breakdown is returned in a
+    Server-Timing response header.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.routes = None
+
+    def route(self, path: str) -> str:
+        """Metric label for a path: its route's path template; unknown paths share one label."""
+        if self.routes is None:
+            self.routes = {route.path: route.path_regex for route in app.routes}
+        if path in self.routes:
+            return path
+        # Paths with parameters, e.g. /scan/sessions/{session_id}
+        return next((template for template, regex in self.routes.items() if regex.match(path)), "other")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        timer = StageTimer()
+        token = current_timer.set(timer)
+        debug = any(name == b"x-debug-timing" for name, _ in scope["headers"])
+        status = 500
+
+        async def send_with_timing(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                if debug:
+                    headers = list(message.get("headers", [])) + [(b"server-timing", timer.server_timing().encode())]
+                    message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            current_timer.reset(token)
+            route = self.route(scope["path"])
+            metrics.histogram("request_seconds", {"route": route},
+                              help="HTTP request latency").observe(time.perf_counter() - start)
+            metrics.inc("requests_total", {"route": route, "status": str(status)},
+                        help="HTTP requests by status code")
+            for stage, seconds in timer.stages.items():
+                metrics.histogram("stage_seconds", {"route": route, "stage": stage},
+                                  help="Time spent in each request stage").observe(seconds)
+            for name, value in timer.values.items():
+                metrics.histogram(name, {"route": route}, VALUE_BUCKETS[name]).observe(value)
+            for name, outcomes in timer.outcomes.items():
+                for outcome, n in outcomes.items():
+                    metrics.inc(f"{name}_total", {"route": route, name: outcome}, n, help=OUTCOME_HELP[name])
+            if timer.error:
+                metrics.inc("analysis_errors_total", {"route": route, "error": timer.error},
+                            help="Label analyses and trust scores that returned an error")
+
+if metrics_enabled:
+    app.add_middleware(StageTimingMiddleware)
 
 # Request/Response models
 class LabelAnalysisRequest(BaseModel):
     productId: str
     image: str  # base64 encoded image
-    expectedCoordinates: Dict[str, float]
+    expectedCoordinates: Optional[Dict[str, float]] = None  # default: the product's stored coordinates
+    featureBackend: Optional[str] = None  # sift, orb or akaze
+
+class LabelBatchRequest(BaseModel):
+    items: List[LabelAnalysisRequest]
 
 class TrustScoreRequest(BaseModel):
     productId: str
@@ -44,6 +225,252 @@ class TrustScoreRequest(BaseModel):
     activationTime: datetime
     returnAttempts: int
     image: Optional[str] = None
+    featureBackend: Optional[str] = None
+
+class TrustScoreBatchRequest(BaseModel):
+    # One entry per return request in every list
+    productIds: List[str]
+    userIds: List[str]
+    activationTimes: List[datetime]
+    returnAttempts: List[int]
+    labelMatchScores: Optional[List[float]] = None  # default 1.0 (not verified)
+    returnTimestamps: Optional[List[datetime]] = None  # default now
+    photoMatches: Optional[List[int]] = None  # default 0 (no reused photo)
+
+class ScanSessionRequest(BaseModel):
+    productId: str
+    expectedCoordinates: Optional[Dict[str, float]] = None
+    userId: Optional[str] = None
+    featureBackend: Optional[str] = None
+
+class ReferenceEnrollRequest(BaseModel):
+    productId: str
+    image: str  # base64 encoded image of the genuine product
+    labelCoordinates: Dict[str, float]
+    featureBackend: Optional[str] = None
+
+# Outcome of the start-up warm-up pass; /health/ready answers 503 until it is done
+warm_up_state: Dict = {"ready": False, "seconds": None, "visionWorkers": 0, "error": None}
+warm_up_task: Optional[asyncio.Task] = None
+
+async def warm_up():
+    """
+    Pay first-call costs before real traffic: start and warm every vision
+    worker (each analyzes a synthetic photo) and score a dummy trust row,
+    which loads the trust model.
+    """
+    start = time.perf_counter()
+    now = datetime.now()
+    try:
+        # The vision pool forks its workers before the trust thread starts
+        warm_up_state["visionWorkers"], _ = await asyncio.gather(
+            vision_pool.warm_up(),
+            asyncio.to_thread(
+                trust_scorer.calculate_trust_scores, [now - timedelta(days=14)], [now], [0], [1.0]
+            )
+        )
+    except Exception as e:
+        # Serve anyway; the failing component reports its own errors per request
+        warm_up_state["error"] = str(e)
+    warm_up_state["seconds"] = time.perf_counter() - start
+    warm_up_state["ready"] = True
+
+@app.on_event("startup")
+async def start_warm_up():
+    global warm_up_task
+    # In the background, so the liveness probe answers right away
+    warm_up_task = asyncio.get_running_loop().create_task(warm_up())
+
+@app.on_event("startup")
+async def watch_trust_model():
+    trust_reloader.start()
+
+async def poll_trust_retrainer():
+    """Pick up the background trainer's reports, for /metrics and the stats endpoint."""
+    while True:
+        await asyncio.sleep(1)
+        trust_retrainer.poll()
+
+@app.on_event("startup")
+async def start_trust_retrainer():
+    if trust_retrainer is not None:
+        trust_retrainer.start()
+        asyncio.get_running_loop().create_task(poll_trust_retrainer())
+
+async def expire_scan_sessions():
+    """Drop idle scan sessions even when no new ones are opened."""
+    while True:
+        await asyncio.sleep(scan_sessions.idle_timeout / 2)
+        scan_sessions.expire()
+
+@app.on_event("startup")
+async def start_scan_session_expiry():
+    asyncio.get_running_loop().create_task(expire_scan_sessions())
+
+@app.on_event("shutdown")
+def stop_trust_model_watch():
+    trust_reloader.stop()
+
+@app.on_event("shutdown")
+def shutdown_vision_pool():
+    vision_pool.shutdown()
+
+@app.on_event("shutdown")
+def stop_trust_retrainer():
+    if trust_retrainer is not None:
+        trust_retrainer.stop()
+
+@app.on_event("shutdown")
+def snapshot_trust_history():
+    trust_history.save()
+
+@app.on_event("shutdown")
+def snapshot_photo_index():
+    if photo_index is not None:
+        photo_index.save()
+
+@app.on_event("shutdown")
+def close_label_coordinates():
+    label_coordinates.close()
+
+def check_image_size(image: Union[str, bytes]):
+    """Reject oversized payloads before they are shipped to a worker."""
+    encoded_size = len(image) if isinstance(image, bytes) else len(image) * 3 // 4
+    try:
+        image_decoder.check_size(encoded_size)
+    except ImageTooLargeError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+
+def check_analysis_error(result: Dict):
+    """Reject images a vision worker found over the pixel or dimension limits, like oversized uploads."""
+    if result.get("errorType") == ImageTooLargeError.__name__:
+        raise HTTPException(status_code=413, detail=result["error"])
+
+def check_feature_backend(backend: Optional[str]):
+    """Reject unknown feature backend names."""
+    if backend is not None and backend.lower() not in BACKENDS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unknown feature backend '{backend}' (choose from {', '.join(BACKENDS)})"
+        )
+
+async def run_vision_job(fn, *args) -> Dict:
+    """
+    Run a job on the vision pool, mapping pool errors to HTTP errors.
+    """
+    try:
+        return await vision_pool.run(fn, *args)
+    except PoolSaturatedError as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "1"})
+    except PoolTimeoutError as e:
+        raise HTTPException(status_code=504, detail=str(e))
+    except PoolBrokenError as e:
+        # The pool has dropped the dead workers; a retry gets fresh ones
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "1"})
+
+def base64_to_bytes(image: str) -> Optional[bytes]:
+    """Decode a base64 image (optionally a data URL), or None if it is not valid base64."""
+    try:
+        return base64.b64decode(image.split(',')[1] if ',' in image else image, validate=True)
+    except (binascii.Error, ValueError):
+        return None
+
+def reference_version(product_id: Optional[str], backend: Optional[str]) -> Optional[int]:
+    """Version of the reference a scan of product_id would be matched against, None if there is none."""
+    if reference_store is None or product_id is None:
+        return None
+    name = (backend or os.getenv("FEATURE_BACKEND", "sift")).lower()
+    return reference_store.version(BACKENDS[name].reference_key(product_id))
+
+def prepare_label_image(image: Union[str, bytes],
+                        coordinates: Dict[str, float],
+                        product_id: Optional[str],
+                        backend: Optional[str],
+                        timer: StageTimer):
+    """Image bytes to ship to a worker and their result cache key (None if uncacheable)."""
+    timer.skip()
+    if isinstance(image, str):
+        image = base64_to_bytes(image) or image
+        timer.lap("base64_decode")
+    if not result_cache.enabled or not isinstance(image, bytes):
+        return image, None
+    key = result_cache_key(image, coordinates, product_id, backend,
+                           reference=reference_version(product_id, backend))
+    timer.lap("cache_key")
+    return image, key
+
+async def cache_call(method, *args):
+    """Run a result cache operation, in a thread when the cache blocks on file I/O."""
+    if result_cache.blocking:
+        return await asyncio.to_thread(method, *args)
+    return method(*args)
+
+async def record_photo(result: Dict, product_id: Optional[str], user_id: Optional[str]) -> Dict:
+    """
+    Add an analyzed photo to the photo index.
+    
+    Returns the result with photoMatches: how many earlier submissions of
+    other returns had a near-identical photo.
+    """
+    if photo_index is None or "photoHash" not in result:
+        return result
+    timer = current_timer.get()
+    timer.skip()
+    # Sub-millisecond, like the history store update
+    matches = photo_index.record(int(result["photoHash"], 16), user_id, product_id)
+    timer.lap("photo_index")
+    if photo_index.snapshot_due():
+        await asyncio.to_thread(photo_index.save)
+    # Cached results are shared; answer with a copy
+    return {**result, "photoMatches": matches}
+
+async def run_timed_vision_job(fn, *args) -> Dict:
+    """
+    Run a job that takes a trailing timed flag on the vision pool, merging
+    the worker's stage timings into the request's timer.
+    """
+    timer = current_timer.get()
+    job_start = time.perf_counter()
+    result = await run_vision_job(fn, *args, timer.enabled)
+    if timer.enabled:
+        # Time outside the worker's stages: queueing for a worker and IPC
+        timing = result.pop("timing")
+        timer.merge(timing)
+        timer.add("vision_wait", time.perf_counter() - job_start - sum(timing["stages"].values()))
+    return result
+
+async def run_label_analysis(image: Union[str, bytes],
+                             coordinates: Dict[str, float],
+                             product_id: Optional[str] = None,
+                             backend: Optional[str] = None,
+                             user_id: Optional[str] = None) -> Dict:
+    """
+    Run label analysis on the vision pool, or answer it from the result cache.
+    
+    Base64 images are decoded here so the cache key covers the image bytes,
+    whichever endpoint they arrived through. Decoding and hashing take
+    milliseconds on large photos, so they run off the event loop. Every
+    analyzed photo, cached or not, is checked against and added to the
+    photo index under user_id and product_id.
+    """
+    check_image_size(image)
+    check_feature_backend(backend)
+    timer = current_timer.get()
+    image, key = await asyncio.to_thread(prepare_label_image, image, coordinates, product_id, backend, timer)
+
+    if key is not None:
+        timer.skip()
+        cached = await cache_call(result_cache.get, key)
+        timer.lap("cache_lookup")
+        if cached is not None:
+            return await record_photo(cached, product_id, user_id)
+
+    result = await run_timed_vision_job(analyze_label_task, image, coordinates, product_id, backend)
+    check_analysis_error(result)
+    # Failures are not cached; the same image may succeed once the cause is gone
+    if key is not None and "error" not in result:
+        await cache_call(result_cache.put, key, result, product_id)
+    return await record_photo(result, product_id, user_id)
 
 @app.get("/")
 async def root():
@@ -54,6 +481,55 @@ async def root():
         "version": "1.0.0"
     }
 
+@app.get("/health/live")
+async def liveness():
+    """Liveness probe: the process is up and serving HTTP."""
+    return {"status": "alive"}
+
+@app.get("/health/ready")
+async def readiness():
+    """Readiness probe: 503 until the start-up warm-up pass has finished."""
+    if not warm_up_state["ready"]:
+        raise HTTPException(status_code=503, detail="Warming up", headers={"Retry-After": "1"})
+    return {"status": "ready", "warmUp": warm_up_state}
+
+def label_response(product_id: str, result: Dict) -> Dict:
+    """Build the /analyze/label response body from an analyzer result."""
+    try:
+        return {
+            "productId": product_id,
+            "labelMatch": result["labelMatch"],
+            "score": result["score"],
+            "confidence": result["confidence"],
+            "reference": result.get("reference", False),
+            "backend": result.get("backend"),
+            "photoMatches": result.get("photoMatches"),
+            "stage": result.get("stage"),
+            "timestamp": datetime.now().isoformat()
+        }
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+def missing_coordinates(product_id: str) -> HTTPException:
+    """503 if the product's coordinates could not be looked up, else 400: it has none."""
+    if label_coordinates.failed(product_id):
+        return HTTPException(status_code=503,
+                             detail=f"Label coordinates of product '{product_id}' are unavailable, retry later")
+    return HTTPException(status_code=400,
+                         detail=f"No expectedCoordinates given and none stored for product '{product_id}'")
+
+async def resolve_coordinates(product_id: str, coordinates: Optional[Dict[str, float]]) -> Dict[str, float]:
+    """Coordinates sent with the request, else the product's stored ones; 400 or 503 if neither exists."""
+    if coordinates is not None:
+        return coordinates
+    timer = current_timer.get()
+    timer.skip()
+    coordinates = await label_coordinates.get(product_id)
+    timer.lap("coordinate_lookup")
+    if coordinates is None:
+        raise missing_coordinates(product_id)
+    return coordinates
+
 @app.post("/analyze/label")
 async def analyze_label(request: LabelAnalysisRequest):
     """
@@ -62,21 +538,380 @@ async def analyze_label(request: LabelAnalysisRequest):
     Args:
         productId: Unique product identifier
         image: Base64 encoded image
-        expectedCoordinates: Expected label coordinates (x, y, width, height)
+        expectedCoordinates: Expected label coordinates (x, y, width, height), in pixels or normalized (0-1);
+            optional, the product's stored label coordinates by default
+        featureBackend: Optional feature backend (sift, orb or akaze; default FEATURE_BACKEND)
     
     Returns:
-        Label analysis results including match score and confidence
+        Label analysis results including match score and confidence, and
+        photoMatches: earlier submissions of a near-identical photo for other
+        returns (null with PHOTO_INDEX_ENABLED=false)
+    """
+    coordinates = await resolve_coordinates(request.productId, request.expectedCoordinates)
+    result = await run_label_analysis(request.image, coordinates, request.productId, request.featureBackend)
+    return label_response(request.productId, result)
+
+@app.post("/analyze/label/upload")
+async def analyze_label_upload(
+    productId: str = Form(...),
+    image: UploadFile = File(...),
+    expectedCoordinates: Optional[str] = Form(None),
+    featureBackend: Optional[str] = Form(None)
+):
+    """
+    Analyze product label placement from a multipart upload.
+    
+    Args:
+        productId: Unique product identifier
+        image: Image file (JPEG, PNG, ...)
+        expectedCoordinates: Optional JSON object with the expected label coordinates (x, y, width, height)
+        featureBackend: Optional feature backend (sift, orb or akaze)
+    
+    Returns:
+        Same response as /analyze/label
     """
     try:
-        result = label_analyzer.analyze_label(
+        coordinates = json.loads(expectedCoordinates) if expectedCoordinates else None
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid expectedCoordinates: {e}")
+    coordinates = await resolve_coordinates(productId, coordinates)
+
+    result = await run_label_analysis(await image.read(), coordinates, productId, featureBackend)
+    return label_response(productId, result)
+
+@app.post("/analyze/label/raw")
+async def analyze_label_raw(
+    request: Request,
+    productId: str,
+    x: float,
+    y: float,
+    width: float,
+    height: float,
+    featureBackend: Optional[str] = None
+):
+    """
+    Analyze product label placement from a raw image body.
+    
+    The request body is the encoded image itself (Content-Type
+    application/octet-stream or image/*); the label coordinates are
+    passed as query parameters.
+    
+    Returns:
+        Same response as /analyze/label
+    """
+    coordinates = {"x": x, "y": y, "width": width, "height": height}
+    result = await run_label_analysis(await request.body(), coordinates, productId, featureBackend)
+    return label_response(productId, result)
+
+@app.post("/analyze/label/batch")
+async def analyze_label_batch(request: LabelBatchRequest):
+    """
+    Analyze many label images at once, streaming each result as it finishes.
+    
+    Items are decoded and analyzed in parallel on the vision pool, enough at
+    a time to keep every worker busy. The response is NDJSON with one line
+    per item, in completion order: the /analyze/label response plus the
+    item's index in the request. A failed item gets a line with its index,
+    productId, error and HTTP status instead; the other items are unaffected.
+    Stored coordinates of the items without expectedCoordinates are fetched
+    in one database query up front.
+    
+    Args:
+        items: /analyze/label requests (at most LABEL_BATCH_MAX_SIZE, default 64)
+    
+    Returns:
+        application/x-ndjson stream, one line per item
+    """
+    count = len(request.items)
+    max_batch_size = int(os.getenv("LABEL_BATCH_MAX_SIZE", 64))
+    if count > max_batch_size:
+        raise HTTPException(status_code=413, detail=f"Batch of {count} exceeds the limit of {max_batch_size}")
+
+    request_timer = current_timer.get()
+    request_timer.skip()
+    stored_coordinates = await label_coordinates.get_many(
+        item.productId for item in request.items if item.expectedCoordinates is None
+    )
+    request_timer.lap("coordinate_lookup")
+    # One job queued behind each running one hides the IPC round trip, and
+    # leaves the rest of the queue to other requests
+    slots = asyncio.Semaphore(min(vision_pool.capacity, 2 * vision_pool.max_workers))
+
+    async def analyze_item(index: int, item: LabelAnalysisRequest) -> Dict:
+        async with slots:
+            # Items overlap, so each laps its own timer
+            timer = StageTimer() if request_timer.enabled else request_timer
+            current_timer.set(timer)
+            try:
+                coordinates = item.expectedCoordinates
+                if coordinates is None:
+                    coordinates = stored_coordinates[item.productId]
+                if coordinates is None:
+                    raise missing_coordinates(item.productId)
+                result = await run_label_analysis(item.image, coordinates, item.productId, item.featureBackend)
+                line = {"index": index, **label_response(item.productId, result)}
+                if "error" in result:
+                    line["error"] = result["error"]
+            except HTTPException as e:
+                line = {"index": index, "productId": item.productId, "error": e.detail, "status": e.status_code}
+            except Exception as e:
+                line = {"index": index, "productId": item.productId, "error": str(e), "status": 500}
+            if timer is not request_timer:
+                request_timer.merge(timer.state())
+            return line
+
+    async def results():
+        tasks = [asyncio.ensure_future(analyze_item(i, item)) for i, item in enumerate(request.items)]
+        try:
+            for next_result in asyncio.as_completed(tasks):
+                yield json.dumps(await next_result) + "\n"
+        finally:
+            # The client went away: drop the items not started yet
+            for task in tasks:
+                task.cancel()
+
+    return StreamingResponse(results(), media_type="application/x-ndjson")
+
+def scan_session_response(session: ScanSession) -> Dict:
+    """Progress of a scan session, with its verdict once it has one."""
+    verdict = None
+    if session.done:
+        verdict = label_response(session.product_id, session.verdict)
+        if "error" in session.verdict:
+            verdict["error"] = session.verdict["error"]
+    return {**session.state(), "verdict": verdict}
+
+def get_scan_session(session_id: str) -> ScanSession:
+    """Open scan session with this id, or 404."""
+    session = scan_sessions.get(session_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail=f"Scan session '{session_id}' not found or expired")
+    return session
+
+@app.post("/scan/sessions")
+async def open_scan_session(request: ScanSessionRequest):
+    """
+    Open a burst scan of one product.
+    
+    Frames are then posted one by one to /scan/sessions/{sessionId}/frames
+    until the response says done. Sessions close after
+    SCAN_SESSION_IDLE_SECONDS without a request.
+    
+    Args:
+        productId: Unique product identifier
+        expectedCoordinates: Expected label coordinates (x, y, width, height), in pixels or normalized (0-1);
+            optional, the product's stored label coordinates by default
+        userId: Optional user returning the product, for the photo index
+        featureBackend: Optional feature backend (sift, orb or akaze; default FEATURE_BACKEND)
+    
+    Returns:
+        Session progress, including the sessionId
+    """
+    check_feature_backend(request.featureBackend)
+    coordinates = await resolve_coordinates(request.productId, request.expectedCoordinates)
+    try:
+        session = scan_sessions.create(request.productId, coordinates,
+                                       request.featureBackend, request.userId)
+    except ScanSessionLimitError as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "1"})
+    return scan_session_response(session)
+
+@app.post("/scan/sessions/{session_id}/frames")
+async def add_scan_frame(session_id: str, request: Request):
+    """
+    Add one frame to a burst scan.
+    
+    The request body is the encoded frame itself, as for
+    /analyze/label/raw. Blurry frames and near-copies of the last analyzed
+    frame are skipped before feature extraction. Analyzed frames add their
+    confidence-weighted vote to the session, which decides as soon as one
+    side leads by SCAN_CONFIDENCE_THRESHOLD, or after SCAN_MAX_FRAMES
+    frames. Frames sent after that are not analyzed.
+    
+    Returns:
+        Session progress; verdict holds the /analyze/label response once done
+    """
+    session = get_scan_session(session_id)
+    if session.done:
+        return scan_session_response(session)
+    image = await request.body()
+    check_image_size(image)
+
+    result = await run_timed_vision_job(scan_frame_task, image, session.coordinates, session.product_id,
+                                        session.backend, session.previous)
+    check_analysis_error(result)
+    # Another frame of the session may have decided it meanwhile
+    if not session.done:
+        current_timer.get().count("scan_frame", session.add(result))
+        if session.done:
+            # One photo per scan goes into the photo index: the most confident frame's
+            session.verdict = await record_photo(session.verdict, session.product_id, session.user_id)
+            session.verdict.pop("photoHash", None)
+    return scan_session_response(session)
+
+@app.get("/scan/sessions/{session_id}")
+async def get_scan_session_state(session_id: str):
+    """Progress of a burst scan, with its verdict once it has one."""
+    return scan_session_response(get_scan_session(session_id))
+
+@app.delete("/scan/sessions/{session_id}")
+async def close_scan_session(session_id: str):
+    """Close a burst scan, returning its final progress."""
+    session = scan_sessions.close(session_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail=f"Scan session '{session_id}' not found or expired")
+    return scan_session_response(session)
+
+@app.post("/reference/enroll")
+async def enroll_reference(request: ReferenceEnrollRequest):
+    """
+    Enroll the reference label of a product.
+    
+    Extracts features from the genuine label and stores them so later
+    scans of this product are matched against it.
+    
+    Args:
+        productId: Unique product identifier
+        image: Base64 encoded image of the genuine product
+        labelCoordinates: Label coordinates (x, y, width, height) in that image
+        featureBackend: Optional feature backend to enroll for; scans are only
+            matched against the reference of the backend they run on
+    
+    Returns:
+        Product id, number of stored features and backend
+    """
+    check_image_size(request.image)
+    check_feature_backend(request.featureBackend)
+    try:
+        result = await run_vision_job(
+            enroll_reference_task,
+            request.productId,
             request.image,
-            request.expectedCoordinates
+            request.labelCoordinates,
+            request.featureBackend
+        )
+    except HTTPException:
+        raise
+    except ImageTooLargeError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    # Cached scans of this product were matched against the old reference
+    await cache_call(result_cache.invalidate_product, request.productId)
+    return result
+
+@app.get("/trust/batcher/stats")
+async def trust_batcher_stats():
+    """Micro-batch size and queue wait time histograms of /analyze/trust."""
+    return trust_batcher.stats()
+
+@app.get("/trust/history/stats")
+async def trust_history_stats():
+    """Users and products tracked by the return history store, and its memory use."""
+    return trust_history.stats()
+
+@app.get("/photos/index/stats")
+async def photo_index_stats():
+    """Photos in the near-duplicate photo index, its match distance and memory use."""
+    if photo_index is None:
+        raise HTTPException(status_code=404, detail="Photo index is disabled (PHOTO_INDEX_ENABLED=false)")
+    return photo_index.stats()
+
+@app.post("/admin/trust/reload")
+async def reload_trust_model():
+    """
+    Reload the trust model from TRUST_MODEL_PATH without a restart.
+    
+    The new model is validated on a canary batch before it replaces the
+    current one; requests keep being served throughout. Reloads only the
+    worker process that receives the call; replacing the model file reloads
+    every worker through its file watcher.
+    
+    Returns:
+        Reload timings and the mean canary score shift
+    """
+    try:
+        return await trust_reloader.reload()
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except ModelValidationError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+@app.get("/trust/model/stats")
+async def trust_model_stats():
+    """Serving trust model version and reload history of this worker."""
+    return trust_reloader.stats()
+
+@app.get("/trust/retrain/stats")
+async def trust_retrain_stats():
+    """Rows seen by the background trainer, current drift and the last refit."""
+    if trust_retrainer is None:
+        raise HTTPException(status_code=404, detail="Background retraining is disabled (TRUST_RETRAIN_ENABLED=false)")
+    return trust_retrainer.stats()
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def prometheus_metrics():
+    """Request, stage, size and component metrics in the Prometheus text format."""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/cache/stats")
+async def cache_stats():
+    """Label analysis result cache size and hit, miss and eviction counters."""
+    return await cache_call(result_cache.stats)
+
+@app.get("/labels/coordinates/stats")
+async def label_coordinates_stats():
+    """Label coordinate cache size, hit and miss counters, and database queries made."""
+    return label_coordinates.stats()
+
+async def score_trust(product_id: str,
+                      user_id: str,
+                      activation_time: datetime,
+                      return_attempts: int,
+                      image: Union[str, bytes, None],
+                      backend: Optional[str] = None) -> Dict:
+    """
+    Run label verification (if an image is given) and trust scoring.
+
+    The label is verified against the product's stored label coordinates.
+    A photo that cannot be verified is not scored as if it had passed: a
+    product without coordinates is a 400, and a failed lookup a 503.
+    """
+    label_match_score = 1.0
+    photo_matches = 0
+    if image:
+        coordinates = await resolve_coordinates(product_id, None)
+        label_result = await run_label_analysis(image, coordinates, product_id, backend, user_id)
+        label_match_score = label_result["score"]
+        photo_matches = label_result.get("photoMatches", 0)
+
+    try:
+        # Calculate trust score, batched with concurrent requests
+        return_timestamp = datetime.now()
+        result = await trust_batcher.score(
+            activation_time=activation_time,
+            return_timestamp=return_timestamp,
+            return_attempts=return_attempts,
+            label_match_score=label_match_score,
+            user_id=user_id,
+            product_id=product_id,
+            photo_matches=photo_matches,
+            timer=current_timer.get()
         )
         
+        # Later scores of this user and product see this return
+        if "error" not in result:
+            trust_history.record(user_id, product_id, return_timestamp, activation_time, label_match_score)
+            if trust_history.snapshot_due():
+                await asyncio.to_thread(trust_history.save)
+        
         return {
-            "productId": request.productId,
-            "labelMatch": result["labelMatch"],
-            "score": result["score"],
+            "productId": product_id,
+            "userId": user_id,
+            "trustScore": result["trustScore"],
+            "riskLevel": result["riskLevel"],
+            "riskFactors": result["riskFactors"],
             "confidence": result["confidence"],
             "timestamp": datetime.now().isoformat()
         }
@@ -94,40 +929,109 @@ async def analyze_trust(request: TrustScoreRequest):
         activationTime: When the product was activated
         returnAttempts: Number of previous return attempts
         image: Optional base64 encoded image for label verification
+        featureBackend: Optional feature backend for label verification
     
     Returns:
         Trust score analysis including risk level and factors
     """
+    return await score_trust(
+        request.productId,
+        request.userId,
+        request.activationTime,
+        request.returnAttempts,
+        request.image,
+        request.featureBackend
+    )
+
+@app.post("/analyze/trust/batch")
+async def analyze_trust_batch(request: TrustScoreBatchRequest):
+    """
+    Calculate trust scores for many return requests in one model call.
+    
+    Takes columnar input: one list per field, all of the same length. No
+    images are analyzed; pass stored label scores in labelMatchScores.
+    
+    Args:
+        productIds: Product identifiers
+        userIds: Users requesting the returns
+        activationTimes: When each product was activated
+        returnAttempts: Number of previous return attempts per request
+        labelMatchScores: Optional label verification scores (default 1.0)
+        returnTimestamps: Optional return request times (default now)
+        photoMatches: Optional earlier returns with a near-identical photo (default 0)
+    
+    Returns:
+        One /analyze/trust result (without timestamp) per request, in order
+    """
+    count = len(request.productIds)
+    max_batch_size = int(os.getenv("TRUST_BATCH_MAX_SIZE", 10000))
+    if count > max_batch_size:
+        raise HTTPException(status_code=413, detail=f"Batch of {count} exceeds the limit of {max_batch_size}")
+
+    now = datetime.now()
+    label_match_scores = request.labelMatchScores or [1.0] * count
+    return_timestamps = request.returnTimestamps or [now] * count
+    photo_matches = request.photoMatches or [0] * count
+    columns = (request.userIds, request.activationTimes, request.returnAttempts,
+               label_match_scores, return_timestamps, photo_matches)
+    if any(len(column) != count for column in columns):
+        raise HTTPException(status_code=400, detail="All batch fields must have the same length")
+
     try:
-        # Get label match score if image provided
-        label_match_score = 1.0
-        if request.image:
-            label_result = label_analyzer.analyze_label(
-                request.image,
-                {}  # Coordinates should be fetched from database
-            )
-            label_match_score = label_result["score"]
-        
-        # Calculate trust score
-        result = trust_scorer.calculate_trust_score(
-            activation_time=request.activationTime,
-            return_timestamp=datetime.now(),
-            return_attempts=request.returnAttempts,
-            label_match_score=label_match_score
+        # Thousands of rows take tens of milliseconds; keep them off the event loop
+        results = await asyncio.to_thread(
+            trust_scorer.calculate_trust_scores,
+            request.activationTimes,
+            return_timestamps,
+            request.returnAttempts,
+            label_match_scores,
+            request.userIds,
+            request.productIds,
+            photo_matches,
+            timer=current_timer.get(),
+            observer=trust_observer
         )
-        
-        return {
-            "productId": request.productId,
-            "userId": request.userId,
-            "trustScore": result["trustScore"],
-            "riskLevel": result["riskLevel"],
-            "riskFactors": result["riskFactors"],
-            "confidence": result["confidence"],
-            "timestamp": datetime.now().isoformat()
-        }
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
+    return {
+        "results": [
+            {
+                "productId": product_id,
+                "userId": user_id,
+                "trustScore": result["trustScore"],
+                "riskLevel": result["riskLevel"],
+                "riskFactors": result["riskFactors"],
+                "confidence": result["confidence"],
+                # A row that could not be scored says why; the others are unaffected
+                **({"error": result["error"]} if "error" in result else {})
+            }
+            for product_id, user_id, result in zip(request.productIds, request.userIds, results)
+        ],
+        "timestamp": now.isoformat()
+    }
+
+@app.post("/analyze/trust/upload")
+async def analyze_trust_upload(
+    productId: str = Form(...),
+    userId: str = Form(...),
+    activationTime: datetime = Form(...),
+    returnAttempts: int = Form(...),
+    image: Optional[UploadFile] = File(None),
+    featureBackend: Optional[str] = Form(None)
+):
+    """
+    Calculate trust score from a multipart upload.
+    
+    Takes the same fields as /analyze/trust as form fields, with the
+    optional image sent as a file part instead of base64.
+    
+    Returns:
+        Same response as /analyze/trust
+    """
+    image_bytes = await image.read() if image is not None else None
+    return await score_trust(productId, userId, activationTime, returnAttempts, image_bytes, featureBackend)
+
 if __name__ == "__main__":
     uvicorn.run(
         "app:app",
@@ -0,0 +1,67 @@
+"""
+Compare accuracy and throughput of the feature backends on the same images.
+
+For every product a genuine photo is enrolled as the reference label. Each
+backend then verifies a rescan of the genuine garment and a rescan of the
+same garment with a counterfeit label sewn in. Timings cover preprocessing,
+feature extraction and matching on the decoded image.
+
+Run from the ai/ directory:
+
+    python -m benchmarks.backends
+"""
+import argparse
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+from benchmarks.images import rescan, synthetic_label_photo
+from feature_backends import BACKENDS
+from label_analyzer import LabelAnalyzer
+from reference_store import ReferenceStore
+
+RESOLUTIONS = [(1280, 960), (2000, 1500)]
+
+
+def run(products: int, repeats: int):
+    analyzer = LabelAnalyzer(reference_store=ReferenceStore(tempfile.mkdtemp()))
+    print(f"{'resolution':>12} {'backend':>8} {'ms/scan':>8} {'scans/s':>8} {'accuracy':>9} "
+          f"{'genuine':>8} {'fake':>6}")
+
+    for width, height in RESOLUTIONS:
+        scans = []
+        for seed in range(products):
+            photo, coordinates = synthetic_label_photo(width, height, seed)
+            counterfeit, _ = synthetic_label_photo(width, height, seed, label_seed=products + seed)
+            genuine = cv2.cvtColor(rescan(photo, seed), cv2.COLOR_BGR2GRAY)
+            fake = cv2.cvtColor(rescan(counterfeit, seed), cv2.COLOR_BGR2GRAY)
+            scans.append((f"{width}-{seed}", photo, coordinates, genuine, fake))
+
+        for name in BACKENDS:
+            timings = []
+            scores = {True: [], False: []}
+            correct = 0
+            for product_id, photo, coordinates, genuine, fake in scans:
+                analyzer.enroll_reference(product_id, cv2.imencode(".png", photo)[1].tobytes(),
+                                          coordinates, name)
+                for is_genuine, image in ((True, genuine), (False, fake)):
+                    for _ in range(repeats):
+                        start = time.perf_counter()
+                        result = analyzer._analyze_image(image, coordinates, product_id, name)
+                        timings.append(time.perf_counter() - start)
+                    scores[is_genuine].append(result["score"])
+                    correct += result["labelMatch"] == is_genuine
+
+            ms = np.median(timings) * 1000
+            print(f"{width}x{height:<7} {name:>8} {ms:8.1f} {1000 / ms:8.1f} "
+                  f"{correct / (2 * len(scans)):9.0%} {np.mean(scores[True]):8.2f} {np.mean(scores[False]):6.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--products", type=int, default=20)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+    run(args.products, args.repeats)
@@ -0,0 +1,110 @@
+"""
+Measure AI service cold start: import time, time until the liveness and
+readiness probes pass, and the latency of the first label and trust requests
+compared with later ones. Starts the service with uvicorn on a free port.
+Run from the ai/ directory:
+
+    python -m benchmarks.cold_start
+"""
+import argparse
+import base64
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+from datetime import datetime, timedelta
+
+import cv2
+
+from benchmarks.images import synthetic_label_photo
+
+
+def import_seconds(repeats: int) -> float:
+    """Median wall time of importing app in a fresh interpreter."""
+    timings = []
+    for _ in range(repeats):
+        output = subprocess.run(
+            [sys.executable, "-c", "import time; t = time.perf_counter(); import app; print(time.perf_counter() - t)"],
+            capture_output=True, text=True, check=True
+        ).stdout
+        timings.append(float(output.strip().splitlines()[-1]))
+    return sorted(timings)[len(timings) // 2]
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def get_status(url: str) -> int:
+    try:
+        with urllib.request.urlopen(url, timeout=5) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+    except OSError:
+        return 0
+
+
+def post_seconds(url: str, body: dict) -> float:
+    request = urllib.request.Request(url, json.dumps(body).encode(), {"Content-Type": "application/json"})
+    start = time.perf_counter()
+    with urllib.request.urlopen(request, timeout=60) as response:
+        response.read()
+    return time.perf_counter() - start
+
+
+def wait_for(url: str, start: float, timeout: float = 60) -> float:
+    while time.perf_counter() - start < timeout:
+        if get_status(url) == 200:
+            return time.perf_counter() - start
+        time.sleep(0.01)
+    raise TimeoutError(url)
+
+
+def run(workers: int, repeats: int):
+    print(f"import app: {import_seconds(repeats) * 1000:.0f} ms")
+
+    photo, coordinates = synthetic_label_photo(1024, 768, seed=0)
+    _, encoded = cv2.imencode(".jpg", photo)
+    label_body = {"productId": "BENCH", "image": base64.b64encode(encoded.tobytes()).decode(),
+                  "expectedCoordinates": coordinates}
+    now = datetime.now()
+    trust_body = {"productId": "BENCH", "userId": "BENCH", "returnAttempts": 0,
+                  "activationTime": (now - timedelta(days=14)).isoformat()}
+
+    port = free_port()
+    base = f"http://127.0.0.1:{port}"
+    env = {**os.environ, "VISION_WORKERS": str(workers), "RESULT_CACHE_SIZE": "0"}
+    start = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app:app", "--port", str(port), "--log-level", "warning"],
+        env=env
+    )
+    try:
+        live = wait_for(f"{base}/health/live", start)
+        ready = wait_for(f"{base}/health/ready", start)
+        print(f"{workers} vision workers: live after {live * 1000:.0f} ms, ready after {ready * 1000:.0f} ms")
+
+        first_label = post_seconds(f"{base}/analyze/label", label_body)
+        warm_label = min(post_seconds(f"{base}/analyze/label", label_body) for _ in range(repeats))
+        first_trust = post_seconds(f"{base}/analyze/trust", trust_body)
+        warm_trust = min(post_seconds(f"{base}/analyze/trust", trust_body) for _ in range(repeats))
+        print(f"/analyze/label: first {first_label * 1000:.0f} ms, warm {warm_label * 1000:.0f} ms")
+        print(f"/analyze/trust: first {first_trust * 1000:.1f} ms, warm {warm_trust * 1000:.1f} ms")
+    finally:
+        server.terminate()
+        server.wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+    run(args.workers, args.repeats)
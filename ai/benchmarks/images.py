@@ -0,0 +1,70 @@
+import cv2
+import numpy as np
+from typing import Dict, Optional, Tuple
+
+
+def synthetic_label_photo(width: int,
+                          height: int,
+                          seed: int = 0,
+                          label_fraction: float = 0.2,
+                          label_seed: Optional[int] = None) -> Tuple[np.ndarray, Dict[str, float]]:
+    """
+    Build a BGR photo of a garment with a textured, printed label.
+
+    Args:
+        width: Photo width in pixels
+        height: Photo height in pixels
+        seed: Random seed for the fabric and label texture
+        label_fraction: Label width as a fraction of the photo width
+        label_seed: Random seed for the label alone, so a different label can be
+            sewn into the same garment (default: drawn from seed)
+
+    Returns:
+        (photo, label coordinates in pixels)
+    """
+    rng = np.random.default_rng(seed)
+
+    # Low-frequency fabric texture
+    fabric = rng.integers(0, 256, (height // 8 + 1, width // 8 + 1, 3), dtype=np.uint8)
+    photo = cv2.resize(fabric, (width, height), interpolation=cv2.INTER_CUBIC)
+    photo = cv2.GaussianBlur(photo, (15, 15), 0)
+
+    label_width = int(width * label_fraction)
+    label_height = label_width // 2
+    x = int(rng.integers(label_width, width - 2 * label_width))
+    y = int(rng.integers(label_height, height - 2 * label_height))
+
+    # Blocky woven pattern plus printed brand text
+    label_rng = rng if label_seed is None else np.random.default_rng(label_seed)
+    pattern = label_rng.integers(0, 256, (label_height // 8, label_width // 8, 3), dtype=np.uint8)
+    label = cv2.resize(pattern, (label_width, label_height), interpolation=cv2.INTER_NEAREST)
+    scale = label_width / 250
+    cv2.putText(label, "TRUETAG", (int(label_width * 0.08), int(label_height * 0.6)),
+                cv2.FONT_HERSHEY_SIMPLEX, scale, (255, 255, 255), max(1, int(3 * scale)))
+    photo[y:y + label_height, x:x + label_width] = label
+
+    return photo, {"x": x, "y": y, "width": label_width, "height": label_height}
+
+
+def rescan(photo: np.ndarray, seed: int = 0, jpeg_quality: int = 85) -> np.ndarray:
+    """
+    Simulate another phone photo of the same garment.
+
+    Applies a small rotation, scale and shift around the image centre, a
+    brightness and contrast change, sensor noise and JPEG compression. Label
+    coordinates stay valid to within a few pixels.
+    """
+    rng = np.random.default_rng(seed)
+    height, width = photo.shape[:2]
+
+    matrix = cv2.getRotationMatrix2D((width / 2, height / 2),
+                                     rng.uniform(-3, 3), rng.uniform(0.97, 1.03))
+    matrix[:, 2] += rng.uniform(-0.005, 0.005, 2) * (width, height)
+    warped = cv2.warpAffine(photo, matrix, (width, height), borderMode=cv2.BORDER_REFLECT)
+
+    adjusted = warped.astype(np.float32) * rng.uniform(0.85, 1.15) + rng.uniform(-15, 15)
+    adjusted += rng.normal(0, 3, adjusted.shape)
+    adjusted = np.clip(adjusted, 0, 255).astype(np.uint8)
+
+    encoded = cv2.imencode(".jpg", adjusted, [cv2.IMWRITE_JPEG_QUALITY, jpeg_quality])[1]
+    return cv2.imdecode(encoded, cv2.IMREAD_COLOR)
@@ -0,0 +1,140 @@
+"""
+Measure trust model hot-reload latency and per-worker model memory.
+
+Reloads a saved model while a stream of micro-batched trust requests is
+being scored, reporting reload timings and the slowest request during the
+reload. Then starts several worker processes that each load the model, with
+the compiled forest memory-mapped from the saved file or compiled privately,
+and reports the memory each worker gained. Run from the ai/ directory:
+
+    python -m benchmarks.model_reload
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from benchmarks.trust_scorer import synthetic_features
+from model_reload import TrustModelReloader
+from trust_batcher import TrustBatcher
+from trust_scorer import TrustScorer, compiled_model_path
+
+
+def save_model(path: str, trees: int, train_rows: int, seed: int):
+    scorer = TrustScorer()
+    scorer.model.set_params(n_estimators=trees, random_state=seed)
+    scorer.fit(synthetic_features(train_rows, seed))
+    scorer.save_model(path)
+
+
+async def reload_under_load(path: str, requests: int):
+    serving = {"scorer": TrustScorer(model_path=path)}
+    batcher = TrustBatcher(serving["scorer"], window=0.002)
+
+    def install(scorer):
+        serving["scorer"] = scorer
+        batcher.scorer = scorer
+
+    reloader = TrustModelReloader(path, load=lambda model_path: TrustScorer(model_path=model_path),
+                                  install=install, current=lambda: serving["scorer"], poll_interval=0)
+
+    now = datetime.now()
+    latencies = []
+
+    async def request(i: int):
+        start = time.perf_counter()
+        await batcher.score(now - timedelta(hours=i % 500), now, i % 3, 0.9)
+        latencies.append(time.perf_counter() - start)
+
+    async def traffic():
+        for i in range(requests):
+            await request(i)
+            await asyncio.sleep(0.001)
+
+    # Baseline latency, then the same traffic with a reload in the middle
+    await traffic()
+    baseline = max(latencies)
+    latencies.clear()
+    traffic_task = asyncio.ensure_future(traffic())
+    await asyncio.sleep(0.05)
+    result = await reloader.reload()
+    await traffic_task
+
+    print(f"reload: load {result['loadSeconds'] * 1000:.1f} ms, validate {result['validateSeconds'] * 1000:.1f} ms, "
+          f"total {result['totalSeconds'] * 1000:.1f} ms")
+    print(f"requests during reload: {len(latencies)}/{requests} served, slowest {max(latencies) * 1000:.1f} ms "
+          f"(without reload: {baseline * 1000:.1f} ms)")
+
+
+def memory_kib():
+    """RSS and PSS of this process, in KiB."""
+    values = {}
+    with open("/proc/self/smaps_rollup") as f:
+        for line in f:
+            key, _, rest = line.partition(":")
+            if key in ("Rss", "Pss"):
+                values[key] = int(rest.split()[0])
+    return values["Rss"], values["Pss"]
+
+
+def worker(path: str, ready, done):
+    before = memory_kib()
+    scorer = TrustScorer(model_path=path)
+    # Touch every node array page, as scoring eventually does
+    scorer.predictor.score_samples(synthetic_features(4096, 2))
+    for name in ("left", "right", "feature", "threshold", "leaf_value"):
+        np.asarray(getattr(scorer.predictor, name)).sum()
+    ready.put(None)
+    done.wait()
+    after = memory_kib()
+    ready.put((after[0] - before[0], after[1] - before[1]))
+
+
+def worker_memory(path: str, workers: int):
+    """Median RSS and PSS gained per worker by loading the model."""
+    context = multiprocessing.get_context("spawn")
+    ready, done = context.Queue(), context.Event()
+    processes = [context.Process(target=worker, args=(path, ready, done)) for _ in range(workers)]
+    for process in processes:
+        process.start()
+    for _ in processes:
+        ready.get()
+    done.set()
+    deltas = [ready.get() for _ in processes]
+    for process in processes:
+        process.join()
+    return np.median([d[0] for d in deltas]), np.median([d[1] for d in deltas])
+
+
+def run(trees: int, train_rows: int, requests: int, workers: int):
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "trust_scorer.pkl")
+        save_model(path, trees, train_rows, seed=1)
+        compiled_size = os.path.getsize(compiled_model_path(path))
+        print(f"{trees} trees: model {os.path.getsize(path) / 1024:.0f} KiB, "
+              f"compiled forest {compiled_size / 1024:.0f} KiB")
+
+        save_model(path, trees, train_rows, seed=1)
+        asyncio.run(reload_under_load(path, requests))
+
+        print(f"per-worker memory gained loading the model ({workers} workers):")
+        rss, pss = worker_memory(path, workers)
+        print(f"  memory-mapped compiled forest: RSS {rss / 1024:.1f} MiB, PSS {pss / 1024:.1f} MiB")
+        os.remove(compiled_model_path(path))
+        rss, pss = worker_memory(path, workers)
+        print(f"  compiled per worker:           RSS {rss / 1024:.1f} MiB, PSS {pss / 1024:.1f} MiB")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--trees", type=int, default=100)
+    parser.add_argument("--train-rows", type=int, default=5000)
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--workers", type=int, default=4)
+    args = parser.parse_args()
+    run(args.trees, args.train_rows, args.requests, args.workers)
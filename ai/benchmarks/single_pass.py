@@ -0,0 +1,54 @@
+"""
+Compare single-pass and two-pass feature extraction in LabelAnalyzer.
+
+Run from the ai/ directory:
+
+    python -m benchmarks.single_pass
+"""
+import argparse
+import time
+
+import cv2
+import numpy as np
+
+from benchmarks.images import synthetic_label_photo
+from label_analyzer import LabelAnalyzer
+
+RESOLUTIONS = [(1280, 960), (2000, 1500), (4000, 3000)]
+
+
+def run(images: int, repeats: int):
+    analyzer = LabelAnalyzer()
+    # Both paths are compared at full resolution, not settled by the coarse stage
+    analyzer.cascade = False
+    print(f"{'resolution':>12} {'two-pass ms':>12} {'single ms':>10} {'saving':>7} {'max |dscore|':>13} {'labelMatch':>11}")
+
+    for width, height in RESOLUTIONS:
+        timings = {False: [], True: []}
+        deltas = []
+        agree = 0
+        for seed in range(images):
+            photo, coordinates = synthetic_label_photo(width, height, seed)
+            gray = cv2.cvtColor(photo, cv2.COLOR_BGR2GRAY)
+            results = {}
+            for single_pass in (False, True):
+                analyzer.single_pass = single_pass
+                for _ in range(repeats):
+                    start = time.perf_counter()
+                    results[single_pass] = analyzer._analyze_image(gray, coordinates)
+                    timings[single_pass].append(time.perf_counter() - start)
+            deltas.append(abs(results[True]["score"] - results[False]["score"]))
+            agree += results[True]["labelMatch"] == results[False]["labelMatch"]
+
+        two_pass = np.median(timings[False]) * 1000
+        single = np.median(timings[True]) * 1000
+        print(f"{width}x{height:<7} {two_pass:12.1f} {single:10.1f} {1 - single / two_pass:7.0%} "
+              f"{max(deltas):13.3f} {agree:>5}/{images}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--images", type=int, default=10)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+    run(args.images, args.repeats)
@@ -0,0 +1,448 @@
+"""
+Reproducible benchmark suite for label analysis and trust scoring.
+
+Times LabelAnalyzer.analyze_label on synthetic label photos at several
+resolutions, TrustScorer.calculate_trust_score and calculate_trust_scores
+at batch sizes from 1 to 100k, TrustScorer.train, perceptual hashing and
+photo index lookups at up to 10M indexed photos, and the HTTP endpoints
+through an in-process client. Every case reports throughput, p50/p99
+latency per call and the peak memory allocated by one call. Inputs use
+fixed seeds, and results are written as JSON together with the versions
+and machine they were measured on. Run from the ai/ directory:
+
+    python -m benchmarks.suite --output results.json
+    python -m benchmarks.suite --baseline results.json
+
+With --baseline the run fails (exit status 1) when a case is slower, or
+allocates more, than the baseline by more than the regression thresholds.
+Compare two saved runs without measuring with --input.
+"""
+import argparse
+import base64
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional
+
+import cv2
+import numpy as np
+
+from benchmarks.images import synthetic_label_photo
+from benchmarks.trust_scorer import synthetic_features
+
+RESOLUTIONS = [(640, 480), (1280, 960), (2000, 1500), (4000, 3000)]
+BATCH_SIZES = [1, 10, 100, 1000, 10_000, 100_000]
+HTTP_BATCH_SIZES = [100, 10_000]
+TRAIN_ROWS = 10_000
+PHOTO_INDEX_SIZES = [1_000_000, 10_000_000]
+RESULTS_VERSION = 1
+
+# Latency and throughput metrics, and whether a larger value is worse
+METRICS = {"p50_ms": True, "p99_ms": True, "throughput": False, "peak_memory_mb": True}
+
+RETURN_TIME = datetime(2024, 1, 1)
+
+
+def measure(fn: Callable[[int], object],
+            items: int = 1,
+            min_calls: int = 5,
+            max_calls: int = 200,
+            min_seconds: float = 1.0) -> Dict:
+    """
+    Time repeated calls of fn(i), after one untimed warm-up call.
+
+    Calls continue until both min_calls and min_seconds are reached, up to
+    max_calls. The peak memory is measured on a separate call with
+    tracemalloc, so tracing does not slow the timed calls. It covers Python
+    and NumPy allocations, including arrays returned by OpenCV, but not
+    OpenCV's internal buffers.
+
+    Args:
+        fn: Benchmarked call; i is the call number, for cycling inputs
+        items: Images or rows handled per call, for the throughput
+    """
+    fn(0)
+    timings = []
+    start = time.perf_counter()
+    while len(timings) < max_calls and (len(timings) < min_calls or time.perf_counter() - start < min_seconds):
+        call_start = time.perf_counter()
+        fn(len(timings) + 1)
+        timings.append(time.perf_counter() - call_start)
+
+    tracemalloc.start()
+    try:
+        fn(0)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    timings = np.array(timings)
+    return {
+        "calls": len(timings),
+        "items_per_call": items,
+        "p50_ms": float(np.percentile(timings, 50) * 1000),
+        "p99_ms": float(np.percentile(timings, 99) * 1000),
+        "mean_ms": float(timings.mean() * 1000),
+        "throughput": float(items * len(timings) / timings.sum()),
+        "peak_memory_mb": peak / 2 ** 20
+    }
+
+
+def label_request(width: int, height: int, seed: int) -> Dict:
+    """Base64 JPEG of a synthetic label photo, with its label coordinates."""
+    photo, coordinates = synthetic_label_photo(width, height, seed)
+    encoded = cv2.imencode(".jpg", photo, [cv2.IMWRITE_JPEG_QUALITY, 90])[1]
+    return {"image": base64.b64encode(encoded.tobytes()).decode(), "coordinates": coordinates}
+
+
+def trust_rows(rows: int, seed: int = 0) -> Dict[str, List]:
+    """Trust scoring inputs as calculate_trust_scores columns, from synthetic features."""
+    features = synthetic_features(rows, seed)
+    return {
+        "activation_times": [RETURN_TIME - timedelta(hours=float(hours)) for hours in features[:, 0]],
+        "return_timestamps": [RETURN_TIME] * rows,
+        "return_attempts": features[:, 1].astype(int).tolist(),
+        "label_match_scores": features[:, 2].tolist()
+    }
+
+
+def training_rows(rows: int, seed: int = 0) -> List[Dict]:
+    """Return history rows in the format TrustScorer.train takes."""
+    columns = trust_rows(rows, seed)
+    return [
+        {"activation_time": activation, "return_timestamp": returned,
+         "return_attempts": attempts, "label_match_score": score}
+        for activation, returned, attempts, score in zip(*columns.values())
+    ]
+
+
+def fitted_scorer():
+    from trust_scorer import TrustScorer
+
+    scorer = TrustScorer()
+    scorer.train(training_rows(TRAIN_ROWS, seed=1))
+    return scorer
+
+
+def label_cases(keep: Callable[[str], bool], resolutions, images: int, min_seconds: float) -> Dict[str, Dict]:
+    from label_analyzer import LabelAnalyzer
+
+    analyzer = LabelAnalyzer()
+    cases = {}
+    for width, height in resolutions:
+        name = f"label/analyze_label/{width}x{height}"
+        if not keep(name):
+            continue
+        requests = [label_request(width, height, seed) for seed in range(images)]
+
+        def analyze(i, requests=requests):
+            request = requests[i % len(requests)]
+            return analyzer.analyze_label(request["image"], request["coordinates"])
+
+        cases[name] = measure(analyze, min_seconds=min_seconds)
+    return cases
+
+
+def trust_cases(keep: Callable[[str], bool], batch_sizes, train_rows: int, min_seconds: float) -> Dict[str, Dict]:
+    from trust_scorer import TrustScorer
+
+    scorer = fitted_scorer()
+    cases = {}
+
+    single = trust_rows(1000, seed=2)
+
+    def score_one(i):
+        j = i % 1000
+        return scorer.calculate_trust_score(*(column[j] for column in single.values()))
+
+    if keep("trust/calculate_trust_score"):
+        cases["trust/calculate_trust_score"] = measure(score_one, max_calls=2000, min_seconds=min_seconds)
+
+    for rows in batch_sizes:
+        name = f"trust/calculate_trust_scores/{rows}"
+        if not keep(name):
+            continue
+        batch = trust_rows(rows, seed=3)
+        cases[name] = measure(
+            lambda i, batch=batch: scorer.calculate_trust_scores(**batch),
+            items=rows, max_calls=2000, min_seconds=min_seconds
+        )
+
+    name = f"trust/train/{train_rows}"
+    if keep(name):
+        history = training_rows(train_rows, seed=4)
+        cases[name] = measure(
+            lambda i: TrustScorer().train(history), items=train_rows, min_calls=3, min_seconds=min_seconds
+        )
+    return cases
+
+
+def photo_cases(keep: Callable[[str], bool], resolutions, index_sizes, min_seconds: float) -> Dict[str, Dict]:
+    from photo_index import PhotoIndex, perceptual_hash
+
+    cases = {}
+    for width, height in resolutions:
+        name = f"photo/perceptual_hash/{width}x{height}"
+        if keep(name):
+            gray = cv2.cvtColor(synthetic_label_photo(width, height, 0)[0], cv2.COLOR_BGR2GRAY)
+            cases[name] = measure(lambda i, gray=gray: perceptual_hash(gray), max_calls=2000, min_seconds=min_seconds)
+
+    rng = np.random.default_rng(5)
+    for size in index_sizes:
+        names = [f"photo/{operation}/{size}" for operation in ("query", "record", "merge")]
+        if not any(keep(name) for name in names):
+            continue
+        hashes = rng.integers(0, 2 ** 64, size, dtype=np.uint64)
+        # Restored from a snapshot, as at start-up
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "photos.npz")
+            np.savez(path, hashes=hashes, users=rng.integers(1, 2 ** 64, size, dtype=np.uint64),
+                     products=rng.integers(1, 2 ** 64, size, dtype=np.uint64),
+                     times=np.full(size, RETURN_TIME.timestamp(), dtype=np.uint32))
+            index = PhotoIndex(path, max_distance=6, max_entries=size)
+            index.path = None
+
+        # Near duplicates of indexed photos: a few bits flipped
+        flips = np.bitwise_or.reduce(np.uint64(1) << rng.integers(0, 64, (2000, 3), dtype=np.uint64), axis=1)
+        queries = [int(h) for h in hashes[rng.integers(0, size, 2000)] ^ flips]
+        if keep(names[0]):
+            cases[names[0]] = measure(lambda i: index.query(queries[i % 2000]), max_calls=2000,
+                                      min_seconds=min_seconds)
+        if keep(names[1]):
+            cases[names[1]] = measure(lambda i: index.record(queries[i % 2000], "BENCH", f"BENCH{i}"),
+                                      max_calls=2000, min_seconds=min_seconds)
+        if keep(names[2]):
+            cases[names[2]] = measure(lambda i: index.compact(), items=size, min_calls=3, min_seconds=min_seconds)
+        del index
+    return cases
+
+
+def http_cases(keep: Callable[[str], bool], resolutions, batch_sizes, images: int,
+               min_seconds: float) -> Dict[str, Dict]:
+    # Every request must reach the analyzer, not the result cache
+    os.environ["RESULT_CACHE_SIZE"] = "0"
+    os.environ.pop("RESULT_CACHE_PATH", None)
+    from fastapi.testclient import TestClient
+    import app
+
+    app.install_trust_scorer(fitted_scorer())
+    client = TestClient(app.app)
+
+    def post(path: str, body: Dict):
+        response = client.post(path, json=body)
+        if response.status_code != 200:
+            raise RuntimeError(f"{path} returned {response.status_code}: {response.text[:200]}")
+        return response
+
+    cases = {}
+    try:
+        for width, height in resolutions:
+            name = f"http/analyze_label/{width}x{height}"
+            if not keep(name):
+                continue
+            bodies = [
+                {"productId": "BENCH", "image": request["image"], "expectedCoordinates": request["coordinates"]}
+                for request in (label_request(width, height, seed) for seed in range(images))
+            ]
+            cases[name] = measure(
+                lambda i, bodies=bodies: post("/analyze/label", bodies[i % len(bodies)]),
+                min_seconds=min_seconds
+            )
+
+        rows = trust_rows(1000, seed=2)
+
+        def score_one(i):
+            j = i % 1000
+            return post("/analyze/trust", {
+                "productId": "BENCH", "userId": "BENCH",
+                "activationTime": rows["activation_times"][j].isoformat(),
+                "returnAttempts": rows["return_attempts"][j]
+            })
+
+        if keep("http/analyze_trust"):
+            cases["http/analyze_trust"] = measure(score_one, max_calls=2000, min_seconds=min_seconds)
+
+        for size in batch_sizes:
+            name = f"http/analyze_trust_batch/{size}"
+            if not keep(name):
+                continue
+            batch = trust_rows(size, seed=3)
+            body = {
+                "productIds": ["BENCH"] * size,
+                "userIds": ["BENCH"] * size,
+                "activationTimes": [t.isoformat() for t in batch["activation_times"]],
+                "returnAttempts": batch["return_attempts"],
+                "labelMatchScores": batch["label_match_scores"],
+                "returnTimestamps": [t.isoformat() for t in batch["return_timestamps"]]
+            }
+            cases[name] = measure(
+                lambda i, body=body: post("/analyze/trust/batch", body),
+                items=size, max_calls=2000, min_seconds=min_seconds
+            )
+    finally:
+        app.vision_pool.shutdown()
+    return cases
+
+
+def environment() -> Dict:
+    """Versions and machine details, to tell whether two runs are comparable."""
+    import sklearn
+
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                                text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "opencv": cv2.__version__,
+        "sklearn": sklearn.__version__,
+        "platform": platform.platform(),
+        "processor": platform.processor() or platform.machine(),
+        "cpus": os.cpu_count(),
+        "opencv_threads": cv2.getNumThreads()
+    }
+
+
+def run(groups: List[str], quick: bool, only: Optional[str], min_seconds: float) -> Dict:
+    resolutions = RESOLUTIONS[:2] if quick else RESOLUTIONS
+    batch_sizes = BATCH_SIZES[:-1] if quick else BATCH_SIZES
+    http_batch_sizes = HTTP_BATCH_SIZES[:1] if quick else HTTP_BATCH_SIZES
+    train_rows = TRAIN_ROWS // 5 if quick else TRAIN_ROWS
+    images = 3
+
+    def keep(name: str) -> bool:
+        return not only or only in name
+
+    cases = {}
+    if "label" in groups:
+        cases.update(label_cases(keep, resolutions, images, min_seconds))
+    if "trust" in groups:
+        cases.update(trust_cases(keep, batch_sizes, train_rows, min_seconds))
+    if "photo" in groups:
+        cases.update(photo_cases(keep, resolutions, PHOTO_INDEX_SIZES[:1] if quick else PHOTO_INDEX_SIZES,
+                                 min_seconds))
+    if "http" in groups:
+        cases.update(http_cases(keep, resolutions[:2], http_batch_sizes, images, min_seconds))
+
+    return {
+        "version": RESULTS_VERSION,
+        "createdAt": datetime.now().isoformat(),
+        "environment": environment(),
+        "settings": {"groups": groups, "quick": quick, "minSeconds": min_seconds},
+        "cases": cases
+    }
+
+
+def compare(results: Dict,
+            baseline: Dict,
+            max_slowdown: float = 0.25,
+            max_p99_slowdown: float = 0.5,
+            max_memory_growth: float = 0.25,
+            noise_floor_ms: float = 0.1) -> List[Dict]:
+    """
+    Compare every case of results that also appears in baseline.
+
+    Args:
+        results: Current run
+        baseline: Run to compare against
+        max_slowdown: Largest accepted relative increase of p50 latency, and
+            decrease of throughput
+        max_p99_slowdown: Largest accepted relative increase of p99 latency
+        max_memory_growth: Largest accepted relative increase of peak memory
+        noise_floor_ms: Latency increases smaller than this are never
+            regressions, however large relative to a tiny baseline
+
+    Returns:
+        One row per case and metric, with the relative change and whether it
+        is a regression
+    """
+    limits = {"p50_ms": max_slowdown, "p99_ms": max_p99_slowdown,
+              "throughput": max_slowdown, "peak_memory_mb": max_memory_growth}
+    rows = []
+    for name, case in results["cases"].items():
+        base = baseline["cases"].get(name)
+        if base is None:
+            continue
+        for metric, larger_is_worse in METRICS.items():
+            old, new = base[metric], case[metric]
+            change = (new - old) / old if old else 0.0
+            worse = change if larger_is_worse else -change
+            regression = worse > limits[metric]
+            if metric.endswith("_ms") and new - old < noise_floor_ms:
+                regression = False
+            rows.append({"case": name, "metric": metric, "baseline": old, "current": new,
+                         "change": change, "regression": regression})
+    return rows
+
+
+def print_results(results: Dict):
+    print(f"{'case':<40} {'calls':>6} {'p50 ms':>10} {'p99 ms':>10} {'per second':>12} {'peak MB':>9}")
+    for name, case in results["cases"].items():
+        print(f"{name:<40} {case['calls']:>6} {case['p50_ms']:10.3f} {case['p99_ms']:10.3f} "
+              f"{case['throughput']:12,.0f} {case['peak_memory_mb']:9.1f}")
+
+
+def print_comparison(rows: List[Dict]):
+    print(f"{'case':<40} {'metric':<15} {'baseline':>12} {'current':>12} {'change':>8}")
+    for row in rows:
+        flag = "  REGRESSION" if row["regression"] else ""
+        print(f"{row['case']:<40} {row['metric']:<15} {row['baseline']:12.3f} {row['current']:12.3f} "
+              f"{row['change']:+8.1%}{flag}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--output", help="Write results to this JSON file")
+    parser.add_argument("--baseline", help="Compare with the results in this JSON file")
+    parser.add_argument("--input", help="Compare these saved results instead of running the benchmarks")
+    parser.add_argument("--groups", nargs="+", choices=["label", "trust", "photo", "http"],
+                        default=["label", "trust", "photo", "http"])
+    parser.add_argument("--only", help="Keep only cases whose name contains this")
+    parser.add_argument("--quick", action="store_true",
+                        help="Skip the largest resolution, batch size and photo index, and train on fewer rows")
+    parser.add_argument("--min-seconds", type=float, default=1.0, help="Minimum timed seconds per case")
+    parser.add_argument("--max-slowdown", type=float, default=0.25,
+                        help="Accepted p50 latency increase and throughput decrease (fraction)")
+    parser.add_argument("--max-p99-slowdown", type=float, default=0.5,
+                        help="Accepted p99 latency increase (fraction)")
+    parser.add_argument("--max-memory-growth", type=float, default=0.25,
+                        help="Accepted peak memory increase (fraction)")
+    parser.add_argument("--noise-floor-ms", type=float, default=0.1,
+                        help="Latency increases below this many ms are never regressions")
+    args = parser.parse_args()
+
+    if args.input:
+        with open(args.input) as f:
+            results = json.load(f)
+    else:
+        results = run(args.groups, args.quick, args.only, args.min_seconds)
+        print_results(results)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        rows = compare(results, baseline, args.max_slowdown, args.max_p99_slowdown,
+                       args.max_memory_growth, args.noise_floor_ms)
+        print()
+        print_comparison(rows)
+        regressions = sorted({row["case"] for row in rows if row["regression"]})
+        if regressions:
+            print(f"\n{len(regressions)} case(s) regressed: {', '.join(regressions)}")
+            sys.exit(1)
+        print(f"\nNo regressions in {len({row['case'] for row in rows})} case(s)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""
+Compare the sklearn IsolationForest with the compiled forest in TrustScorer.
+
+Reports single-row and batch predict latency, checks that scores are
+bit-identical and compares memory use. Run from the ai/ directory:
+
+    python -m benchmarks.trust_scorer
+"""
+import argparse
+import pickle
+import time
+
+import numpy as np
+from sklearn.ensemble import IsolationForest
+
+from compiled_forest import CompiledIsolationForest
+
+BATCH_SIZES = [1, 16, 256, 4096]
+
+
+def synthetic_features(rows: int, seed: int = 0) -> np.ndarray:
+    """Hours since activation, return attempts and label score, as TrustScorer builds them."""
+    rng = np.random.default_rng(seed)
+    return np.column_stack([
+        rng.exponential(200, rows),
+        rng.poisson(0.3, rows),
+        rng.beta(8, 2, rows)
+    ])
+
+
+def median_ms(fn, X: np.ndarray, repeats: int) -> float:
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn(X)
+        timings.append(time.perf_counter() - start)
+    return np.median(timings) * 1000
+
+
+def run(train_rows: int, repeats: int):
+    model = IsolationForest(contamination=0.1, random_state=42).fit(synthetic_features(train_rows))
+    compiled = CompiledIsolationForest(model)
+
+    X = synthetic_features(max(BATCH_SIZES), seed=1)
+    identical = np.array_equal(model.score_samples(X), compiled.score_samples(X)) and all(
+        np.array_equal(model.score_samples(X[i:i + 1]), compiled.score_samples(X[i:i + 1]))
+        for i in range(100)
+    )
+    print(f"bit-identical score_samples: {identical}")
+    print(f"memory: sklearn model {len(pickle.dumps(model)) / 1024:.0f} KiB pickled, "
+          f"compiled arrays {compiled.nbytes / 1024:.0f} KiB")
+
+    print(f"{'rows':>6} {'sklearn ms':>11} {'compiled ms':>12} {'speedup':>8}")
+    for rows in BATCH_SIZES:
+        sklearn_ms = median_ms(model.predict, X[:rows], repeats)
+        compiled_ms = median_ms(compiled.predict, X[:rows], repeats)
+        print(f"{rows:>6} {sklearn_ms:11.3f} {compiled_ms:12.3f} {sklearn_ms / compiled_ms:7.1f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--train-rows", type=int, default=5000)
+    parser.add_argument("--repeats", type=int, default=20)
+    args = parser.parse_args()
+    run(args.train_rows, args.repeats)
@@ -1,100 +1,313 @@
-import numpy as np
-from datetime import datetime, timedelta
+"""
+Generate synthetic label positions, return records and label photos.
+
+Rows are drawn a chunk at a time with a seeded numpy Generator and streamed
+to JSONL, CSV or Parquet, so millions of rows take seconds and little
+memory. Return records can be read back by trust_training. Run from the ai/
+directory:
+
+    python -m datasets.synthetic_generator returns returns.jsonl --rows 5000000 --fraud-ratio 0.2
+    python -m datasets.synthetic_generator labels labels.csv --rows 1000000
+    python -m datasets.synthetic_generator images scans/ --count 200 --tamper-ratio 0.5
+
+The same seed and chunk size always give the same rows. Parquet needs
+pyarrow.
+"""
+import argparse
 import json
 import os
-from typing import List, Dict
+import time
+from datetime import datetime
+from typing import Dict, Iterable, Iterator, List, Optional
+
+import numpy as np
+import pandas as pd
+
+# Larger chunks are no faster, and pandas needs several times a chunk's output size to write it
+DEFAULT_CHUNK_SIZE = 10_000
+
+# Standard label positions (normalized 0-1 range): top left, top right,
+# bottom left, bottom right, as x, y, width, height
+STANDARD_POSITIONS = np.array([
+    [0.1, 0.1, 0.2, 0.1],
+    [0.7, 0.1, 0.2, 0.1],
+    [0.1, 0.8, 0.2, 0.1],
+    [0.7, 0.8, 0.2, 0.1]
+])
+
+# Ways a scanned label can differ from the enrolled one
+TAMPERING = ("counterfeit", "relocated", "reprinted")
+
+
+def _ids(prefix: str, start: int, count: int, width: int = 4) -> np.ndarray:
+    return (prefix + pd.Series(np.arange(start, start + count)).astype(str).str.zfill(width)).to_numpy()
+
+
+def _iso(times: np.ndarray) -> np.ndarray:
+    return np.datetime_as_string(times, unit="us")
+
 
 class SyntheticDataGenerator:
-    def __init__(self, num_samples: int = 1000):
+    def __init__(self,
+                 num_samples: int = 1000,
+                 fraud_ratio: float = 0.2,
+                 seed: Optional[int] = None,
+                 chunk_size: int = DEFAULT_CHUNK_SIZE,
+                 now: Optional[datetime] = None):
+        """
+        Args:
+            num_samples: Rows to generate
+            fraud_ratio: Fraction of suspicious returns
+            seed: Random seed (default: unpredictable)
+            chunk_size: Rows per generated chunk
+            now: Time returns are requested at (default: when created)
+        """
+        if not 0 <= fraud_ratio <= 1:
+            raise ValueError("fraud_ratio must be between 0 and 1")
         self.num_samples = num_samples
-        
+        self.fraud_ratio = fraud_ratio
+        self.seed = seed
+        self.chunk_size = chunk_size
+        self.now = np.datetime64(now or datetime.now(), "us")
+
+    def _chunks(self) -> Iterator[tuple]:
+        """(start row, rows, generator) per chunk, from a fresh generator."""
+        rng = np.random.default_rng(self.seed)
+        for start in range(0, self.num_samples, self.chunk_size):
+            yield start, min(self.chunk_size, self.num_samples - start), rng
+
+    def label_position_chunks(self) -> Iterator[pd.DataFrame]:
+        """Label positions as DataFrames with productId, x, y, width, height and isValid."""
+        for start, rows, rng in self._chunks():
+            base = STANDARD_POSITIONS[rng.integers(0, len(STANDARD_POSITIONS), rows)]
+            # Add some random noise (±10% variation)
+            offsets = rng.uniform(-0.1, 0.1, (rows, 2))
+            scales = rng.uniform(0.9, 1.1, (rows, 2))
+            yield pd.DataFrame({
+                "productId": _ids("PROD", start, rows),
+                "x": base[:, 0] + offsets[:, 0],
+                "y": base[:, 1] + offsets[:, 1],
+                "width": base[:, 2] * scales[:, 0],
+                "height": base[:, 3] * scales[:, 1],
+                "isValid": np.ones(rows, dtype=bool)
+            })
+
+    def return_data_chunks(self) -> Iterator[pd.DataFrame]:
+        """
+        Return records as DataFrames in the format trust_training reads.
+
+        Legitimate returns come 5-30 days after activation, with 0-1 earlier
+        attempts and a label score of 0.8-1.0. Suspicious ones come 1-24 hours
+        after activation, with 2-4 attempts and a label score of 0.3-0.7.
+        """
+        for start, rows, rng in self._chunks():
+            legitimate = rng.random(rows) >= self.fraud_ratio
+            hours = np.where(legitimate, rng.integers(5, 30, rows) * 24, rng.integers(1, 24, rows))
+            attempts = np.where(legitimate, rng.integers(0, 2, rows), rng.integers(2, 5, rows))
+            label_score = np.where(legitimate, rng.uniform(0.8, 1.0, rows), rng.uniform(0.3, 0.7, rows))
+
+            yield pd.DataFrame({
+                "productId": _ids("PROD", start, rows),
+                "activation_time": _iso(self.now - hours.astype("timedelta64[h]")),
+                "return_timestamp": _iso(np.full(rows, self.now)),
+                "return_attempts": attempts,
+                "label_match_score": label_score,
+                "is_legitimate": legitimate
+            })
+
     def generate_label_positions(self) -> List[Dict]:
         """Generate synthetic label position data."""
-        data = []
-        
-        # Standard label positions (normalized 0-1 range)
-        standard_positions = [
-            {"x": 0.1, "y": 0.1, "width": 0.2, "height": 0.1},  # Top left
-            {"x": 0.7, "y": 0.1, "width": 0.2, "height": 0.1},  # Top right
-            {"x": 0.1, "y": 0.8, "width": 0.2, "height": 0.1},  # Bottom left
-            {"x": 0.7, "y": 0.8, "width": 0.2, "height": 0.1}   # Bottom right
+        frame = pd.concat(self.label_position_chunks(), ignore_index=True)
+        positions = frame[["x", "y", "width", "height"]].to_dict("records")
+        return [
+            {"productId": product_id, "labelPosition": position, "isValid": True}
+            for product_id, position in zip(frame["productId"], positions)
         ]
-        
-        for _ in range(self.num_samples):
-            # Pick a random standard position
-            base_pos = standard_positions[np.random.randint(0, len(standard_positions))]
-            
-            # Add some random noise (±10% variation)
-            noise = 0.1
-            pos = {
-                "x": base_pos["x"] + np.random.uniform(-noise, noise),
-                "y": base_pos["y"] + np.random.uniform(-noise, noise),
-                "width": base_pos["width"] * np.random.uniform(0.9, 1.1),
-                "height": base_pos["height"] * np.random.uniform(0.9, 1.1)
-            }
-            
-            data.append({
-                "productId": f"PROD{len(data):04d}",
-                "labelPosition": pos,
-                "isValid": True
-            })
-            
-        return data
-    
+
     def generate_return_data(self) -> List[Dict]:
         """Generate synthetic return attempt data."""
-        data = []
-        
-        # Generate a mix of legitimate and suspicious returns
+        return pd.concat(self.return_data_chunks(), ignore_index=True).to_dict("records")
+
+    def generate_label_images(self,
+                              directory: str,
+                              width: int = 1280,
+                              height: int = 960,
+                              tamper_ratio: float = 0.5) -> List[Dict]:
+        """
+        Write label photo pairs for the vision benchmarks.
+
+        For every product, writes the enrolled reference photo and a rescan
+        of the same garment. A tamper_ratio share of the rescans is tampered,
+        cycling through TAMPERING:
+
+        - counterfeit: a different label sewn in at the same place
+        - relocated: the genuine label moved by one label width
+        - reprinted: the genuine label blurred, recoloured and recompressed
+
+        Returns:
+            Manifest rows, also written to manifest.jsonl in directory
+        """
+        import cv2
+        from benchmarks.images import rescan, synthetic_label_photo
+
+        os.makedirs(directory, exist_ok=True)
+        rng = np.random.default_rng(self.seed)
+        tampered = rng.random(self.num_samples) < tamper_ratio
+        manifest = []
+        tampered_so_far = 0
         for i in range(self.num_samples):
-            is_legitimate = np.random.random() > 0.2  # 80% legitimate returns
-            
-            if is_legitimate:
-                # Legitimate return pattern
-                activation_time = datetime.now() - timedelta(
-                    days=np.random.randint(5, 30)
-                )
-                return_attempts = np.random.randint(0, 2)
-                label_score = np.random.uniform(0.8, 1.0)
-            else:
-                # Suspicious return pattern
-                activation_time = datetime.now() - timedelta(
-                    hours=np.random.randint(1, 24)
-                )
-                return_attempts = np.random.randint(2, 5)
-                label_score = np.random.uniform(0.3, 0.7)
-            
-            data.append({
-                "productId": f"PROD{i:04d}",
-                "activation_time": activation_time.isoformat(),
-                "return_timestamp": datetime.now().isoformat(),
-                "return_attempts": return_attempts,
-                "label_match_score": label_score,
-                "is_legitimate": is_legitimate
+            seed = int(rng.integers(2 ** 31))
+            product_id = f"PROD{i:04d}"
+            reference, coordinates = synthetic_label_photo(width, height, seed)
+            tampering = None
+            if tampered[i]:
+                tampering = TAMPERING[tampered_so_far % len(TAMPERING)]
+                tampered_so_far += 1
+
+            scan = reference
+            if tampering == "counterfeit":
+                scan, _ = synthetic_label_photo(width, height, seed, label_seed=seed + 1)
+            elif tampering == "relocated":
+                scan = _relocate_label(reference, coordinates)
+            elif tampering == "reprinted":
+                scan = _reprint_label(reference, coordinates, rng)
+            scan = rescan(scan, seed)
+
+            reference_file, scan_file = f"{product_id}_reference.jpg", f"{product_id}_scan.jpg"
+            cv2.imwrite(os.path.join(directory, reference_file), reference)
+            cv2.imwrite(os.path.join(directory, scan_file), scan)
+            manifest.append({
+                "productId": product_id,
+                "reference": reference_file,
+                "scan": scan_file,
+                "coordinates": coordinates,
+                "tampering": tampering,
+                "isGenuine": tampering is None
             })
-            
-        return data
-    
+
+        with open(os.path.join(directory, "manifest.jsonl"), "w") as f:
+            for row in manifest:
+                f.write(json.dumps(row) + "\n")
+        return manifest
+
     def save_to_file(self, data: List[Dict], filename: str):
         """Save synthetic data to JSON file."""
         os.makedirs("datasets", exist_ok=True)
         filepath = os.path.join("datasets", filename)
-        
+
         with open(filepath, 'w') as f:
-            json.dump(data, f, indent=2)
-        
+            json.dump(data, f)
+
         print(f"Saved {len(data)} records to {filepath}")
 
+
+def _relocate_label(photo: np.ndarray, coordinates: Dict[str, int]) -> np.ndarray:
+    """Move the label one label width to the right, covering its old place with blurred fabric."""
+    import cv2
+
+    x, y, w, h = (coordinates[k] for k in ("x", "y", "width", "height"))
+    moved = photo.copy()
+    label = photo[y:y + h, x:x + w].copy()
+    moved[y:y + h, x:x + w] = cv2.GaussianBlur(photo[y:y + h, x:x + w], (0, 0), w / 4)
+    moved[y:y + h, x + w:x + 2 * w] = label
+    return moved
+
+
+def _reprint_label(photo: np.ndarray, coordinates: Dict[str, int], rng: np.random.Generator) -> np.ndarray:
+    """Blur, recolour and heavily recompress the label, as a printed copy would look."""
+    import cv2
+
+    x, y, w, h = (coordinates[k] for k in ("x", "y", "width", "height"))
+    reprinted = photo.copy()
+    label = cv2.GaussianBlur(photo[y:y + h, x:x + w], (0, 0), 1.5).astype(np.float32)
+    label = np.clip(label * rng.uniform(0.8, 0.9, 3) + rng.uniform(10, 30), 0, 255).astype(np.uint8)
+    encoded = cv2.imencode(".jpg", label, [cv2.IMWRITE_JPEG_QUALITY, 20])[1]
+    reprinted[y:y + h, x:x + w] = cv2.imdecode(encoded, cv2.IMREAD_COLOR)
+    return reprinted
+
+
+def write_chunks(chunks: Iterable[pd.DataFrame], path: str, format: Optional[str] = None) -> int:
+    """
+    Stream DataFrames to a JSONL, CSV or Parquet file.
+
+    Args:
+        chunks: DataFrames with the same columns
+        path: Output file
+        format: jsonl, csv or parquet (default: from the file extension)
+
+    Returns:
+        Rows written
+    """
+    format = format or os.path.splitext(path)[1].lstrip(".").lower()
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+    rows = 0
+    if format in ("jsonl", "ndjson"):
+        with open(path, "w") as f:
+            for chunk in chunks:
+                text = chunk.to_json(orient="records", lines=True)
+                f.write(text if text.endswith("\n") else text + "\n")
+                rows += len(chunk)
+    elif format == "csv":
+        with open(path, "w", newline="") as f:
+            for chunk in chunks:
+                chunk.to_csv(f, header=rows == 0, index=False)
+                rows += len(chunk)
+    elif format == "parquet":
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError("Writing Parquet needs pyarrow (pip install pyarrow)")
+        writer = None
+        try:
+            for chunk in chunks:
+                table = pa.Table.from_pandas(chunk, preserve_index=False)
+                if writer is None:
+                    writer = pq.ParquetWriter(path, table.schema)
+                writer.write_table(table)
+                rows += len(chunk)
+        finally:
+            if writer is not None:
+                writer.close()
+    else:
+        raise ValueError(f"Unsupported output format '{format}' (use jsonl, csv or parquet)")
+    return rows
+
+
 def main():
-    generator = SyntheticDataGenerator(num_samples=1000)
-    
-    # Generate and save label position data
-    label_data = generator.generate_label_positions()
-    generator.save_to_file(label_data, "synthetic_labels.json")
-    
-    # Generate and save return data
-    return_data = generator.generate_return_data()
-    generator.save_to_file(return_data, "synthetic_returns.json")
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("kind", choices=["returns", "labels", "images"],
+                        help="Return records, label positions or label photos")
+    parser.add_argument("output", help="Output file (returns, labels) or directory (images)")
+    parser.add_argument("--rows", type=int, default=1000, help="Rows to generate")
+    parser.add_argument("--fraud-ratio", type=float, default=0.2, help="Fraction of suspicious returns")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--format", choices=["jsonl", "csv", "parquet"], help="Output format (default: from extension)")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE)
+    parser.add_argument("--count", type=int, default=100, help="Label photo pairs to generate")
+    parser.add_argument("--width", type=int, default=1280, help="Label photo width")
+    parser.add_argument("--height", type=int, default=960, help="Label photo height")
+    parser.add_argument("--tamper-ratio", type=float, default=0.5, help="Fraction of tampered label scans")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    if args.kind == "images":
+        generator = SyntheticDataGenerator(args.count, seed=args.seed)
+        manifest = generator.generate_label_images(args.output, args.width, args.height, args.tamper_ratio)
+        tampered = sum(not row["isGenuine"] for row in manifest)
+        print(f"Wrote {len(manifest)} label photo pairs ({tampered} tampered) to {args.output} "
+              f"in {time.perf_counter() - start:.1f}s")
+        return
+
+    generator = SyntheticDataGenerator(args.rows, args.fraud_ratio, args.seed, args.chunk_size)
+    chunks = generator.return_data_chunks() if args.kind == "returns" else generator.label_position_chunks()
+    rows = write_chunks(chunks, args.output, args.format)
+    seconds = time.perf_counter() - start
+    print(f"Wrote {rows:,} {args.kind} rows to {args.output} in {seconds:.1f}s ({rows / seconds:,.0f} rows/s)")
+
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,201 @@
+import cv2
+import numpy as np
+import os
+from typing import Dict, List, Optional, Tuple
+
+
+class FeatureBackend:
+    """
+    Feature detector, descriptor matcher and score calibration.
+
+    Raw match scores depend on the detector: binary descriptors pass the
+    ratio test at different rates than SIFT on the same label. Each backend
+    carries its own ratio and raw-score thresholds, and calibrate() maps its
+    raw scores so those thresholds land on the analyzer's common thresholds.
+    A calibrated score means the same thing whichever backend produced it.
+    """
+
+    name = ""
+
+    # Lowe's ratio test: keep a match when best < ratio * second best
+    ratio = 0.7
+
+    # Raw scores at which a label matches its surroundings / its reference;
+    # None when raw scores are already on the common scale
+    label_threshold: Optional[float] = None
+    reference_threshold: Optional[float] = None
+
+    # Whether one detection over the label window finds the features a
+    # detection on the label crop would; false when feature caps or contrast
+    # normalization make detection depend on the image extent
+    single_pass = False
+
+    # Descriptor dtype the matcher expects
+    descriptor_dtype = np.float32
+
+    def __init__(self, max_features: Optional[int] = None):
+        """
+        Args:
+            max_features: Strongest keypoints kept per image (default: no limit;
+                AKAZE has no limit and ignores it)
+        """
+        self.max_features = max_features
+        self.detector = self._create_detector()
+        self.matcher = self._create_matcher()
+
+    def _create_detector(self):
+        raise NotImplementedError
+
+    def _create_matcher(self):
+        raise NotImplementedError
+
+    def detect_and_compute(self,
+                           image: np.ndarray,
+                           mask: Optional[np.ndarray] = None) -> Tuple[Tuple, Optional[np.ndarray]]:
+        """Detect keypoints and compute their descriptors."""
+        keypoints, descriptors = self.detector.detectAndCompute(image, mask)
+        if descriptors is None or not len(descriptors):
+            return (), None
+        return keypoints, descriptors
+
+    def detect(self, image: np.ndarray) -> Tuple:
+        """Detect keypoints without computing descriptors."""
+        return tuple(self.detector.detect(image, None))
+
+    def match(self, query: np.ndarray, train: np.ndarray) -> List[cv2.DMatch]:
+        """Match query descriptors to train descriptors, keeping those that pass the ratio test."""
+        if len(train) < 2:
+            return []
+        matches = self.matcher.knnMatch(
+            np.asarray(query, dtype=self.descriptor_dtype),
+            np.asarray(train, dtype=self.descriptor_dtype),
+            k=2
+        )
+        return [
+            pair[0] for pair in matches
+            if len(pair) == 2 and pair[0].distance < self.ratio * pair[1].distance
+        ]
+
+    def calibrate(self, raw_score: float, raw_threshold: Optional[float], threshold: float) -> float:
+        """
+        Map a raw score onto the common scale.
+
+        Piecewise linear through (0, 0), (raw_threshold, threshold) and (1, 1),
+        so labelMatch is decided by the same threshold for every backend.
+        """
+        raw_score = min(1.0, max(0.0, raw_score))
+        if raw_threshold is None:
+            return raw_score
+        if raw_score <= raw_threshold:
+            return raw_score / raw_threshold * threshold
+        return threshold + (raw_score - raw_threshold) / (1 - raw_threshold) * (1 - threshold)
+
+    @classmethod
+    def reference_key(cls, product_id: str) -> str:
+        """Reference store key of a product's features for this backend."""
+        return f"{product_id}@{cls.name}"
+
+    def warm_up(self):
+        """Run detection and matching once so first-call setup is paid up front."""
+        rng = np.random.default_rng(0)
+        noise = rng.integers(0, 256, size=(256, 256), dtype=np.uint8)
+        _, descriptors = self.detect_and_compute(noise)
+        if descriptors is not None:
+            self.match(descriptors, descriptors)
+
+
+class SiftBackend(FeatureBackend):
+    """SIFT with a KD-tree FLANN matcher. Most accurate, and the slowest."""
+
+    name = "sift"
+    single_pass = True
+
+    def _create_detector(self):
+        return cv2.SIFT_create(nfeatures=self.max_features or 0)
+
+    def _create_matcher(self):
+        # FLANN matcher parameters
+        FLANN_INDEX_KDTREE = 1
+        index_params = dict(algorithm=FLANN_INDEX_KDTREE, trees=5)
+        search_params = dict(checks=50)
+        return cv2.FlannBasedMatcher(index_params, search_params)
+
+    def match(self, query: np.ndarray, train: np.ndarray) -> List[cv2.DMatch]:
+        # The KD-trees are randomized; a fixed seed gives the same scan the same score
+        cv2.setRNGSeed(0)
+        return super().match(query, train)
+
+    @classmethod
+    def reference_key(cls, product_id: str) -> str:
+        # SIFT references predate other backends and keep the bare product id
+        return product_id
+
+
+class BinaryBackend(FeatureBackend):
+    """
+    Binary descriptors matched by brute-force Hamming distance.
+
+    Label feature sets hold a few hundred descriptors, where an exact
+    Hamming scan with popcount beats building an LSH index per request.
+    """
+
+    descriptor_dtype = np.uint8
+
+    def _create_matcher(self):
+        return cv2.BFMatcher(cv2.NORM_HAMMING)
+
+
+class OrbBackend(BinaryBackend):
+    """ORB: FAST corners with rotated BRIEF descriptors. The fastest backend."""
+
+    name = "orb"
+    ratio = 0.75
+    label_threshold = 0.25
+    reference_threshold = 0.2
+
+    def __init__(self, max_features: Optional[int] = None):
+        """
+        Args:
+            max_features: Keypoints kept per image (default: ORB_MAX_FEATURES or 1000)
+        """
+        super().__init__(max_features or int(os.getenv("ORB_MAX_FEATURES", 1000)))
+
+    def _create_detector(self):
+        # Smaller patches than the default 31 keep keypoints near the label edges
+        return cv2.ORB_create(nfeatures=self.max_features, edgeThreshold=15, patchSize=15)
+
+
+class AkazeBackend(BinaryBackend):
+    """AKAZE: nonlinear scale space with binary MLDB descriptors."""
+
+    name = "akaze"
+    ratio = 0.8
+    label_threshold = 0.35
+    reference_threshold = 0.25
+
+    def _create_detector(self):
+        return cv2.AKAZE_create()
+
+
+BACKENDS: Dict[str, type] = {
+    SiftBackend.name: SiftBackend,
+    OrbBackend.name: OrbBackend,
+    AkazeBackend.name: AkazeBackend,
+}
+
+
+def create_backend(name: str, max_features: Optional[int] = None) -> FeatureBackend:
+    """
+    Build the feature backend registered under name.
+
+    Args:
+        name: Backend name
+        max_features: Strongest keypoints kept per image (default: the backend's default)
+
+    Raises:
+        ValueError: No backend has that name
+    """
+    try:
+        return BACKENDS[name.lower()](max_features)
+    except KeyError:
+        raise ValueError(f"Unknown feature backend '{name}' (choose from {', '.join(BACKENDS)})")
@@ -0,0 +1,296 @@
+import hashlib
+import os
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+# Days of return counts kept per entity; covers the 30-day window
+HISTORY_DAYS = 32
+
+# Upper bounds (hours) of the time-to-return sketch bins; the last is open
+RETURN_HOURS_BINS = np.array([1, 3, 6, 12, 24, 48, 72, 120, 168, 240, 336, 480, 720, 1080, 1440], dtype=np.float64)
+# Value reported for a median falling in each bin (geometric bin centre)
+RETURN_HOURS_VALUES = np.sqrt(np.concatenate([[0.5], RETURN_HOURS_BINS]) * np.concatenate([RETURN_HOURS_BINS, [2880]]))
+
+# History features appended to the trust model input, in order
+HISTORY_FEATURES = (
+    "user_returns_7d",
+    "user_returns_30d",
+    "user_mean_label_score",
+    "user_median_return_hours",
+    "product_returns_30d",
+)
+
+# Features of an entity with no recorded returns
+NO_HISTORY = np.array([0.0, 0.0, 1.0, -1.0, 0.0])
+
+
+def entity_key(entity_id: str) -> int:
+    """64-bit key for a user or product id."""
+    digest = hashlib.blake2b(str(entity_id).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "little")
+
+
+def to_naive_utc(timestamp: datetime) -> datetime:
+    """A timestamp as naive UTC; naive timestamps are taken to be UTC already."""
+    if timestamp.utcoffset() is not None:
+        return timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    return timestamp
+
+
+def hours_between(start: datetime, end: datetime) -> float:
+    """Hours from start to end, whether each is naive (UTC) or timezone-aware."""
+    return (to_naive_utc(end) - to_naive_utc(start)).total_seconds() / 3600
+
+
+def _day(timestamp: datetime) -> int:
+    return int(timestamp.timestamp() // 86400)
+
+
+class _EntityTable:
+    """
+    Rolling return aggregates for one kind of entity, in fixed-size arrays.
+
+    Each entity owns one slot: a ring of daily return counts, a log-binned
+    histogram of time-to-return, and the sum and count of label scores.
+    When all slots are taken, the least recently updated entities are evicted.
+    """
+
+    FIELDS = ("keys", "days", "last_day", "hours", "label_sum", "label_count", "updated")
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.keys = np.zeros(capacity, dtype=np.uint64)
+        self.days = np.zeros((capacity, HISTORY_DAYS), dtype=np.uint16)
+        self.last_day = np.zeros(capacity, dtype=np.int32)
+        self.hours = np.zeros((capacity, len(RETURN_HOURS_BINS) + 1), dtype=np.uint16)
+        self.label_sum = np.zeros(capacity, dtype=np.float64)
+        self.label_count = np.zeros(capacity, dtype=np.uint32)
+        self.updated = np.zeros(capacity, dtype=np.float64)
+        self.evictions = 0
+        self._slots: Dict[int, int] = {}
+        self._free: List[int] = list(range(capacity - 1, -1, -1))
+
+    def __len__(self) -> int:
+        return len(self._slots)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(getattr(self, field).nbytes for field in self.FIELDS)
+
+    def find(self, key: int) -> int:
+        """Slot of key, or -1."""
+        return self._slots.get(key, -1)
+
+    def _allocate(self, key: int) -> int:
+        if not self._free:
+            self._evict(max(1, self.capacity // 64))
+        slot = self._free.pop()
+        self._slots[key] = slot
+        self.keys[slot] = key
+        self.days[slot] = 0
+        self.hours[slot] = 0
+        self.label_sum[slot] = 0
+        self.label_count[slot] = 0
+        self.last_day[slot] = 0
+        return slot
+
+    def _evict(self, count: int):
+        """Free the count least recently updated slots."""
+        used = np.fromiter(self._slots.values(), dtype=np.int64, count=len(self._slots))
+        oldest = used[np.argpartition(self.updated[used], count - 1)[:count]]
+        for slot in oldest:
+            del self._slots[int(self.keys[slot])]
+            self._free.append(int(slot))
+        self.evictions += count
+
+    def add(self, key: int, day: int, hours: float, label_score: float):
+        slot = self.find(key)
+        if slot < 0:
+            slot = self._allocate(key)
+
+        last_day = int(self.last_day[slot])
+        if day > last_day:
+            # Clear the ring entries of the days skipped since the last return
+            stale = np.arange(last_day + 1, min(day, last_day + HISTORY_DAYS) + 1) % HISTORY_DAYS
+            self.days[slot, stale] = 0
+            self.last_day[slot] = last_day = day
+        if last_day - day < HISTORY_DAYS:
+            ring = day % HISTORY_DAYS
+            self.days[slot, ring] = min(int(self.days[slot, ring]) + 1, np.iinfo(np.uint16).max)
+
+        if hours >= 0:
+            bin_index = int(np.searchsorted(RETURN_HOURS_BINS, hours))
+            self.hours[slot, bin_index] = min(int(self.hours[slot, bin_index]) + 1, np.iinfo(np.uint16).max)
+        self.label_sum[slot] += label_score
+        self.label_count[slot] += 1
+        self.updated[slot] = time.time()
+
+    def returns_within(self, slots: np.ndarray, days: np.ndarray, window: int) -> np.ndarray:
+        """Returns in the window days up to and including days, per slot (-1 slots give 0)."""
+        window_days = days[:, None] - np.arange(window)[None, :]
+        safe_slots = np.maximum(slots, 0)
+        last_day = self.last_day[safe_slots][:, None]
+        # Ring entries are only valid for the HISTORY_DAYS days up to last_day
+        valid = (slots[:, None] >= 0) & (window_days <= last_day) & (window_days > last_day - HISTORY_DAYS)
+        counts = self.days[safe_slots[:, None], window_days % HISTORY_DAYS]
+        return np.where(valid, counts, 0).sum(axis=1).astype(np.float64)
+
+    def mean_label_scores(self, slots: np.ndarray) -> np.ndarray:
+        safe_slots = np.maximum(slots, 0)
+        count = self.label_count[safe_slots]
+        mean = self.label_sum[safe_slots] / np.maximum(count, 1)
+        return np.where((slots >= 0) & (count > 0), mean, NO_HISTORY[2])
+
+    def median_return_hours(self, slots: np.ndarray) -> np.ndarray:
+        """Median time-to-return estimated from the binned sketch."""
+        safe_slots = np.maximum(slots, 0)
+        cumulative = np.cumsum(self.hours[safe_slots], axis=1)
+        total = cumulative[:, -1]
+        median_bin = (cumulative < (total[:, None] + 1) / 2).sum(axis=1)
+        median = RETURN_HOURS_VALUES[np.minimum(median_bin, len(RETURN_HOURS_VALUES) - 1)]
+        return np.where((slots >= 0) & (total > 0), median, NO_HISTORY[3])
+
+    def state(self, prefix: str) -> Dict[str, np.ndarray]:
+        used = np.fromiter(self._slots.values(), dtype=np.int64, count=len(self._slots))
+        return {f"{prefix}_{field}": getattr(self, field)[used] for field in self.FIELDS}
+
+    def restore(self, prefix: str, state: Dict[str, np.ndarray]):
+        keys = state[f"{prefix}_keys"]
+        # Keep the most recently updated entities if the snapshot is larger
+        order = np.argsort(-state[f"{prefix}_updated"], kind="stable")[:self.capacity]
+        count = len(order)
+        for field in self.FIELDS:
+            getattr(self, field)[:count] = state[f"{prefix}_{field}"][order]
+        self._slots = {int(key): slot for slot, key in enumerate(keys[order])}
+        self._free = list(range(self.capacity - 1, count - 1, -1))
+
+
+class ReturnHistoryStore:
+    """
+    In-service rolling return aggregates per user and per product.
+
+    Updated incrementally as each return is scored, so the trust model sees
+    return history without the backend shipping it or anything rescanning
+    it. Memory is bounded by max_entities per kind (about 130 bytes of
+    arrays per entity plus the id lookup); the least recently updated
+    entities are evicted first. Ids are kept as 64-bit hashes only.
+
+    Thread-safe. The aggregates live in one process: the save() of every
+    process replaces the same snapshot file, so keeping the history of all
+    traffic needs a single service worker.
+    """
+
+    def __init__(self,
+                 path: Optional[str] = None,
+                 max_entities: Optional[int] = None,
+                 snapshot_interval: Optional[float] = None):
+        """
+        Args:
+            path: Snapshot file, restored if it exists (default: TRUST_HISTORY_PATH; None keeps no snapshot)
+            max_entities: Users and products each kept (default: TRUST_HISTORY_MAX_ENTITIES or 100000)
+            snapshot_interval: Seconds between snapshots (default: TRUST_HISTORY_SNAPSHOT_SECONDS or 300)
+        """
+        if path is None:
+            path = os.getenv("TRUST_HISTORY_PATH")
+        if max_entities is None:
+            max_entities = int(os.getenv("TRUST_HISTORY_MAX_ENTITIES", 100000))
+        if snapshot_interval is None:
+            snapshot_interval = float(os.getenv("TRUST_HISTORY_SNAPSHOT_SECONDS", 300))
+
+        self.path = path
+        self.snapshot_interval = snapshot_interval
+        self.users = _EntityTable(max(1, max_entities))
+        self.products = _EntityTable(max(1, max_entities))
+        self._lock = threading.Lock()
+        self._last_snapshot = time.monotonic()
+
+        if path and os.path.exists(path):
+            self.load(path)
+
+    def record(self,
+               user_id: str,
+               product_id: str,
+               return_timestamp: datetime,
+               activation_time: datetime,
+               label_match_score: float):
+        """Add one scored return to the user's and the product's aggregates."""
+        day = _day(to_naive_utc(return_timestamp))
+        hours = hours_between(activation_time, return_timestamp)
+        with self._lock:
+            self.users.add(entity_key(user_id), day, hours, label_match_score)
+            self.products.add(entity_key(product_id), day, hours, label_match_score)
+
+    def features(self,
+                 user_ids: Sequence[str],
+                 product_ids: Sequence[str],
+                 timestamps: Sequence[datetime]) -> np.ndarray:
+        """
+        History features (HISTORY_FEATURES) as of each timestamp.
+
+        Args:
+            user_ids: User of each return, or None
+            product_ids: Product of each return, or None
+            timestamps: Time each return was requested
+
+        Returns:
+            Array of shape (len(user_ids), len(HISTORY_FEATURES))
+        """
+        days = np.array([_day(to_naive_utc(timestamp)) for timestamp in timestamps], dtype=np.int64)
+        with self._lock:
+            # Unknown (None) ids have no history
+            users = np.array([
+                self.users.find(entity_key(user_id)) if user_id is not None else -1
+                for user_id in user_ids
+            ], dtype=np.int64)
+            products = np.array([
+                self.products.find(entity_key(product_id)) if product_id is not None else -1
+                for product_id in product_ids
+            ], dtype=np.int64)
+            return np.column_stack([
+                self.users.returns_within(users, days, 7),
+                self.users.returns_within(users, days, 30),
+                self.users.mean_label_scores(users),
+                self.users.median_return_hours(users),
+                self.products.returns_within(products, days, 30),
+            ]).reshape(len(days), len(HISTORY_FEATURES))
+
+    def snapshot_due(self) -> bool:
+        return bool(self.path) and time.monotonic() - self._last_snapshot >= self.snapshot_interval
+
+    def save(self, path: Optional[str] = None):
+        """Write a snapshot, atomically replacing the previous one."""
+        path = path or self.path
+        if not path:
+            return
+        with self._lock:
+            state = {**self.users.state("users"), **self.products.state("products")}
+            self._last_snapshot = time.monotonic()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # Per process, so concurrent saves never write into one temporary file
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(f, **state)
+        os.replace(tmp_path, path)
+
+    def load(self, path: str):
+        """Restore aggregates from a snapshot."""
+        with np.load(path) as snapshot:
+            state = dict(snapshot)
+        with self._lock:
+            self.users.restore("users", state)
+            self.products.restore("products", state)
+
+    def stats(self) -> Dict:
+        return {
+            "users": len(self.users),
+            "products": len(self.products),
+            "evictions": self.users.evictions + self.products.evictions,
+            "bytes": self.users.nbytes + self.products.nbytes
+        }
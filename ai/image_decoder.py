@@ -0,0 +1,199 @@
+import cv2
+import numpy as np
+from PIL import Image
+import io
+import os
+from typing import Dict, Optional, Tuple
+
+# EXIF orientation tag
+EXIF_ORIENTATION = 0x0112
+
+# OpenCV flags for JPEG DCT-scaled grayscale decode, keyed by reduction factor
+REDUCED_GRAYSCALE_FLAGS = {
+    1: cv2.IMREAD_GRAYSCALE,
+    2: cv2.IMREAD_REDUCED_GRAYSCALE_2,
+    4: cv2.IMREAD_REDUCED_GRAYSCALE_4,
+    8: cv2.IMREAD_REDUCED_GRAYSCALE_8,
+}
+
+
+def is_normalized(coordinates: Dict[str, float]) -> bool:
+    """
+    Whether label coordinates are fractions (0-1) of the image size rather than pixels.
+
+    A box that fits in one pixel is no usable label, so boxes inside the unit
+    square are read as normalized.
+    """
+    try:
+        x, y, width, height = (float(coordinates[key]) for key in ("x", "y", "width", "height"))
+    except (KeyError, TypeError, ValueError):
+        return False
+    return all(0 <= value <= 1 for value in (x, y, width, height)) and width > 0 and height > 0
+
+
+def to_pixels(coordinates: Dict[str, float], width: int, height: int) -> Dict[str, float]:
+    """Normalized label coordinates in pixels of a width x height image."""
+    return {
+        "x": coordinates["x"] * width,
+        "y": coordinates["y"] * height,
+        "width": coordinates["width"] * width,
+        "height": coordinates["height"] * height
+    }
+
+
+class ImageTooLargeError(ValueError):
+    """Raised when an image exceeds the configured byte or pixel limits."""
+
+
+class ImageHeader:
+    """Image properties read from the file header, without decoding pixels."""
+
+    def __init__(self, width: int, height: int, format: Optional[str], orientation: int):
+        self.width = width
+        self.height = height
+        self.format = format
+        self.orientation = orientation
+
+    @property
+    def oriented_size(self) -> Tuple[int, int]:
+        """(width, height) after applying the EXIF orientation."""
+        # Orientations 5-8 include a 90 degree rotation
+        if self.orientation in (5, 6, 7, 8):
+            return self.height, self.width
+        return self.width, self.height
+
+
+class ImageDecoder:
+    """
+    Bounded-resolution image decoder.
+
+    Reads the header first and rejects oversized images before any pixel is
+    decoded. Decodes straight to grayscale. For JPEGs it uses DCT-scaled
+    decoding when the label is large enough to survive the reduction.
+    """
+
+    def __init__(self,
+                 max_bytes: Optional[int] = None,
+                 max_pixels: Optional[int] = None,
+                 max_dimension: Optional[int] = None,
+                 min_label_side: Optional[int] = None):
+        """
+        Args:
+            max_bytes: Largest accepted encoded image (default: MAX_IMAGE_SIZE or 10 MB)
+            max_pixels: Largest accepted width * height (default: MAX_IMAGE_PIXELS or 50 MP)
+            max_dimension: Largest accepted width or height (default: MAX_IMAGE_DIMENSION or 12000)
+            min_label_side: Smallest label side, in decoded pixels, allowed after a
+                reduced decode (default: LABEL_MIN_SIDE or 128)
+        """
+        self.max_bytes = max_bytes or int(os.getenv("MAX_IMAGE_SIZE", 10 * 1024 * 1024))
+        self.max_pixels = max_pixels or int(os.getenv("MAX_IMAGE_PIXELS", 50_000_000))
+        self.max_dimension = max_dimension or int(os.getenv("MAX_IMAGE_DIMENSION", 12000))
+        self.min_label_side = min_label_side or int(os.getenv("LABEL_MIN_SIDE", 128))
+
+    def check_size(self, num_bytes: int):
+        """Reject encoded payloads larger than max_bytes."""
+        if num_bytes > self.max_bytes:
+            raise ImageTooLargeError(
+                f"Image is {num_bytes} bytes, limit is {self.max_bytes}"
+            )
+
+    def probe(self, image_bytes: bytes) -> ImageHeader:
+        """
+        Read image dimensions, format and EXIF orientation from the header.
+
+        Raises:
+            ImageTooLargeError: The image exceeds the byte or pixel limits
+            ValueError: The header cannot be parsed or has invalid dimensions
+        """
+        self.check_size(len(image_bytes))
+        try:
+            # Image.open only parses the header; pixels are decoded lazily
+            with Image.open(io.BytesIO(image_bytes)) as img:
+                width, height = img.size
+                orientation = img.getexif().get(EXIF_ORIENTATION, 1)
+                header = ImageHeader(width, height, img.format, orientation)
+        except Image.DecompressionBombError as e:
+            raise ImageTooLargeError(str(e))
+        except Exception as e:
+            raise ValueError(f"Unable to read image header: {e}")
+
+        if header.width <= 0 or header.height <= 0:
+            raise ValueError(f"Invalid image dimensions {header.width}x{header.height}")
+        if max(header.width, header.height) > self.max_dimension:
+            raise ImageTooLargeError(
+                f"Image is {header.width}x{header.height}, "
+                f"largest side limit is {self.max_dimension}"
+            )
+        if header.width * header.height > self.max_pixels:
+            raise ImageTooLargeError(
+                f"Image has {header.width * header.height} pixels, limit is {self.max_pixels}"
+            )
+        return header
+
+    def reduction_factor(self, header: ImageHeader, roi: Optional[Dict[str, float]]) -> int:
+        """
+        Pick the largest JPEG reduction that keeps the label at least
+        min_label_side pixels on its shorter side.
+        """
+        # Only JPEG supports reduced decoding in the DCT domain
+        if header.format != "JPEG" or not roi:
+            return 1
+        if is_normalized(roi):
+            roi = to_pixels(roi, *header.oriented_size)
+        try:
+            label_side = min(float(roi["width"]), float(roi["height"]))
+        except (KeyError, TypeError, ValueError):
+            return 1
+
+        for factor in (8, 4, 2):
+            if label_side / factor >= self.min_label_side:
+                return factor
+        return 1
+
+    def decode(self,
+               image_bytes: bytes,
+               roi: Optional[Dict[str, float]] = None) -> Tuple[np.ndarray, float]:
+        """
+        Decode an image to an upright grayscale array.
+
+        Args:
+            image_bytes: Encoded image file contents
+            roi: Optional label coordinates, in full-resolution pixels or
+                normalized, used to choose how far the decode can be reduced
+
+        Returns:
+            (grayscale image, scale) where scale maps full-resolution pixel
+            coordinates onto the decoded image
+        """
+        header = self.probe(image_bytes)
+        factor = self.reduction_factor(header, roi)
+
+        # Orientation is applied below from the header we already parsed
+        flags = REDUCED_GRAYSCALE_FLAGS[factor] | cv2.IMREAD_IGNORE_ORIENTATION
+        gray = cv2.imdecode(np.frombuffer(image_bytes, dtype=np.uint8), flags)
+        if gray is None:
+            raise ValueError("Unable to decode image")
+
+        gray = self._apply_orientation(gray, header.orientation)
+
+        # Reduced decodes round sizes up, so measure the real scale
+        oriented_width, _ = header.oriented_size
+        return gray, gray.shape[1] / oriented_width
+
+    def _apply_orientation(self, image: np.ndarray, orientation: int) -> np.ndarray:
+        """Rotate/flip the decoded image so it matches EXIF orientation 1."""
+        if orientation == 2:
+            return cv2.flip(image, 1)
+        if orientation == 3:
+            return cv2.rotate(image, cv2.ROTATE_180)
+        if orientation == 4:
+            return cv2.flip(image, 0)
+        if orientation == 5:
+            return cv2.flip(cv2.rotate(image, cv2.ROTATE_90_CLOCKWISE), 1)
+        if orientation == 6:
+            return cv2.rotate(image, cv2.ROTATE_90_CLOCKWISE)
+        if orientation == 7:
+            return cv2.flip(cv2.rotate(image, cv2.ROTATE_90_COUNTERCLOCKWISE), 1)
+        if orientation == 8:
+            return cv2.rotate(image, cv2.ROTATE_90_COUNTERCLOCKWISE)
+        return image
@@ -1,20 +1,90 @@
 import cv2
 import numpy as np
-from PIL import Image
 import base64
-import io
-from typing import Dict, Tuple
+import os
+from typing import Dict, Optional, Tuple, Union
+
+from feature_backends import FeatureBackend, create_backend
+from image_decoder import ImageDecoder, is_normalized, to_pixels
+from metrics import NULL_TIMER, StageTimer
+from photo_index import perceptual_hash
+from reference_store import ReferenceFeatures, ReferenceStore
+from scan_session import frame_difference, frame_sharpness, frame_thumbnail
+
+# Calibrated score above which a label matches its surroundings
+LABEL_MATCH_THRESHOLD = 0.5
+
+# Keypoint sizes a single-pass label feature must clear the label box edges
+# by to count as one the label crop would re-find
+LABEL_EDGE_MARGIN = 1.5
 
 class LabelAnalyzer:
-    def __init__(self):
-        # Initialize feature detector
-        self.sift = cv2.SIFT_create()
+    def __init__(self,
+                 decoder: Optional[ImageDecoder] = None,
+                 reference_store: Optional[ReferenceStore] = None,
+                 backend: Optional[str] = None):
+        # Bounded-resolution grayscale decoder
+        self.decoder = decoder or ImageDecoder()
+
+        # Enrolled reference labels, matched instead of the surrounding region when present
+        self.reference_store = reference_store
+        self.reference_threshold = float(os.getenv("REFERENCE_MATCH_THRESHOLD", 0.3))
+        self.max_reference_features = int(os.getenv("REFERENCE_MAX_FEATURES", 500))
+
+        # Detect once over the surrounding window instead of twice
+        self.single_pass = os.getenv("LABEL_SINGLE_PASS", "true").lower() == "true"
+
+        # Coarse-to-fine cascade: a downscaled pass with a capped detector settles
+        # clear matches, and only the rest pay for full-resolution detection.
+        # Off by default: with ORB and AKAZE it settles too few scans to pay for itself
+        self.cascade = os.getenv("LABEL_CASCADE", "false").lower() == "true"
+        self.coarse_side = int(os.getenv("LABEL_COARSE_SIDE", 48))
+        self.coarse_max_features = int(os.getenv("LABEL_COARSE_MAX_FEATURES", 500))
+        self.coarse_min_keypoints = int(os.getenv("LABEL_COARSE_MIN_KEYPOINTS", 20))
+        self.coarse_accept = float(os.getenv("LABEL_COARSE_ACCEPT", 0.7))
+
+        # Burst scan frames blurrier than this, or this close to the previous
+        # analyzed frame, are skipped before feature extraction
+        self.min_sharpness = float(os.getenv("SCAN_MIN_SHARPNESS", 15))
+        self.min_frame_difference = float(os.getenv("SCAN_MIN_FRAME_DIFFERENCE", 2.0))
+
+        # Built once and reused; every worker process has its own analyzer
+        self._clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
+
+        # Feature backends, built on first use; requests may pick a non-default one
+        self._backends: Dict[str, FeatureBackend] = {}
+        self._coarse_backends: Dict[str, FeatureBackend] = {}
+        self.default_backend = self.backend(backend or os.getenv("FEATURE_BACKEND", "sift")).name
+
+    def backend(self, name: Optional[str] = None) -> FeatureBackend:
+        """
+        Feature backend registered under name, or the default backend.
         
-        # FLANN matcher parameters
-        FLANN_INDEX_KDTREE = 1
-        index_params = dict(algorithm=FLANN_INDEX_KDTREE, trees=5)
-        search_params = dict(checks=50)
-        self.flann = cv2.FlannBasedMatcher(index_params, search_params)
+        Raises:
+            ValueError: No backend has that name
+        """
+        name = (name or self.default_backend).lower()
+        if name not in self._backends:
+            self._backends[name] = create_backend(name)
+        return self._backends[name]
+
+    def coarse_backend(self, name: Optional[str] = None) -> FeatureBackend:
+        """Feature backend for the coarse stage: same detector, capped at coarse_max_features."""
+        name = (name or self.default_backend).lower()
+        if name not in self._coarse_backends:
+            self._coarse_backends[name] = create_backend(name, self.coarse_max_features)
+        return self._coarse_backends[name]
+
+    def warm_up(self):
+        """
+        Analyze a synthetic photo once so first-call setup (decoder, CLAHE,
+        detector and matcher) is paid before real requests arrive.
+        """
+        self.backend().warm_up()
+        rng = np.random.default_rng(0)
+        photo = cv2.GaussianBlur(rng.integers(0, 256, (480, 640, 3), dtype=np.uint8), (9, 9), 0)
+        _, encoded = cv2.imencode(".jpg", photo)
+        self.analyze_label_bytes(encoded.tobytes(), {"x": 220, "y": 190, "width": 200, "height": 100})
 
     def _preprocess_image(self, image: np.ndarray) -> np.ndarray:
         """Preprocess image for feature detection."""
@@ -25,19 +95,110 @@ class LabelAnalyzer:
             gray = image
         
         # Apply adaptive histogram equalization
-        clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8,8))
-        return clahe.apply(gray)
+        return self._clahe.apply(gray)
 
-    def _decode_base64_image(self, base64_string: str) -> np.ndarray:
-        """Decode base64 image to numpy array."""
+    def _preprocess_window(self,
+                           image: np.ndarray,
+                           coordinates: Dict[str, float]) -> Tuple[np.ndarray, Dict[str, float]]:
+        """
+        Crop the 3x3 label-sized window around the label and preprocess only that.
+        
+        Analysis never looks outside this window, so cropping before colour
+        conversion and equalization makes their cost follow the label size
+        rather than the photo size.
+        
+        Args:
+            image: Decoded image
+            coordinates: Label coordinates in pixels of image, or normalized
+            
+        Returns:
+            (preprocessed window, label coordinates in window pixels)
+        """
+        coordinates = self._pixel_coordinates(coordinates, image.shape)
+        top, bottom, left, right = self._surrounding_bounds(image.shape, coordinates)
+        window = self._preprocess_image(image[top:bottom, left:right])
+        return window, {**coordinates, "x": coordinates["x"] - left, "y": coordinates["y"] - top}
+
+    def _base64_to_bytes(self, base64_string: str) -> bytes:
+        """Decode a base64 string (optionally a data URL) to encoded image bytes."""
         # Remove data URL prefix if present
         if ',' in base64_string:
             base64_string = base64_string.split(',')[1]
+        return base64.b64decode(base64_string)
+
+    def _decode_base64_image(self,
+                             base64_string: str,
+                             roi: Optional[Dict[str, float]] = None) -> Tuple[np.ndarray, float]:
+        """Decode base64 image to a grayscale numpy array and its scale."""
+        return self._decode_image_bytes(self._base64_to_bytes(base64_string), roi)
+
+    def _decode_image_bytes(self,
+                            image_bytes: bytes,
+                            roi: Optional[Dict[str, float]] = None) -> Tuple[np.ndarray, float]:
+        """
+        Decode raw encoded image bytes (JPEG, PNG, ...) to a grayscale numpy array.
         
-        # Decode base64 to image
-        img_data = base64.b64decode(base64_string)
-        img = Image.open(io.BytesIO(img_data))
-        return cv2.cvtColor(np.array(img), cv2.COLOR_RGB2BGR)
+        Returns the image and the scale factor from full-resolution pixel
+        coordinates to the decoded image (below 1.0 for reduced JPEG decodes).
+        """
+        return self.decoder.decode(image_bytes, roi)
+
+    def _surrounding_bounds(self,
+                            shape: Tuple[int, ...],
+                            coordinates: Dict[str, float]) -> Tuple[int, int, int, int]:
+        """(top, bottom, left, right) of the 3x3 label-sized window around the label."""
+        return (
+            max(0, int(coordinates['y'] - coordinates['height'])),
+            min(shape[0], int(coordinates['y'] + 2 * coordinates['height'])),
+            max(0, int(coordinates['x'] - coordinates['width'])),
+            min(shape[1], int(coordinates['x'] + 2 * coordinates['width']))
+        )
+
+    def _label_box(self,
+                   shape: Tuple[int, ...],
+                   coordinates: Dict[str, float]) -> Tuple[int, int, int, int]:
+        """(x0, y0, x1, y1) of the label box in the coordinates of its surrounding window."""
+        top, bottom, left, right = self._surrounding_bounds(shape, coordinates)
+        x0, y0 = int(coordinates['x']) - left, int(coordinates['y']) - top
+        x1 = min(x0 + int(coordinates['width']), right - left)
+        y1 = min(y0 + int(coordinates['height']), bottom - top)
+        return x0, y0, x1, y1
+
+    def _detect_single_pass(self,
+                            image: np.ndarray,
+                            coordinates: Dict[str, float],
+                            backend: FeatureBackend) -> Tuple[Tuple, Tuple]:
+        """
+        Detect keypoints once over the surrounding window and split off the label's.
+        
+        The window contains the label, so the label keypoints are the window
+        keypoints that fall inside the label box. Crops bound the work to the
+        window; nothing outside it is processed.
+        
+        Returns:
+            (label keypoints, window keypoints), in window coordinates
+        """
+        top, bottom, left, right = self._surrounding_bounds(image.shape, coordinates)
+        keypoints = backend.detect(image[top:bottom, left:right])
+        x0, y0, x1, y1 = self._label_box(image.shape, coordinates)
+        label_keypoints = tuple(
+            kp for kp in keypoints
+            if x0 <= kp.pt[0] < x1 and y0 <= kp.pt[1] < y1
+        )
+        return label_keypoints, keypoints
+
+    def _scale_coordinates(self, coordinates: Dict[str, float], scale: float) -> Dict[str, float]:
+        """Map full-resolution label coordinates onto a reduced decode."""
+        # Normalized coordinates hold at any resolution
+        if scale == 1.0 or is_normalized(coordinates):
+            return coordinates
+        return {key: value * scale for key, value in coordinates.items()}
+
+    def _pixel_coordinates(self, coordinates: Dict[str, float], shape: Tuple[int, ...]) -> Dict[str, float]:
+        """Label coordinates in pixels of an image of this shape."""
+        if is_normalized(coordinates):
+            return to_pixels(coordinates, shape[1], shape[0])
+        return coordinates
 
     def _extract_label_region(self, image: np.ndarray, coordinates: Dict[str, float]) -> np.ndarray:
         """Extract label region using provided coordinates."""
@@ -45,79 +206,425 @@ class LabelAnalyzer:
         w, h = int(coordinates['width']), int(coordinates['height'])
         return image[y:y+h, x:x+w]
 
-    def analyze_label(self, image_base64: str, expected_coordinates: Dict[str, float]) -> Dict[str, float]:
+    def analyze_label(self,
+                      image_base64: str,
+                      expected_coordinates: Dict[str, float],
+                      product_id: Optional[str] = None,
+                      backend: Optional[str] = None,
+                      timer: StageTimer = NULL_TIMER) -> Dict[str, float]:
         """
         Analyze label placement and authenticity.
         
         Args:
             image_base64: Base64 encoded image
-            expected_coordinates: Dict with x, y, width, height of expected label position
+            expected_coordinates: Dict with x, y, width, height of expected label position,
+                in pixels or as fractions (0-1) of the image size
+            product_id: Product whose enrolled reference label, if any, is matched against
+            backend: Feature backend name (default: the analyzer's default backend)
+            timer: Records the time of each stage and the image and keypoint counts
             
         Returns:
             Dict with match score and confidence
         """
+        timer.skip()
         try:
-            # Decode and preprocess image
-            image = self._decode_base64_image(image_base64)
-            processed_image = self._preprocess_image(image)
-            
-            # Extract label region
-            label_region = self._extract_label_region(processed_image, expected_coordinates)
-            
-            # Detect features in label region
-            keypoints, descriptors = self.sift.detectAndCompute(label_region, None)
-            
-            if descriptors is None or len(keypoints) < 10:
-                return {
-                    "labelMatch": False,
-                    "score": 0.0,
-                    "confidence": 1.0,
-                    "error": "Insufficient features detected"
-                }
-            
-            # Compare with surrounding region
-            surrounding_region = processed_image[
-                max(0, int(expected_coordinates['y'] - expected_coordinates['height'])):
-                min(processed_image.shape[0], int(expected_coordinates['y'] + 2 * expected_coordinates['height'])),
-                max(0, int(expected_coordinates['x'] - expected_coordinates['width'])):
-                min(processed_image.shape[1], int(expected_coordinates['x'] + 2 * expected_coordinates['width']))
-            ]
-            
-            # Detect features in surrounding region
-            surr_keypoints, surr_descriptors = self.sift.detectAndCompute(surrounding_region, None)
+            image_bytes = self._base64_to_bytes(image_base64)
+            timer.lap("base64_decode")
+        except Exception as e:
+            return self._error_result(e, timer)
+        return self.analyze_label_bytes(image_bytes, expected_coordinates, product_id, backend, timer)
+
+    def analyze_label_bytes(self,
+                            image_bytes: bytes,
+                            expected_coordinates: Dict[str, float],
+                            product_id: Optional[str] = None,
+                            backend: Optional[str] = None,
+                            timer: StageTimer = NULL_TIMER) -> Dict[str, float]:
+        """
+        Analyze label placement from raw encoded image bytes.
+        
+        Same as analyze_label, but skips the base64 round trip so the
+        uploaded buffer is decoded in place.
+        
+        Args:
+            image_bytes: Encoded image file contents
+            expected_coordinates: Dict with x, y, width, height of expected label position,
+                in pixels or as fractions (0-1) of the image size
+            product_id: Product whose enrolled reference label, if any, is matched against
+            backend: Feature backend name (default: the analyzer's default backend)
+            timer: Records the time of each stage and the image and keypoint counts
             
-            if surr_descriptors is None:
-                return {
-                    "labelMatch": True,
-                    "score": 0.8,  # High score since no competing features found
-                    "confidence": 0.7
-                }
+        Returns:
+            Dict with match score and confidence, and the perceptual hash of
+            the whole photo (hex) under photoHash
+        """
+        timer.skip()
+        timer.observe("image_bytes", len(image_bytes))
+        try:
+            image, scale = self._decode_image_bytes(image_bytes, expected_coordinates)
+        except Exception as e:
+            return self._error_result(e, timer)
+        timer.lap("image_decode")
+        timer.observe("image_pixels", image.shape[0] * image.shape[1])
+        photo_hash = perceptual_hash(image)
+        timer.lap("photo_hash")
+        result = self._analyze_image(image, self._scale_coordinates(expected_coordinates, scale),
+                                     product_id, backend, timer)
+        result["photoHash"] = f"{photo_hash:016x}"
+        return result
+
+    def analyze_frame_bytes(self,
+                            image_bytes: bytes,
+                            expected_coordinates: Dict[str, float],
+                            product_id: Optional[str] = None,
+                            backend: Optional[str] = None,
+                            previous: Optional[np.ndarray] = None,
+                            timer: StageTimer = NULL_TIMER) -> Dict:
+        """
+        Analyze one frame of a burst scan, skipping frames not worth the feature work.
+        
+        After decoding, the label crop is checked first: a frame whose label
+        sharpness is below min_sharpness is skipped as blurry, and one whose
+        label thumbnail is within min_frame_difference of previous as a
+        duplicate. Only the remaining frames go through analyze_label_bytes'
+        analysis.
+        
+        Args:
+            image_bytes: Encoded frame
+            expected_coordinates: Label coordinates, in pixels or normalized
+            product_id: Product whose enrolled reference label, if any, is matched against
+            backend: Feature backend name (default: the analyzer's default backend)
+            previous: Label thumbnail of the last analyzed frame of the scan
+            timer: Records the time of each stage and the image and keypoint counts
             
-            # Match features
-            matches = self.flann.knnMatch(descriptors, surr_descriptors, k=2)
+        Returns:
+            Skipped frames: skipped (blurry or duplicate) and sharpness.
+            Analyzed frames: the analyze_label_bytes result plus sharpness
+            and the label thumbnail to pass as previous with the next frame.
+        """
+        timer.skip()
+        try:
+            image, scale = self._decode_image_bytes(image_bytes, expected_coordinates)
+            timer.lap("image_decode")
+            coordinates = self._pixel_coordinates(self._scale_coordinates(expected_coordinates, scale), image.shape)
+            label = self._extract_label_region(image, coordinates)
+            sharpness = frame_sharpness(label)
+            thumbnail = frame_thumbnail(label)
+        except Exception as e:
+            return self._error_result(e, timer)
+        
+        skipped = None
+        if sharpness < self.min_sharpness:
+            skipped = "blurry"
+        elif previous is not None and frame_difference(thumbnail, previous) < self.min_frame_difference:
+            skipped = "duplicate"
+        timer.lap("frame_check")
+        if skipped:
+            return {"labelMatch": False, "score": 0.0, "confidence": 0.0, "skipped": skipped, "sharpness": sharpness}
+        
+        photo_hash = perceptual_hash(image)
+        timer.lap("photo_hash")
+        result = self._analyze_image(image, coordinates, product_id, backend, timer)
+        result.update(photoHash=f"{photo_hash:016x}", sharpness=sharpness, thumbnail=thumbnail)
+        return result
+
+    def enroll_reference(self,
+                         product_id: str,
+                         image: Union[str, bytes],
+                         label_coordinates: Dict[str, float],
+                         backend: Optional[str] = None) -> Dict:
+        """
+        Extract and store the reference label features of a product.
+        
+        References are stored per backend; a scan is only matched against
+        the reference enrolled with the backend it runs on.
+        
+        Args:
+            product_id: Product identifier
+            image: Base64 encoded image or raw encoded image bytes of the genuine product
+            label_coordinates: Dict with x, y, width, height of the label, in pixels or normalized
+            backend: Feature backend name (default: the analyzer's default backend)
             
-            # Apply ratio test
-            good_matches = []
-            for m, n in matches:
-                if m.distance < 0.7 * n.distance:
-                    good_matches.append(m)
+        Returns:
+            Dict with the product id and the number of stored features
+        """
+        if self.reference_store is None:
+            raise RuntimeError("Reference store is not configured (set REFERENCE_STORE_PATH)")
+
+        feature_backend = self.backend(backend)
+        image_bytes = image if isinstance(image, (bytes, bytearray)) else self._base64_to_bytes(image)
+        decoded, scale = self._decode_image_bytes(image_bytes, label_coordinates)
+        label_region = self._extract_label_region(
+            *self._preprocess_window(decoded, self._scale_coordinates(label_coordinates, scale))
+        )
+
+        keypoints, descriptors = feature_backend.detect_and_compute(label_region)
+        if descriptors is None or len(keypoints) < 10:
+            raise ValueError("Insufficient features detected")
+
+        # Keep the strongest keypoints so every entry stays small
+        order = np.argsort([-kp.response for kp in keypoints], kind="stable")[:self.max_reference_features]
+        points = np.array([keypoints[i].pt for i in order], dtype=np.float32) / scale
+        self.reference_store.put(feature_backend.reference_key(product_id), points, descriptors[order])
+
+        return {
+            "productId": product_id,
+            "features": int(len(order)),
+            "backend": feature_backend.name
+        }
+
+    def _get_reference(self,
+                       product_id: Optional[str],
+                       backend: FeatureBackend) -> Optional[ReferenceFeatures]:
+        """Enrolled reference features for a product, if any."""
+        if self.reference_store is None or not product_id:
+            return None
+        reference = self.reference_store.get(backend.reference_key(product_id))
+        if reference is None or len(reference) < 2:
+            return None
+        return reference
+
+    def _match_reference(self,
+                         keypoints: Tuple,
+                         descriptors: np.ndarray,
+                         reference: ReferenceFeatures,
+                         backend: FeatureBackend) -> Dict[str, float]:
+        """Score label features against the enrolled reference label."""
+        good_matches = backend.match(descriptors, reference.descriptors)
+        
+        # Normalise by the smaller feature set so a full match scores 1.0
+        raw_score = len(good_matches) / min(len(keypoints), len(reference))
+        match_score = backend.calibrate(raw_score, backend.reference_threshold, self.reference_threshold)
+        confidence = min(1.0, min(len(keypoints), len(reference)) / 100)
+        
+        return {
+            "labelMatch": match_score > self.reference_threshold,
+            "score": float(match_score),
+            "confidence": float(confidence),
+            "reference": True,
+            "backend": backend.name
+        }
+
+    def _match_surroundings(self,
+                            keypoints: Tuple,
+                            descriptors: np.ndarray,
+                            surr_descriptors: np.ndarray,
+                            backend: FeatureBackend) -> Dict[str, float]:
+        """Score label features against the features of the window around the label."""
+        # Match features, applying the backend's ratio test
+        good_matches = backend.match(descriptors, surr_descriptors)
+        
+        raw_score = len(good_matches) / len(keypoints) if keypoints else 0
+        return self._surroundings_result(raw_score, keypoints, backend)
+
+    def _score_single_pass(self,
+                           keypoints: Tuple,
+                           shape: Tuple[int, ...],
+                           coordinates: Dict[str, float],
+                           backend: FeatureBackend) -> Dict[str, float]:
+        """
+        Estimate the surroundings score from one detection over the window.
+        
+        Two passes score the share of label-crop features the window
+        detection finds again. Features clear of the label box edges see the
+        same pixels in the crop as in the window, so the crop finds them with
+        the same descriptors; features within LABEL_EDGE_MARGIN keypoint sizes
+        of an edge are described from pixels the crop lacks and mostly fail
+        the ratio test. The share of label keypoints clear of the edges
+        estimates the two-pass score without matching the label against a
+        set that holds its own features.
+        """
+        x0, y0, x1, y1 = self._label_box(shape, coordinates)
+        clear = sum(
+            min(kp.pt[0] - x0, x1 - kp.pt[0], kp.pt[1] - y0, y1 - kp.pt[1]) >= LABEL_EDGE_MARGIN * kp.size
+            for kp in keypoints
+        )
+        raw_score = clear / len(keypoints) if keypoints else 0
+        return self._surroundings_result(raw_score, keypoints, backend)
+
+    def _surroundings_result(self,
+                             raw_score: float,
+                             keypoints: Tuple,
+                             backend: FeatureBackend) -> Dict[str, float]:
+        """Calibrate a raw surroundings score into an analysis result."""
+        match_score = backend.calibrate(raw_score, backend.label_threshold, LABEL_MATCH_THRESHOLD)
+        
+        # Calculate confidence based on number of features
+        confidence = min(1.0, len(keypoints) / 100)
+        
+        return {
+            "labelMatch": match_score > LABEL_MATCH_THRESHOLD,
+            "score": float(match_score),
+            "confidence": float(confidence),
+            "backend": backend.name
+        }
+
+    def _coarse_stage(self,
+                      image: np.ndarray,
+                      coordinates: Dict[str, float],
+                      backend: FeatureBackend,
+                      timer: StageTimer = NULL_TIMER) -> Optional[Dict[str, float]]:
+        """
+        Match the label against its surroundings in a downscaled copy of the window.
+        
+        The window is shrunk until the label's shorter side is coarse_side
+        pixels, so the cost no longer grows with the label size. Only a clear
+        match is trusted: at least coarse_min_keypoints label keypoints and a
+        score of at least coarse_accept. Anything else, including too few
+        keypoints, is left to the full stage; fine texture lost to the
+        downscale makes a weak coarse result no evidence against the label.
+        
+        Returns:
+            The result when the coarse match is clear, None when the full
+            stage has to decide
+        """
+        coordinates = self._pixel_coordinates(coordinates, image.shape)
+        factor = min(coordinates["width"], coordinates["height"]) / self.coarse_side
+        if factor <= 1:
+            # Labels this small cost about the same at full resolution
+            return None
+        
+        top, bottom, left, right = self._surrounding_bounds(image.shape, coordinates)
+        size = (max(1, round((right - left) / factor)), max(1, round((bottom - top) / factor)))
+        window = self._preprocess_image(
+            cv2.resize(image[top:bottom, left:right], size, interpolation=cv2.INTER_AREA)
+        )
+        coordinates = {
+            "x": (coordinates["x"] - left) / factor,
+            "y": (coordinates["y"] - top) / factor,
+            "width": coordinates["width"] / factor,
+            "height": coordinates["height"] / factor
+        }
+        timer.lap("coarse_preprocess")
+        
+        coarse_backend = self.coarse_backend(backend.name)
+        if coarse_backend.single_pass:
+            keypoints, _ = self._detect_single_pass(window, coordinates, coarse_backend)
+            timer.lap("coarse_detect")
+            if len(keypoints) < self.coarse_min_keypoints:
+                return None
+            result = self._score_single_pass(keypoints, window.shape, coordinates, backend)
+        else:
+            label_region = self._extract_label_region(window, coordinates)
+            keypoints, descriptors = coarse_backend.detect_and_compute(label_region)
+            _, surr_descriptors = coarse_backend.detect_and_compute(window)
+            timer.lap("coarse_detect")
+            if len(keypoints) < self.coarse_min_keypoints or surr_descriptors is None:
+                return None
+            result = self._match_surroundings(keypoints, descriptors, surr_descriptors, backend)
+        timer.lap("coarse_match")
+        return result if result["score"] >= self.coarse_accept else None
+
+    def _error_result(self, error: Exception, timer: StageTimer = NULL_TIMER) -> Dict[str, float]:
+        """Build the result returned when analysis fails."""
+        timer.fail(type(error).__name__)
+        return {
+            "labelMatch": False,
+            "score": 0.0,
+            "confidence": 0.0,
+            "error": str(error),
+            "errorType": type(error).__name__
+        }
+
+    def _analyze_image(self,
+                       image: np.ndarray,
+                       expected_coordinates: Dict[str, float],
+                       product_id: Optional[str] = None,
+                       backend: Optional[str] = None,
+                       timer: StageTimer = NULL_TIMER) -> Dict[str, float]:
+        """
+        Run preprocessing, feature detection and matching on a decoded image.
+        
+        With the cascade on, scans without an enrolled reference run a coarse
+        stage first, and the full stage only when the coarse match is not
+        clear. The result's stage says which of the two decided it.
+        """
+        try:
+            feature_backend = self.backend(backend)
             
-            # Calculate score
-            match_score = len(good_matches) / len(keypoints) if keypoints else 0
+            # Only the label is needed when a reference label is enrolled
+            reference = self._get_reference(product_id, feature_backend)
+            timer.lap("reference_lookup")
             
-            # Calculate confidence based on number of features
-            confidence = min(1.0, len(keypoints) / 100)
+            # Reference matching already detects on the label alone, against
+            # full-resolution reference features a downscaled label matches poorly
+            if self.cascade and reference is None:
+                result = self._coarse_stage(image, expected_coordinates, feature_backend, timer)
+                stage = "full" if result is None else "coarse"
+                timer.count("cascade_stage", stage)
+                if result is not None:
+                    return {**result, "stage": stage}
             
-            return {
-                "labelMatch": match_score > 0.5,
-                "score": float(match_score),
-                "confidence": float(confidence)
-            }
+            return {**self._full_stage(image, expected_coordinates, reference, feature_backend, timer),
+                    "stage": "full"}
             
         except Exception as e:
+            return self._error_result(e, timer)
+
+    def _full_stage(self,
+                    image: np.ndarray,
+                    expected_coordinates: Dict[str, float],
+                    reference: Optional[ReferenceFeatures],
+                    feature_backend: FeatureBackend,
+                    timer: StageTimer = NULL_TIMER) -> Dict[str, float]:
+        """Full-resolution feature detection and matching over the label window."""
+        # Preprocess the label window only; coordinates are window pixels from here on
+        processed_image, expected_coordinates = self._preprocess_window(image, expected_coordinates)
+        single_pass = self.single_pass and reference is None and feature_backend.single_pass
+        timer.lap("clahe")
+        
+        if single_pass:
+            keypoints, window_keypoints = self._detect_single_pass(
+                processed_image, expected_coordinates, feature_backend
+            )
+            timer.lap("detect_window")
+            timer.observe("surrounding_keypoints", len(window_keypoints))
+        else:
+            # Extract label region
+            label_region = self._extract_label_region(processed_image, expected_coordinates)
+            
+            # Detect features in label region
+            keypoints, descriptors = feature_backend.detect_and_compute(label_region)
+            timer.lap("detect_label")
+        timer.observe("label_keypoints", len(keypoints))
+        
+        if len(keypoints) < 10:
+            timer.fail("InsufficientFeatures")
             return {
                 "labelMatch": False,
                 "score": 0.0,
-                "confidence": 0.0,
-                "error": str(e)
-            }
\ No newline at end of file
+                "confidence": 1.0,
+                "error": "Insufficient features detected"
+            }
+        
+        # Verification is one match when a reference label is enrolled
+        if reference is not None:
+            result = self._match_reference(keypoints, descriptors, reference, feature_backend)
+            timer.lap("match")
+            return result
+        
+        if single_pass:
+            result = self._score_single_pass(keypoints, processed_image.shape, expected_coordinates, feature_backend)
+            timer.lap("match")
+            return result
+        
+        # Compare with surrounding region
+        top, bottom, left, right = self._surrounding_bounds(processed_image.shape, expected_coordinates)
+        surrounding_region = processed_image[top:bottom, left:right]
+        
+        # Detect features in surrounding region
+        surr_keypoints, surr_descriptors = feature_backend.detect_and_compute(surrounding_region)
+        timer.lap("detect_surrounding")
+        timer.observe("surrounding_keypoints", len(surr_keypoints))
+        
+        if surr_descriptors is None:
+            return {
+                "labelMatch": True,
+                "score": 0.8,  # High score since no competing features found
+                "confidence": 0.7,
+                "backend": feature_backend.name
+            }
+        
+        result = self._match_surroundings(keypoints, descriptors, surr_descriptors, feature_backend)
+        timer.lap("match")
+        return result
\ No newline at end of file
@@ -0,0 +1,195 @@
+import asyncio
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+# Collection the backend's Product model is stored in
+PRODUCT_COLLECTION = "products"
+COORDINATE_KEYS = ("x", "y", "width", "height")
+
+
+def parse_coordinates(value: Any) -> Optional[Dict[str, float]]:
+    """Label coordinates from a product document, or None if any field is missing."""
+    try:
+        coordinates = {key: float(value[key]) for key in COORDINATE_KEYS}
+    except (KeyError, TypeError, ValueError):
+        return None
+    if coordinates["width"] <= 0 or coordinates["height"] <= 0:
+        return None
+    return coordinates
+
+
+class LabelCoordinateStore:
+    """
+    Expected label coordinates of products, read from the backend's MongoDB.
+
+    Lookups are answered from an in-process LRU cache with a TTL. Products
+    without usable coordinates are cached too, for a shorter negative TTL,
+    as are failed queries, so an unknown product or an unreachable database
+    costs one round trip per TTL rather than one per request. Both look up
+    as None; failed() tells a failed query from a product without coordinates. Concurrent
+    misses for the same product share one query, and get_many fetches all
+    misses of a batch in one query.
+
+    Queries run on pymongo's pooled client in a worker thread, off the event
+    loop. Like MetricsRegistry, not thread-safe; use from the event loop.
+    """
+
+    def __init__(self,
+                 collection: Any = None,
+                 max_entries: Optional[int] = None,
+                 ttl: Optional[float] = None,
+                 negative_ttl: Optional[float] = None):
+        """
+        Args:
+            collection: Products collection, or any object with pymongo's
+                find(filter, projection) (default: the products collection of
+                MONGODB_URI; lookups find nothing when it is unset)
+            max_entries: Products kept before the least recently used is evicted
+                (default: LABEL_COORDINATES_CACHE_SIZE or 100000)
+            ttl: Seconds found coordinates stay cached (default:
+                LABEL_COORDINATES_TTL_SECONDS or 300)
+            negative_ttl: Seconds a product without coordinates, or a failed
+                query, stays cached (default: LABEL_COORDINATES_NEGATIVE_TTL_SECONDS or 30)
+        """
+        self.client = None
+        if collection is None and os.getenv("MONGODB_URI"):
+            # Imported here, so the service only loads pymongo when it has a database
+            from pymongo import MongoClient
+
+            # Connects lazily; the pool is shared by every lookup thread
+            self.client = MongoClient(
+                os.getenv("MONGODB_URI"),
+                maxPoolSize=int(os.getenv("MONGODB_POOL_SIZE", 10)),
+                serverSelectionTimeoutMS=int(os.getenv("MONGODB_TIMEOUT_MS", 2000))
+            )
+            collection = self.client.get_default_database("truetag")[PRODUCT_COLLECTION]
+        self.collection = collection
+
+        self.max_entries = max_entries or int(os.getenv("LABEL_COORDINATES_CACHE_SIZE", 100000))
+        self.ttl = ttl or float(os.getenv("LABEL_COORDINATES_TTL_SECONDS", 300))
+        self.negative_ttl = negative_ttl or float(os.getenv("LABEL_COORDINATES_NEGATIVE_TTL_SECONDS", 30))
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.queries = 0
+        self.errors = 0
+
+        # product id -> (expiry time, coordinates or None, whether the query failed)
+        self._entries: "OrderedDict[str, Tuple[float, Optional[Dict[str, float]], bool]]" = OrderedDict()
+        # product id -> query in flight for it
+        self._pending: Dict[str, asyncio.Task] = {}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def enabled(self) -> bool:
+        return self.collection is not None
+
+    def _cached(self, product_id: str) -> Tuple[bool, Optional[Dict[str, float]]]:
+        """(found, coordinates) from the cache, dropping an expired entry."""
+        entry = self._entries.get(product_id)
+        if entry is None:
+            return False, None
+        if entry[0] < time.monotonic():
+            del self._entries[product_id]
+            return False, None
+        self._entries.move_to_end(product_id)
+        return True, entry[1]
+
+    def _put(self, product_id: str, coordinates: Optional[Dict[str, float]], failed: bool = False):
+        ttl = self.ttl if coordinates is not None else self.negative_ttl
+        self._entries[product_id] = (time.monotonic() + ttl, coordinates, failed)
+        self._entries.move_to_end(product_id)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _query(self, product_ids: List[str]) -> Dict[str, Optional[Dict[str, float]]]:
+        """Fetch the coordinates of these products in one query. Blocking."""
+        from bson import ObjectId
+
+        # The backend keys products by ObjectId and sends its hex string
+        keys = {pid: ObjectId(pid) if ObjectId.is_valid(pid) else pid for pid in product_ids}
+        ids = {str(key): pid for pid, key in keys.items()}
+        documents = self.collection.find({"_id": {"$in": list(keys.values())}}, {"labelCoordinates": 1})
+        return {
+            ids[str(document["_id"])]: parse_coordinates(document.get("labelCoordinates"))
+            for document in documents if str(document["_id"]) in ids
+        }
+
+    async def _load(self, product_ids: List[str]) -> Dict[str, Optional[Dict[str, float]]]:
+        """Query the products off the event loop and cache the results, found or not."""
+        self.queries += 1
+        failed = False
+        try:
+            found = await asyncio.to_thread(self._query, product_ids)
+        except Exception:
+            self.errors += 1
+            found, failed = {}, True
+        finally:
+            for pid in product_ids:
+                self._pending.pop(pid, None)
+        for pid in product_ids:
+            self._put(pid, found.get(pid), failed)
+        return found
+
+    async def get(self, product_id: str) -> Optional[Dict[str, float]]:
+        """Label coordinates of a product in pixels or normalized, or None if it has none."""
+        return (await self.get_many([product_id]))[product_id]
+
+    async def get_many(self, product_ids: Iterable[str]) -> Dict[str, Optional[Dict[str, float]]]:
+        """Label coordinates of several products, with one query for all cache misses."""
+        result: Dict[str, Optional[Dict[str, float]]] = {}
+        missing = []
+        for pid in dict.fromkeys(product_ids):
+            found, coordinates = self._cached(pid)
+            if found:
+                if coordinates is None:
+                    self.negative_hits += 1
+                else:
+                    self.hits += 1
+                result[pid] = coordinates
+            elif not self.enabled:
+                result[pid] = None
+            else:
+                self.misses += 1
+                missing.append(pid)
+
+        if missing:
+            fetch = [pid for pid in missing if pid not in self._pending]
+            if fetch:
+                task = asyncio.ensure_future(self._load(fetch))
+                self._pending.update(dict.fromkeys(fetch, task))
+            # Shielded, so a cancelled request leaves the shared query running
+            for pid, task in {pid: self._pending[pid] for pid in missing}.items():
+                result[pid] = (await asyncio.shield(task)).get(pid)
+        return result
+
+    def failed(self, product_id: str) -> bool:
+        """Whether the product's last lookup, still cached, failed rather than found nothing."""
+        entry = self._entries.get(product_id)
+        return entry is not None and entry[2]
+
+    def invalidate(self, product_id: str):
+        """Drop a product's cached coordinates, e.g. after its label was moved."""
+        self._entries.pop(product_id, None)
+
+    def close(self):
+        if self.client is not None:
+            self.client.close()
+
+    def stats(self) -> Dict:
+        return {
+            "enabled": self.enabled,
+            "entries": len(self),
+            "maxEntries": self.max_entries,
+            "ttlSeconds": self.ttl,
+            "negativeTtlSeconds": self.negative_ttl,
+            "hits": self.hits,
+            "negativeHits": self.negative_hits,
+            "misses": self.misses,
+            "queries": self.queries,
+            "errors": self.errors
+        }
@@ -0,0 +1,253 @@
+import bisect
+import math
+import time
+from contextvars import ContextVar
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+# Latency buckets in seconds, from sub-millisecond cache hits to slow vision jobs
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Buckets for sizes observed by StageTimer.observe, keyed by observation name
+VALUE_BUCKETS = {
+    "image_bytes": (65536, 262144, 1048576, 2097152, 4194304, 8388608, 16777216),
+    "image_pixels": (250000, 1000000, 2000000, 4000000, 8000000, 16000000, 50000000),
+    "label_keypoints": (10, 25, 50, 100, 250, 500, 1000, 2500),
+    "surrounding_keypoints": (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000),
+}
+# Help text of the outcomes counted by StageTimer.count, keyed by outcome name
+OUTCOME_HELP = {
+    "cascade_stage": "Label analyses by the cascade stage that decided them",
+    "scan_frame": "Burst scan frames by outcome: analyzed, blurry, duplicate or unusable",
+}
+
+
+class Histogram:
+    """
+    Cumulative histogram with fixed bucket upper bounds, as in Prometheus.
+
+    Not thread-safe; observe from one thread (the event loop).
+    """
+
+    def __init__(self, buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def snapshot(self) -> Dict:
+        """Cumulative counts per upper bound, plus total sum and count."""
+        cumulative = 0
+        buckets = {}
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            buckets[f"{bound:g}"] = cumulative
+        buckets["+Inf"] = self.count
+        return {
+            "buckets": buckets,
+            "sum": self.sum,
+            "count": self.count
+        }
+
+
+class StageTimer:
+    """
+    Wall time per stage of one request, plus sizes seen and outcomes counted
+    along the way.
+
+    Stages are timed as laps: lap(stage) charges the time since the previous
+    lap (or since the timer was created) to stage. Plain dicts only, so a
+    timer's state can be shipped back from a worker process.
+    """
+
+    enabled = True
+
+    def __init__(self):
+        self.stages: Dict[str, float] = {}
+        self.values: Dict[str, float] = {}
+        self.outcomes: Dict[str, Dict[str, int]] = {}
+        self.error: Optional[str] = None
+        self._last = time.perf_counter()
+
+    def lap(self, stage: str):
+        now = time.perf_counter()
+        self.stages[stage] = self.stages.get(stage, 0.0) + now - self._last
+        self._last = now
+
+    def add(self, stage: str, seconds: float):
+        """Charge time measured elsewhere to stage."""
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def skip(self):
+        """Start the next lap now, charging the time since the last one to no stage."""
+        self._last = time.perf_counter()
+
+    def observe(self, name: str, value: float):
+        self.values[name] = value
+
+    def count(self, name: str, outcome: str):
+        """Count one outcome under name, e.g. the cascade stage that decided an analysis."""
+        outcomes = self.outcomes.setdefault(name, {})
+        outcomes[outcome] = outcomes.get(outcome, 0) + 1
+
+    def fail(self, error: str):
+        self.error = error
+
+    def state(self) -> Dict:
+        return {"stages": self.stages, "values": self.values, "outcomes": self.outcomes, "error": self.error}
+
+    def merge(self, state: Dict):
+        """Add the stages, sizes, outcomes and error of another timer's state()."""
+        for stage, seconds in state.get("stages", {}).items():
+            self.add(stage, seconds)
+        self.values.update(state.get("values", {}))
+        for name, outcomes in state.get("outcomes", {}).items():
+            counts = self.outcomes.setdefault(name, {})
+            for outcome, n in outcomes.items():
+                counts[outcome] = counts.get(outcome, 0) + n
+        self.error = state.get("error") or self.error
+
+    def server_timing(self) -> str:
+        """Stages as a Server-Timing header value, in milliseconds."""
+        return ", ".join(f"{stage};dur={seconds * 1000:.3f}" for stage, seconds in self.stages.items())
+
+
+class _NullTimer(StageTimer):
+    """Timer that records nothing; used when instrumentation is off."""
+
+    enabled = False
+
+    def __init__(self):
+        pass
+
+    def lap(self, stage: str):
+        pass
+
+    def add(self, stage: str, seconds: float):
+        pass
+
+    def skip(self):
+        pass
+
+    def observe(self, name: str, value: float):
+        pass
+
+    def count(self, name: str, outcome: str):
+        pass
+
+    def fail(self, error: str):
+        pass
+
+    def merge(self, state: Dict):
+        pass
+
+
+NULL_TIMER = _NullTimer()
+
+# Timer of the HTTP request being handled, set by the metrics middleware
+current_timer: ContextVar[StageTimer] = ContextVar("current_timer", default=NULL_TIMER)
+
+
+def _format_labels(labels: Tuple[Tuple[str, str], ...], extra: str = "") -> str:
+    parts = [f'{key}="{value}"' for key, value in labels]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _format_value(value: float) -> str:
+    """Sample value at full precision: whole numbers exactly, others round-tripping."""
+    value = float(value)
+    if math.isnan(value):
+        return "NaN"
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    if value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class MetricsRegistry:
+    """
+    Named histograms and counters, rendered in the Prometheus text format.
+
+    Like Histogram, not thread-safe; record from the event loop.
+    """
+
+    def __init__(self, prefix: str = "truetag"):
+        self.prefix = prefix
+        self._histograms: Dict[str, Dict[Tuple, Histogram]] = {}
+        self._counters: Dict[str, Dict[Tuple, float]] = {}
+        self._callbacks: List[Tuple[str, str, Callable[[], Dict[Tuple, float]]]] = []
+        self._help: Dict[str, str] = {}
+
+    def histogram(self,
+                  name: str,
+                  labels: Dict[str, str] = None,
+                  buckets: Sequence[float] = LATENCY_BUCKETS,
+                  help: str = "") -> Histogram:
+        """Histogram with these labels, created on first use."""
+        series = self._histograms.setdefault(name, {})
+        key = tuple(sorted((labels or {}).items()))
+        if key not in series:
+            series[key] = Histogram(buckets)
+        if help:
+            self._help.setdefault(name, help)
+        return series[key]
+
+    def register_histogram(self, name: str, histogram: Histogram, labels: Dict[str, str] = None, help: str = ""):
+        """Export a histogram owned by another component."""
+        self._histograms.setdefault(name, {})[tuple(sorted((labels or {}).items()))] = histogram
+        if help:
+            self._help.setdefault(name, help)
+
+    def inc(self, name: str, labels: Dict[str, str] = None, value: float = 1.0, help: str = ""):
+        series = self._counters.setdefault(name, {})
+        key = tuple(sorted((labels or {}).items()))
+        series[key] = series.get(key, 0.0) + value
+        if help:
+            self._help.setdefault(name, help)
+
+    def register_callback(self, name: str, kind: str, collect: Callable[[], Dict[Tuple, float]], help: str = ""):
+        """
+        Export values read at render time.
+
+        Args:
+            name: Metric name, without the prefix
+            kind: Prometheus type, counter or gauge
+            collect: Returns {label tuples: value}; () for an unlabelled value
+        """
+        self._callbacks.append((name, kind, collect))
+        if help:
+            self._help[name] = help
+
+    def _header(self, lines: List[str], name: str, kind: str):
+        full_name = f"{self.prefix}_{name}"
+        if name in self._help:
+            lines.append(f"# HELP {full_name} {self._help[name]}")
+        lines.append(f"# TYPE {full_name} {kind}")
+        return full_name
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for name, series in self._histograms.items():
+            full_name = self._header(lines, name, "histogram")
+            for labels, histogram in series.items():
+                snapshot = histogram.snapshot()
+                for bound, count in snapshot["buckets"].items():
+                    bucket_labels = _format_labels(labels, f'le="{bound}"')
+                    lines.append(f"{full_name}_bucket{bucket_labels} {count}")
+                lines.append(f"{full_name}_sum{_format_labels(labels)} {_format_value(snapshot['sum'])}")
+                lines.append(f"{full_name}_count{_format_labels(labels)} {snapshot['count']}")
+        for name, series in self._counters.items():
+            full_name = self._header(lines, name, "counter")
+            for labels, value in series.items():
+                lines.append(f"{full_name}{_format_labels(labels)} {_format_value(value)}")
+        for name, kind, collect in self._callbacks:
+            full_name = self._header(lines, name, kind)
+            for labels, value in collect().items():
+                lines.append(f"{full_name}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,218 @@
+import asyncio
+import logging
+import os
+import time
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from trust_scorer import TrustScorer
+
+logger = logging.getLogger(__name__)
+
+# Canary returns: every combination of these, returned at CANARY_RETURN_TIME
+CANARY_RETURN_TIME = datetime(2024, 1, 1)
+CANARY_HOURS = (0.5, 2, 12, 48, 168, 336, 720, 2000)
+CANARY_ATTEMPTS = (0, 1, 3)
+CANARY_LABEL_SCORES = (0.2, 0.6, 1.0)
+
+
+class ModelValidationError(Exception):
+    """A candidate model failed the canary batch."""
+
+
+def canary_batch() -> Tuple[List, List, List, List]:
+    """Fixed trust scoring batch, as calculate_trust_scores columns."""
+    rows = [
+        (CANARY_RETURN_TIME - timedelta(hours=hours), CANARY_RETURN_TIME, attempts, label_score)
+        for hours in CANARY_HOURS
+        for attempts in CANARY_ATTEMPTS
+        for label_score in CANARY_LABEL_SCORES
+    ]
+    return tuple(list(column) for column in zip(*rows))
+
+
+def validate_scorer(candidate: TrustScorer,
+                    current: Optional[TrustScorer] = None,
+                    max_score_shift: float = 0.5) -> Dict:
+    """
+    Score the canary batch with a candidate model.
+
+    Args:
+        candidate: Scorer holding the new model
+        current: Scorer serving now, to compare against
+        max_score_shift: Largest accepted mean absolute change of the trust
+            score against current
+
+    Returns:
+        Canary size and mean score shift
+
+    Raises:
+        ModelValidationError: If the model is unfitted, fails to score, gives
+            scores outside [0, 1] or moves them more than max_score_shift
+    """
+    if not candidate.fitted:
+        raise ModelValidationError("Model is not fitted")
+
+    batch = canary_batch()
+    try:
+        results = candidate.calculate_trust_scores(*batch)
+    except Exception as e:
+        raise ModelValidationError(f"Canary batch failed: {e}")
+    errors = [result["error"] for result in results if "error" in result]
+    if errors:
+        raise ModelValidationError(f"Canary batch failed: {errors[0]}")
+
+    scores = np.array([result["trustScore"] for result in results])
+    if not np.all(np.isfinite(scores)) or scores.min() < 0 or scores.max() > 1:
+        raise ModelValidationError("Canary trust scores outside [0, 1]")
+
+    shift = None
+    if current is not None and current.fitted:
+        current_results = current.calculate_trust_scores(*batch)
+        if not any("error" in result for result in current_results):
+            shift = float(np.mean(np.abs(scores - [result["trustScore"] for result in current_results])))
+            if shift > max_score_shift:
+                raise ModelValidationError(
+                    f"Canary trust scores moved by {shift:.3f} on average (limit {max_score_shift})"
+                )
+
+    return {"canarySize": len(results), "canaryScoreShift": shift}
+
+
+class TrustModelReloader:
+    """
+    Replaces the serving trust model without a restart.
+
+    The candidate is loaded and validated in a worker thread while requests
+    keep being served by the current scorer, then installed with a single
+    reference swap: requests already running finish on the old scorer and
+    later ones use the new one. Nothing blocks or is dropped.
+
+    Every worker process reloads on its own; with a watcher running in each,
+    replacing the model file (save_model does so atomically) updates them all.
+    """
+
+    def __init__(self,
+                 model_path: Optional[str],
+                 load: Callable[[str], TrustScorer],
+                 install: Callable[[TrustScorer], None],
+                 current: Callable[[], TrustScorer],
+                 poll_interval: Optional[float] = None,
+                 max_score_shift: Optional[float] = None):
+        """
+        Args:
+            model_path: Model file to reload from
+            load: Builds a scorer from a model file
+            install: Makes a scorer serve all following requests
+            current: Returns the scorer serving now
+            poll_interval: Seconds between checks of the model file
+                (default: TRUST_MODEL_POLL_SECONDS or 10; 0 disables the watcher)
+            max_score_shift: Largest accepted mean canary score change
+                (default: TRUST_RELOAD_MAX_SCORE_SHIFT or 0.5)
+        """
+        if poll_interval is None:
+            poll_interval = float(os.getenv("TRUST_MODEL_POLL_SECONDS", 10))
+        if max_score_shift is None:
+            max_score_shift = float(os.getenv("TRUST_RELOAD_MAX_SCORE_SHIFT", 0.5))
+
+        self.model_path = model_path
+        self.load = load
+        self.install = install
+        self.current = current
+        self.poll_interval = poll_interval
+        self.max_score_shift = max_score_shift
+
+        self.version = 1
+        self.reloads = 0
+        self.failures = 0
+        self.last_reload: Optional[Dict] = None
+        self.last_error: Optional[str] = None
+        self._file_state = self._stat()
+        self._lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+    def _stat(self) -> Optional[Tuple[int, int, int]]:
+        try:
+            stat = os.stat(self.model_path)
+        except (OSError, TypeError):
+            return None
+        return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+    async def reload(self) -> Dict:
+        """
+        Load, validate and install the model at model_path.
+
+        Raises:
+            FileNotFoundError: If there is no model file
+            ModelValidationError: If the candidate fails validation; the
+                current model keeps serving
+        """
+        async with self._lock:
+            if not self.model_path or not os.path.exists(self.model_path):
+                raise FileNotFoundError(f"No trust model at {self.model_path}")
+            file_state = self._stat()
+            start = time.perf_counter()
+            try:
+                candidate = await asyncio.to_thread(self.load, self.model_path)
+                loaded = time.perf_counter()
+                report = await asyncio.to_thread(
+                    validate_scorer, candidate, self.current(), self.max_score_shift
+                )
+            except Exception as e:
+                self.failures += 1
+                self.last_error = str(e)
+                # Do not retry the same file on every poll
+                self._file_state = file_state
+                if isinstance(e, ModelValidationError):
+                    raise
+                raise ModelValidationError(f"Could not load model: {e}")
+
+            self.install(candidate)
+            self._file_state = file_state
+            self.version += 1
+            self.reloads += 1
+            self.last_error = None
+            self.last_reload = {
+                "version": self.version,
+                "loadSeconds": loaded - start,
+                "validateSeconds": time.perf_counter() - loaded,
+                "totalSeconds": time.perf_counter() - start,
+                **report,
+                "completedAt": datetime.now().isoformat()
+            }
+            return self.last_reload
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            state = self._stat()
+            if state is None or state == self._file_state:
+                continue
+            try:
+                result = await self.reload()
+                logger.info("Reloaded trust model %s in %.3fs", self.model_path, result["totalSeconds"])
+            except Exception as e:
+                logger.warning("Trust model reload from %s rejected: %s", self.model_path, e)
+
+    def start(self):
+        """Start watching model_path, if there is one and polling is enabled."""
+        if self.model_path and self.poll_interval > 0 and self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._watch())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def stats(self) -> Dict:
+        return {
+            "modelPath": self.model_path,
+            "version": self.version,
+            "reloads": self.reloads,
+            "failures": self.failures,
+            "lastReload": self.last_reload,
+            "lastError": self.last_error,
+            "pollSeconds": self.poll_interval
+        }
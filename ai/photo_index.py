@@ -0,0 +1,374 @@
+import os
+import threading
+import time
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from feature_store import entity_key
+
+# Perceptual hashes are split into CHUNKS substrings of CHUNK_BITS bits for indexing
+HASH_BITS = 64
+CHUNKS = 4
+CHUNK_BITS = HASH_BITS // CHUNKS
+CHUNK_MASK = (1 << CHUNK_BITS) - 1
+
+# Images are reduced by a whole factor to at least this short side before hashing
+HASH_MIN_SIDE = 128
+
+# Merge the unsorted tail into the bucket tables once it holds this many entries
+DEFAULT_TAIL_SIZE = 16384
+
+# Per-entry columns, as stored in snapshots
+COLUMNS = ("hashes", "users", "products", "times")
+
+# Masks of the SWAR popcount in hamming_distances
+_M1 = np.uint64(0x5555555555555555)
+_M2 = np.uint64(0x3333333333333333)
+_M4 = np.uint64(0x0F0F0F0F0F0F0F0F)
+_H01 = np.uint64(0x0101010101010101)
+
+
+def perceptual_hash(gray: np.ndarray) -> int:
+    """
+    64-bit DCT hash (pHash) of a grayscale image.
+
+    The image is reduced to 32x32 and each bit says whether one of the
+    lowest 8x8 DCT frequencies is above their median, so recompression,
+    resizing and brightness or contrast changes flip only a few bits.
+    """
+    factor = min(gray.shape[:2]) // HASH_MIN_SIDE
+    if factor > 1:
+        # Integer area reductions take OpenCV's fast path; fractional ones
+        # over a large image cost tens of milliseconds
+        height, width = gray.shape[0] // factor, gray.shape[1] // factor
+        gray = cv2.resize(gray[:height * factor, :width * factor], (width, height), interpolation=cv2.INTER_AREA)
+    small = cv2.resize(gray, (32, 32), interpolation=cv2.INTER_AREA).astype(np.float32)
+    low = cv2.dct(small)[:8, :8].flatten()
+    bits = low > np.median(low[1:])
+    return int(np.packbits(bits).view(">u8")[0])
+
+
+def hamming_distances(hashes: np.ndarray, photo_hash: int) -> np.ndarray:
+    """Bits differing between each uint64 hash and photo_hash."""
+    x = hashes ^ np.uint64(photo_hash)
+    x = x - ((x >> np.uint64(1)) & _M1)
+    x = (x & _M2) + ((x >> np.uint64(2)) & _M2)
+    x = (x + (x >> np.uint64(4))) & _M4
+    return (x * _H01) >> np.uint64(56)
+
+
+def _chunk_probes(radius: int) -> np.ndarray:
+    """XOR masks of all CHUNK_BITS-bit values within radius bits of zero, nearest first."""
+    values = np.arange(1 << CHUNK_BITS, dtype=np.uint64)
+    bits = hamming_distances(values, 0)
+    return values[np.argsort(bits, kind="stable")[:int((bits <= radius).sum())]].astype(np.int64)
+
+
+def _chunks(hashes: np.ndarray, chunk: int) -> np.ndarray:
+    return ((hashes >> np.uint64(chunk * CHUNK_BITS)) & np.uint64(CHUNK_MASK)).astype(np.uint16)
+
+
+def _bucket_tables(hashes: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Entries sorted by each chunk and the bucket boundaries of each chunk.
+
+    Returns:
+        (order, bucketed, starts): order[c] lists entry indices by chunk c
+        value and bucketed[c] their hashes; the entries with value v are
+        order[c][starts[c, v]:starts[c, v + 1]]
+    """
+    order = np.empty((CHUNKS, len(hashes)), dtype=np.uint32)
+    bucketed = np.empty((CHUNKS, len(hashes)), dtype=np.uint64)
+    starts = np.zeros((CHUNKS, (1 << CHUNK_BITS) + 1), dtype=np.int64)
+    for chunk in range(CHUNKS):
+        values = _chunks(hashes, chunk)
+        # Stable sorts of 16-bit keys are radix sorts
+        order[chunk] = np.argsort(values, kind="stable")
+        np.take(hashes, order[chunk], out=bucketed[chunk])
+        np.cumsum(np.bincount(values, minlength=1 << CHUNK_BITS), out=starts[chunk, 1:])
+    return order, bucketed, starts
+
+
+class PhotoIndex:
+    """
+    Near-duplicate index of the photos submitted with returns.
+
+    Stores the 64-bit perceptual hash of each photo with the (hashed) user
+    and product of the return, so a photo reused across returns - a stock
+    image, or one picture submitted for several products - is found by
+    Hamming distance in well under a millisecond at tens of millions of
+    entries.
+
+    Lookups use multi-index hashing: hashes are split into four 16-bit
+    chunks, and two hashes within max_distance bits agree to within
+    max_distance // 4 bits on at least one chunk. Sorted entries are
+    bucketed by each chunk, so a lookup only verifies the entries in the
+    buckets near the query's chunks (68 buckets up to a distance of 7).
+    New entries go to an unsorted tail that is scanned in full and merged
+    into the buckets in a background thread once it reaches tail_size.
+    Memory is about 76 bytes per entry; beyond max_entries the oldest
+    entries are dropped at the next merge.
+
+    Thread-safe. Entries are held per process and snapshotted to one .npz
+    path, which a restart loads back. With several service workers, each
+    indexes only the photos it saw and the last snapshot written wins.
+    """
+
+    def __init__(self,
+                 path: Optional[str] = None,
+                 max_distance: Optional[int] = None,
+                 max_entries: Optional[int] = None,
+                 snapshot_interval: Optional[float] = None,
+                 tail_size: int = DEFAULT_TAIL_SIZE):
+        """
+        Args:
+            path: Snapshot file, restored if it exists (default: PHOTO_INDEX_PATH; None keeps no snapshot)
+            max_distance: Largest Hamming distance of a near-duplicate (default: PHOTO_MATCH_DISTANCE or 6)
+            max_entries: Photos kept (default: PHOTO_INDEX_MAX_ENTRIES or 1000000)
+            snapshot_interval: Seconds between snapshots (default: PHOTO_INDEX_SNAPSHOT_SECONDS or 300)
+            tail_size: Unsorted entries merged into the buckets at a time
+        """
+        if path is None:
+            path = os.getenv("PHOTO_INDEX_PATH")
+        if max_distance is None:
+            max_distance = int(os.getenv("PHOTO_MATCH_DISTANCE", 6))
+        if max_entries is None:
+            max_entries = int(os.getenv("PHOTO_INDEX_MAX_ENTRIES", 1000000))
+        if snapshot_interval is None:
+            snapshot_interval = float(os.getenv("PHOTO_INDEX_SNAPSHOT_SECONDS", 300))
+        if not 0 <= max_distance < HASH_BITS:
+            raise ValueError(f"max_distance must be between 0 and {HASH_BITS - 1}")
+
+        self.path = path
+        self.max_distance = max_distance
+        self.max_entries = max(1, max_entries)
+        self.snapshot_interval = snapshot_interval
+        self.tail_size = max(1, tail_size)
+        self._probes = _chunk_probes(max_distance // CHUNKS)
+
+        # Bucketed entries: hashes, user and product keys, submission times (epoch seconds)
+        self._hashes = np.zeros(0, dtype=np.uint64)
+        self._users = np.zeros(0, dtype=np.uint64)
+        self._products = np.zeros(0, dtype=np.uint64)
+        self._times = np.zeros(0, dtype=np.uint32)
+        self._order, self._bucketed, self._starts = _bucket_tables(self._hashes)
+
+        # Entries added since the last merge, in the first _tail_count slots
+        self._tail = self._empty_columns(self.tail_size)
+        self._tail_count = 0
+
+        self._lock = threading.Lock()
+        self._merging = False
+        self._last_snapshot = time.monotonic()
+
+        if path and os.path.exists(path):
+            self.load(path)
+
+    @staticmethod
+    def _empty_columns(size: int) -> Tuple[np.ndarray, ...]:
+        return (np.zeros(size, dtype=np.uint64), np.zeros(size, dtype=np.uint64),
+                np.zeros(size, dtype=np.uint64), np.zeros(size, dtype=np.uint32))
+
+    def _columns(self) -> Tuple[np.ndarray, ...]:
+        return self._hashes, self._users, self._products, self._times
+
+    def __len__(self) -> int:
+        return len(self._hashes) + self._tail_count
+
+    def _near_entries(self, photo_hash: int, max_distance: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        (entries, distances) of the bucketed entries within max_distance.
+
+        Only entries agreeing with photo_hash to within max_distance // 4
+        bits on some chunk are verified; their hashes are read from the
+        bucket-ordered copies, so the scan touches a few contiguous runs.
+        """
+        values = np.array([(photo_hash >> (chunk * CHUNK_BITS)) & CHUNK_MASK for chunk in range(CHUNKS)])
+        probes = values[:, None] ^ self._probes[None, :]
+        rows = np.arange(CHUNKS)[:, None]
+        lo = self._starts[rows, probes].ravel()
+        lengths = self._starts[rows, probes + 1].ravel() - lo
+        total = int(lengths.sum())
+        if not total:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        # Positions of all probed buckets in the flattened tables
+        lo = lo + np.repeat(np.arange(CHUNKS) * len(self._hashes), len(self._probes))
+        positions = np.repeat(lo - np.cumsum(lengths) + lengths, lengths) + np.arange(total)
+        distances = hamming_distances(self._bucketed.ravel()[positions], photo_hash)
+        near = distances <= max_distance
+        # An entry close on several chunks is found once per chunk
+        entries, first = np.unique(self._order.ravel()[positions[near]], return_index=True)
+        return entries.astype(np.int64), distances[near][first].astype(np.int64)
+
+    def _matches(self, photo_hash: int, max_distance: int) -> Tuple[np.ndarray, ...]:
+        """(distances, user keys, product keys, times) of the entries within max_distance. Hold the lock."""
+        near, distances = self._near_entries(photo_hash, max_distance)
+        tail_hashes, tail_users, tail_products, tail_times = (column[:self._tail_count] for column in self._tail)
+        tail_distances = hamming_distances(tail_hashes, photo_hash)
+        tail_near = tail_distances <= max_distance
+        return (
+            np.concatenate([distances, tail_distances[tail_near].astype(np.int64)]),
+            np.concatenate([self._users[near], tail_users[tail_near]]),
+            np.concatenate([self._products[near], tail_products[tail_near]]),
+            np.concatenate([self._times[near], tail_times[tail_near]]),
+        )
+
+    def query(self, photo_hash: int, max_distance: Optional[int] = None, limit: int = 100) -> List[Dict]:
+        """
+        Earlier submissions of near-identical photos, nearest first.
+
+        Args:
+            photo_hash: Perceptual hash of the photo
+            max_distance: Largest Hamming distance (default: the index's; larger
+                values still only find entries within max_distance // 4 bits
+                on one chunk)
+            limit: Most matches returned
+
+        Returns:
+            List of dicts with distance, user and product keys and timestamp
+        """
+        with self._lock:
+            distances, users, products, times = self._matches(
+                photo_hash, self.max_distance if max_distance is None else max_distance
+            )
+        nearest = np.argsort(distances, kind="stable")[:limit]
+        return [
+            {
+                "distance": int(distances[i]),
+                "user": int(users[i]),
+                "product": int(products[i]),
+                "timestamp": datetime.fromtimestamp(int(times[i])).isoformat()
+            }
+            for i in nearest
+        ]
+
+    def add(self,
+            photo_hash: int,
+            user_id: Optional[str] = None,
+            product_id: Optional[str] = None,
+            timestamp: Optional[datetime] = None):
+        """Add one submitted photo."""
+        self._add(photo_hash, self._key(user_id), self._key(product_id), timestamp)
+
+    def record(self,
+               photo_hash: int,
+               user_id: Optional[str],
+               product_id: Optional[str],
+               timestamp: Optional[datetime] = None) -> int:
+        """
+        Count earlier submissions of a near-identical photo by other returns, then add this one.
+
+        A submission belongs to another return if it was for another
+        product, or by another user when both users are known; rescans of
+        the same return are not counted.
+        """
+        user, product = self._key(user_id), self._key(product_id)
+        with self._lock:
+            _, users, products, _ = self._matches(photo_hash, self.max_distance)
+        other = products != np.uint64(product)
+        if user:
+            other |= (users != np.uint64(user)) & (users != 0)
+        self._add(photo_hash, user, product, timestamp)
+        return int(other.sum())
+
+    @staticmethod
+    def _key(entity_id: Optional[str]) -> int:
+        # Key 0 stands for an unknown user or product
+        return entity_key(entity_id) if entity_id is not None else 0
+
+    def _add(self, photo_hash: int, user: int, product: int, timestamp: Optional[datetime]):
+        seconds = int((timestamp or datetime.now()).timestamp())
+        with self._lock:
+            if self._tail_count == len(self._tail[0]):
+                # A merge is still running; grow the tail meanwhile
+                grown = self._empty_columns(2 * self._tail_count)
+                for new, old in zip(grown, self._tail):
+                    new[:self._tail_count] = old
+                self._tail = grown
+            i = self._tail_count
+            for column, value in zip(self._tail, (photo_hash, user, product, seconds)):
+                column[i] = value
+            self._tail_count += 1
+            start_merge = self._tail_count >= self.tail_size and not self._merging
+            if start_merge:
+                self._merging = True
+        if start_merge:
+            threading.Thread(target=self._merge, daemon=True).start()
+
+    def compact(self):
+        """Merge the tail into the buckets now, waiting for a running merge first."""
+        while True:
+            with self._lock:
+                if not self._merging:
+                    self._merging = True
+                    break
+            time.sleep(0.001)
+        self._merge()
+
+    def _merge(self):
+        """Rebuild the bucket tables with the tail merged in. Call with _merging set."""
+        try:
+            with self._lock:
+                count = self._tail_count
+                base = self._columns()
+                tail = [column[:count].copy() for column in self._tail]
+            # Copying and sorting take seconds at tens of millions of entries;
+            # lookups and adds go on meanwhile (the bucketed arrays are replaced, never modified)
+            columns = [np.concatenate([old, new])[-self.max_entries:] for old, new in zip(base, tail)]
+            order, bucketed, starts = _bucket_tables(columns[0])
+            with self._lock:
+                self._hashes, self._users, self._products, self._times = columns
+                self._order, self._bucketed, self._starts = order, bucketed, starts
+                # Entries added during the merge stay in the tail
+                remaining = self._tail_count - count
+                for column in self._tail:
+                    column[:remaining] = column[count:count + remaining]
+                self._tail_count = remaining
+        finally:
+            self._merging = False
+
+    def snapshot_due(self) -> bool:
+        return bool(self.path) and time.monotonic() - self._last_snapshot >= self.snapshot_interval
+
+    def save(self, path: Optional[str] = None):
+        """Write a snapshot, atomically replacing the previous one."""
+        path = path or self.path
+        if not path:
+            return
+        with self._lock:
+            base = self._columns()
+            tail = [column[:self._tail_count].copy() for column in self._tail]
+            self._last_snapshot = time.monotonic()
+        state = {name: np.concatenate([old, new]) for name, old, new in zip(COLUMNS, base, tail)}
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # Per process, so concurrent saves never write into one temporary file
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(f, **state)
+        os.replace(tmp_path, path)
+
+    def load(self, path: str):
+        """Restore the entries of a snapshot, replacing the current ones."""
+        with np.load(path) as snapshot:
+            columns = [snapshot[name][-self.max_entries:] for name in COLUMNS]
+        order, bucketed, starts = _bucket_tables(columns[0])
+        with self._lock:
+            self._hashes, self._users, self._products, self._times = columns
+            self._order, self._bucketed, self._starts = order, bucketed, starts
+            self._tail_count = 0
+
+    def stats(self) -> Dict:
+        with self._lock:
+            arrays = self._columns() + (self._order, self._bucketed, self._starts) + self._tail
+            return {
+                "entries": len(self._hashes) + self._tail_count,
+                "unmerged": self._tail_count,
+                "maxDistance": self.max_distance,
+                "bytes": sum(array.nbytes for array in arrays)
+            }
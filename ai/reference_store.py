@@ -0,0 +1,256 @@
+import fcntl
+import hashlib
+import mmap
+import os
+from typing import Dict, Optional
+
+import numpy as np
+
+# Journal record: product key plus the location of its features
+INDEX_DTYPE = np.dtype([
+    ("key", "<u8"),
+    ("offset", "<u8"),
+    ("count", "<u4"),
+    ("dim", "<u4"),
+])
+
+# Index entry, stored apart from the keys so binary search reads a contiguous array
+ENTRY_DTYPE = np.dtype([
+    ("offset", "<u8"),
+    ("count", "<u4"),
+    ("dim", "<u4"),
+])
+
+# Merge the journal into the sorted index once it holds this many records
+DEFAULT_COMPACT_THRESHOLD = 10000
+
+
+def product_key(product_id: str) -> int:
+    """64-bit key for a product id."""
+    digest = hashlib.blake2b(product_id.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "little")
+
+
+class ReferenceFeatures:
+    """Keypoint coordinates and descriptors of a product's reference label."""
+
+    def __init__(self, points: np.ndarray, descriptors: np.ndarray):
+        self.points = points
+        self.descriptors = descriptors
+
+    def __len__(self) -> int:
+        return len(self.descriptors)
+
+
+class ReferenceStore:
+    """
+    Memory-mapped store of per-product reference descriptors.
+
+    A store directory holds three files:
+
+        features.bin  Append-only feature records: keypoint coordinates
+                      (float32, count x 2) then descriptors (uint8,
+                      count x dim), padded to 8 bytes.
+        index.bin     N sorted uint64 keys followed by N ENTRY_DTYPE entries.
+        journal.bin   INDEX_DTYPE records appended since the last compaction.
+
+    Keys are 64-bit BLAKE2b hashes of product ids. Features and index are only
+    read through memory maps, so several workers on one host share a single
+    copy in the page cache and a lookup touches only the pages it needs.
+
+    Descriptors are stored as uint8. This is lossless for OpenCV's SIFT, whose
+    float32 descriptors hold whole numbers in [0, 255], and for binary
+    descriptors. Writers serialize on an exclusive file lock. Readers pick up
+    new entries by watching the journal size, and compactions by watching the
+    index file's inode.
+    """
+
+    def __init__(self, path: str, compact_threshold: int = DEFAULT_COMPACT_THRESHOLD):
+        """
+        Args:
+            path: Store directory, created if missing
+            compact_threshold: Journal size that triggers a compaction on write
+        """
+        self.path = path
+        self.compact_threshold = compact_threshold
+        os.makedirs(path, exist_ok=True)
+
+        self._features_path = os.path.join(path, "features.bin")
+        self._index_path = os.path.join(path, "index.bin")
+        self._journal_path = os.path.join(path, "journal.bin")
+        self._lock_path = os.path.join(path, ".lock")
+        for file_path in (self._features_path, self._index_path, self._journal_path):
+            open(file_path, "ab").close()
+
+        self._features_map: Optional[mmap.mmap] = None
+        self._index_map: Optional[mmap.mmap] = None
+        self._keys = np.empty(0, dtype=np.uint64)
+        self._entries = np.empty(0, dtype=ENTRY_DTYPE)
+        self._index_inode = None
+        self._journal: Dict[int, np.void] = {}
+        self._journal_size = -1
+
+    def __len__(self) -> int:
+        self._refresh()
+        keys = set(self._journal)
+        return len(self._keys) + sum(1 for key in keys if self._find_in_index(key) is None)
+
+    def __contains__(self, product_id: str) -> bool:
+        return self._find(product_key(product_id)) is not None
+
+    def _refresh(self):
+        """Remap the index after a compaction and reload a grown journal."""
+        stat = os.stat(self._index_path)
+        if stat.st_ino != self._index_inode:
+            self._index_inode = stat.st_ino
+            self._map_index(stat.st_size)
+            # A compaction also truncates the journal
+            self._journal_size = -1
+
+        journal_size = os.path.getsize(self._journal_path)
+        if journal_size != self._journal_size:
+            records = np.fromfile(self._journal_path, dtype=INDEX_DTYPE,
+                                  count=journal_size // INDEX_DTYPE.itemsize)
+            # Later records supersede earlier ones for the same key
+            self._journal = {int(record["key"]): record for record in records}
+            self._journal_size = journal_size
+
+    def _map_index(self, size: int):
+        count = size // (8 + ENTRY_DTYPE.itemsize)
+        if not count:
+            self._keys = np.empty(0, dtype=np.uint64)
+            self._entries = np.empty(0, dtype=ENTRY_DTYPE)
+            return
+        with open(self._index_path, "rb") as f:
+            self._index_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._keys = np.frombuffer(self._index_map, dtype=np.uint64, count=count)
+        self._entries = np.frombuffer(self._index_map, dtype=ENTRY_DTYPE, count=count, offset=8 * count)
+
+    def _find_in_index(self, key: int) -> Optional[np.void]:
+        position = int(np.searchsorted(self._keys, np.uint64(key)))
+        if position < len(self._keys) and int(self._keys[position]) == key:
+            return self._entries[position]
+        return None
+
+    def _find(self, key: int) -> Optional[np.void]:
+        self._refresh()
+        record = self._journal.get(key)
+        if record is None:
+            record = self._find_in_index(key)
+        return record
+
+    def _features_buffer(self, end: int) -> mmap.mmap:
+        """Memory map of features.bin covering at least `end` bytes."""
+        if self._features_map is None or len(self._features_map) < end:
+            # The old map stays alive while arrays returned by get() use it
+            with open(self._features_path, "rb") as f:
+                self._features_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._features_map
+
+    def version(self, product_id: str) -> Optional[int]:
+        """
+        Version of a product's reference: the offset of its feature record.
+
+        features.bin is append-only, so every enrollment gets a new version,
+        and compaction keeps it. None if the product is not enrolled.
+        """
+        record = self._find(product_key(product_id))
+        return None if record is None else int(record["offset"])
+
+    def get(self, product_id: str) -> Optional[ReferenceFeatures]:
+        """
+        Look up the reference features of a product.
+
+        Returns:
+            ReferenceFeatures backed by the memory map, or None if not enrolled
+        """
+        record = self._find(product_key(product_id))
+        if record is None:
+            return None
+
+        offset, count, dim = int(record["offset"]), int(record["count"]), int(record["dim"])
+        points_size = count * 2 * 4
+        buffer = self._features_buffer(offset + points_size + count * dim)
+        points = np.frombuffer(buffer, dtype=np.float32, count=count * 2, offset=offset)
+        descriptors = np.frombuffer(buffer, dtype=np.uint8, count=count * dim,
+                                    offset=offset + points_size)
+        return ReferenceFeatures(points.reshape(count, 2), descriptors.reshape(count, dim))
+
+    def put(self, product_id: str, points: np.ndarray, descriptors: np.ndarray):
+        """
+        Store (or replace) the reference features of a product.
+
+        Args:
+            product_id: Product identifier
+            points: Keypoint coordinates relative to the label, shape (count, 2)
+            descriptors: Descriptors with values in [0, 255], shape (count, dim)
+        """
+        points = np.ascontiguousarray(points, dtype=np.float32).reshape(-1, 2)
+        descriptors = np.ascontiguousarray(descriptors)
+        if descriptors.dtype != np.uint8:
+            descriptors = np.clip(np.rint(descriptors), 0, 255).astype(np.uint8)
+        if len(points) != len(descriptors):
+            raise ValueError("points and descriptors must have the same length")
+
+        payload = points.tobytes() + descriptors.tobytes()
+        # Keep every record 8-byte aligned
+        payload += b"\0" * (-len(payload) % 8)
+
+        with open(self._lock_path, "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                with open(self._features_path, "ab") as f:
+                    offset = f.seek(0, os.SEEK_END)
+                    f.write(payload)
+
+                record = np.zeros(1, dtype=INDEX_DTYPE)
+                record["key"] = product_key(product_id)
+                record["offset"] = offset
+                record["count"] = len(descriptors)
+                record["dim"] = descriptors.shape[1] if descriptors.ndim == 2 else 0
+                with open(self._journal_path, "ab") as f:
+                    f.write(record.tobytes())
+
+                if os.path.getsize(self._journal_path) // INDEX_DTYPE.itemsize >= self.compact_threshold:
+                    self._compact_locked()
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def compact(self):
+        """Merge the journal into the sorted index."""
+        with open(self._lock_path, "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                self._compact_locked()
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _compact_locked(self):
+        journal = np.fromfile(self._journal_path, dtype=INDEX_DTYPE)
+        if not len(journal):
+            return
+
+        index_bytes = np.fromfile(self._index_path, dtype=np.uint8)
+        count = len(index_bytes) // (8 + ENTRY_DTYPE.itemsize)
+        index = np.empty(count, dtype=INDEX_DTYPE)
+        index["key"] = index_bytes[:8 * count].view(np.uint64)
+        entries = index_bytes[8 * count:].view(ENTRY_DTYPE)
+        for field in ENTRY_DTYPE.names:
+            index[field] = entries[field]
+
+        # Stable sort keeps insertion order among equal keys; keep the newest
+        merged = np.concatenate([index, journal])
+        merged = merged[np.argsort(merged["key"], kind="stable")]
+        last_of_key = np.append(merged["key"][1:] != merged["key"][:-1], True)
+        merged = merged[last_of_key]
+
+        entries = np.empty(len(merged), dtype=ENTRY_DTYPE)
+        for field in ENTRY_DTYPE.names:
+            entries[field] = merged[field]
+
+        tmp_path = self._index_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(np.ascontiguousarray(merged["key"]).tobytes())
+            f.write(entries.tobytes())
+        os.replace(tmp_path, self._index_path)
+        open(self._journal_path, "wb").close()
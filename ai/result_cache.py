@@ -0,0 +1,239 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+# Settings that change analysis results; part of every cache key
+ANALYZER_CONFIG_VARS = (
+    "FEATURE_BACKEND",
+    "LABEL_SINGLE_PASS",
+    "LABEL_CASCADE",
+    "LABEL_COARSE_SIDE",
+    "LABEL_COARSE_MAX_FEATURES",
+    "LABEL_COARSE_MIN_KEYPOINTS",
+    "LABEL_COARSE_ACCEPT",
+    "LABEL_MIN_SIDE",
+    "REFERENCE_MATCH_THRESHOLD",
+    "REFERENCE_MAX_FEATURES",
+    "ORB_MAX_FEATURES",
+)
+
+# Bump when analysis changes in a way that invalidates cached results
+CACHE_VERSION = 6
+
+
+def analyzer_config() -> str:
+    """Fingerprint of the analyzer settings in the environment."""
+    return json.dumps([CACHE_VERSION] + [os.getenv(name) for name in ANALYZER_CONFIG_VARS])
+
+
+def result_cache_key(image_bytes: bytes,
+                     coordinates: Dict[str, float],
+                     product_id: Optional[str] = None,
+                     backend: Optional[str] = None,
+                     config: Optional[str] = None,
+                     reference: Optional[int] = None) -> str:
+    """
+    Cache key of a label analysis.
+
+    Args:
+        image_bytes: Encoded image file contents
+        coordinates: Expected label coordinates
+        product_id: Product whose reference label is matched, if any
+        backend: Feature backend name, None for the default
+        config: Analyzer settings fingerprint (default: analyzer_config())
+        reference: Version of the product's enrolled reference
+            (ReferenceStore.version), None if it has none
+    """
+    digest = hashlib.blake2b(image_bytes, digest_size=16)
+    digest.update(json.dumps(
+        [coordinates, product_id, backend and backend.lower(), config or analyzer_config(), reference],
+        sort_keys=True
+    ).encode())
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """
+    In-process LRU cache of label analysis results with a TTL.
+
+    Keys include the version of the product's reference label, so after an
+    enrollment no process finds the results computed against the old one.
+    Entries also remember their product, so the enrolling process can free
+    them straight away.
+    """
+
+    # Whether operations wait on file I/O, so callers on the event loop
+    # should run them in a thread
+    blocking = False
+
+    def __init__(self, max_entries: Optional[int] = None, ttl: Optional[float] = None):
+        """
+        Args:
+            max_entries: Entries kept before the least recently used is evicted;
+                0 disables the cache (default: RESULT_CACHE_SIZE or 1024)
+            ttl: Seconds an entry stays valid (default: RESULT_CACHE_TTL_SECONDS or 600)
+        """
+        if max_entries is None:
+            max_entries = int(os.getenv("RESULT_CACHE_SIZE", 1024))
+        if ttl is None:
+            ttl = float(os.getenv("RESULT_CACHE_TTL_SECONDS", 600))
+
+        self.max_entries = max(0, max_entries)
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._lock = threading.Lock()
+        # key -> (expiry time, product id, result)
+        self._entries: "OrderedDict[str, Tuple[float, Optional[str], Dict]]" = OrderedDict()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: str) -> Optional[Dict]:
+        """Cached result for key, or None on a miss."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] < time.monotonic():
+                del self._entries[key]
+                self.evictions += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return dict(entry[2])
+
+    def put(self, key: str, result: Dict, product_id: Optional[str] = None):
+        """Store a result, evicting the least recently used entries over the limit."""
+        if not self.enabled:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, product_id, dict(result))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate_product(self, product_id: str):
+        """Drop every result computed for a product."""
+        with self._lock:
+            stale = [key for key, entry in self._entries.items() if entry[1] == product_id]
+            for key in stale:
+                del self._entries[key]
+
+    def stats(self) -> Dict:
+        """Hit, miss and eviction counters."""
+        return {
+            "backend": "memory",
+            "entries": len(self),
+            "maxEntries": self.max_entries,
+            "ttlSeconds": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions
+        }
+
+
+class SharedResultCache(ResultCache):
+    """
+    LRU result cache in a local SQLite file, shared by every worker process.
+
+    Lets uvicorn workers on one host reuse each other's results. Counters
+    are per process. Every operation may wait up to five seconds on another
+    process's write lock, so it is blocking; each thread gets its own
+    connection, so operations can run from worker threads.
+    """
+
+    blocking = True
+
+    def __init__(self, path: str, max_entries: Optional[int] = None, ttl: Optional[float] = None):
+        """
+        Args:
+            path: SQLite database file, created if missing
+            max_entries: As for ResultCache
+            ttl: As for ResultCache
+        """
+        super().__init__(max_entries, ttl)
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        # Connections are per thread; WAL lets readers run alongside a writer
+        self._local = threading.local()
+        db = self._connection()
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            " key TEXT PRIMARY KEY, product_id TEXT, result TEXT,"
+            " expires REAL, used REAL)"
+        )
+        db.execute("CREATE INDEX IF NOT EXISTS results_used ON results (used)")
+        db.execute("CREATE INDEX IF NOT EXISTS results_product ON results (product_id)")
+
+    def _connection(self) -> sqlite3.Connection:
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+        return db
+
+    def __len__(self) -> int:
+        return self._connection().execute("SELECT COUNT(*) FROM results").fetchone()[0]
+
+    def get(self, key: str) -> Optional[Dict]:
+        # Wall-clock time, since entries outlive the process that wrote them
+        now = time.time()
+        db = self._connection()
+        row = db.execute("SELECT result, expires FROM results WHERE key = ?", (key,)).fetchone()
+        if row is not None and row[1] < now:
+            db.execute("DELETE FROM results WHERE key = ?", (key,))
+            row = None
+            with self._lock:
+                self.evictions += 1
+        if row is None:
+            with self._lock:
+                self.misses += 1
+            return None
+        db.execute("UPDATE results SET used = ? WHERE key = ?", (now, key))
+        with self._lock:
+            self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, key: str, result: Dict, product_id: Optional[str] = None):
+        if not self.enabled:
+            return
+        now = time.time()
+        db = self._connection()
+        db.execute(
+            "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)",
+            (key, product_id, json.dumps(result), now + self.ttl, now)
+        )
+        evicted = db.execute(
+            "DELETE FROM results WHERE key IN ("
+            " SELECT key FROM results ORDER BY used DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,)
+        ).rowcount
+        with self._lock:
+            self.evictions += max(0, evicted)
+
+    def invalidate_product(self, product_id: str):
+        self._connection().execute("DELETE FROM results WHERE product_id = ?", (product_id,))
+
+    def stats(self) -> Dict:
+        stats = super().stats()
+        stats["backend"] = "sqlite"
+        return stats
@@ -0,0 +1,243 @@
+import cv2
+import numpy as np
+import os
+import secrets
+import time
+from collections import OrderedDict
+from typing import Dict, Optional
+
+# Side of the label thumbnail compared between frames
+THUMBNAIL_SIDE = 32
+# Shorter label side, in pixels, at which sharpness is measured
+SHARPNESS_SIDE = 128
+# Reasons a frame contributes no evidence
+SKIP_REASONS = ("blurry", "duplicate", "unusable")
+
+
+def frame_sharpness(label: np.ndarray) -> float:
+    """
+    Variance of the Laplacian of a grayscale label crop.
+
+    Measured on the label scaled down to SHARPNESS_SIDE on its shorter side,
+    so the same blur scores the same at any photo resolution.
+    """
+    factor = min(label.shape[:2]) / SHARPNESS_SIDE
+    if factor > 1:
+        size = (max(1, round(label.shape[1] / factor)), max(1, round(label.shape[0] / factor)))
+        label = cv2.resize(label, size, interpolation=cv2.INTER_AREA)
+    return float(cv2.Laplacian(label, cv2.CV_32F).var())
+
+
+def frame_thumbnail(label: np.ndarray) -> np.ndarray:
+    """THUMBNAIL_SIDE x THUMBNAIL_SIDE grayscale thumbnail of a label crop."""
+    return cv2.resize(label, (THUMBNAIL_SIDE, THUMBNAIL_SIDE), interpolation=cv2.INTER_AREA)
+
+
+def frame_difference(thumbnail: np.ndarray, previous: np.ndarray) -> float:
+    """Mean absolute grey-level difference between two label thumbnails."""
+    return float(cv2.absdiff(thumbnail, previous).mean())
+
+
+class ScanSessionLimitError(Exception):
+    """Raised when the store already holds its maximum number of live sessions."""
+
+
+class ScanSession:
+    """
+    One burst scan: the frames of a single product, and the evidence so far.
+
+    Every analyzed frame votes for or against a label match, weighted by its
+    confidence. The session decides once the winning side leads by the
+    confidence threshold, or when it has seen max_frames frames.
+    """
+
+    def __init__(self,
+                 session_id: str,
+                 product_id: str,
+                 coordinates: Dict[str, float],
+                 backend: Optional[str],
+                 user_id: Optional[str],
+                 max_frames: int,
+                 confidence_threshold: float):
+        self.session_id = session_id
+        self.product_id = product_id
+        self.coordinates = coordinates
+        self.backend = backend
+        self.user_id = user_id
+        self.max_frames = max_frames
+        self.confidence_threshold = confidence_threshold
+
+        self.frames = 0
+        self.analyzed = 0
+        self.skipped = dict.fromkeys(SKIP_REASONS, 0)
+        self.last_frame: Optional[str] = None
+        # Thumbnail of the last analyzed frame; near-copies of it are skipped
+        self.previous: Optional[np.ndarray] = None
+
+        # Confidence-weighted votes and scores of the analyzed frames
+        self.weight = 0.0
+        self.match_weight = 0.0
+        self.weighted_score = 0.0
+        # Most confident analyzed frame, whose photo goes into the photo index
+        self.best: Optional[Dict] = None
+        self.verdict: Optional[Dict] = None
+        self.last_seen = time.monotonic()
+
+    @property
+    def done(self) -> bool:
+        return self.verdict is not None
+
+    @property
+    def confidence(self) -> float:
+        """Lead of the winning side, in summed frame confidence."""
+        return abs(2 * self.match_weight - self.weight)
+
+    def add(self, result: Dict) -> str:
+        """
+        Add one frame's analysis result.
+
+        Returns:
+            What became of the frame: analyzed, blurry, duplicate or unusable
+        """
+        self.frames += 1
+        outcome = result.get("skipped") or ("unusable" if "error" in result else "analyzed")
+        if outcome == "analyzed":
+            weight = float(result["confidence"])
+            self.analyzed += 1
+            self.weight += weight
+            self.match_weight += weight if result["labelMatch"] else 0.0
+            self.weighted_score += weight * float(result["score"])
+            self.previous = result.get("thumbnail", self.previous)
+            if self.best is None or weight > self.best["confidence"]:
+                self.best = result
+        else:
+            self.skipped[outcome] += 1
+        self.last_frame = outcome
+
+        if self.confidence >= self.confidence_threshold or self.frames >= self.max_frames:
+            self.verdict = self._verdict()
+        return outcome
+
+    def _verdict(self) -> Dict:
+        """Session result, in the shape of a single-frame analysis result."""
+        if not self.weight:
+            return {
+                "labelMatch": False,
+                "score": 0.0,
+                "confidence": 0.0,
+                "error": "No usable frame"
+            }
+        verdict = {
+            "labelMatch": 2 * self.match_weight > self.weight,
+            "score": self.weighted_score / self.weight,
+            "confidence": min(1.0, self.confidence),
+            "backend": self.best.get("backend"),
+            "reference": self.best.get("reference", False)
+        }
+        if "photoHash" in self.best:
+            verdict["photoHash"] = self.best["photoHash"]
+        return verdict
+
+    def state(self) -> Dict:
+        """Progress of the session, as returned to the client."""
+        return {
+            "sessionId": self.session_id,
+            "productId": self.product_id,
+            "frames": self.frames,
+            "analyzed": self.analyzed,
+            "skipped": dict(self.skipped),
+            "lastFrame": self.last_frame,
+            "confidence": min(1.0, self.confidence),
+            "done": self.done
+        }
+
+
+class ScanSessionStore:
+    """
+    Live burst scan sessions, dropped after idle_timeout seconds without a frame.
+
+    At most max_sessions are kept. Sessions are plain in-process state and
+    live in the process that created them. Like MetricsRegistry, not
+    thread-safe; use from the event loop.
+    """
+
+    def __init__(self,
+                 max_sessions: Optional[int] = None,
+                 idle_timeout: Optional[float] = None,
+                 max_frames: Optional[int] = None,
+                 confidence_threshold: Optional[float] = None):
+        """
+        Args:
+            max_sessions: Live sessions kept (default: SCAN_MAX_SESSIONS or 1000)
+            idle_timeout: Seconds a session lives after its last request
+                (default: SCAN_SESSION_IDLE_SECONDS or 60)
+            max_frames: Frames a session accepts before it decides on the
+                evidence it has (default: SCAN_MAX_FRAMES or 20)
+            confidence_threshold: Lead in summed frame confidence at which a
+                session decides early (default: SCAN_CONFIDENCE_THRESHOLD or 1.5;
+                a frame's confidence is at most 1, so above 1 no single frame decides)
+        """
+        self.max_sessions = max_sessions or int(os.getenv("SCAN_MAX_SESSIONS", 1000))
+        self.idle_timeout = idle_timeout or float(os.getenv("SCAN_SESSION_IDLE_SECONDS", 60))
+        self.max_frames = max_frames or int(os.getenv("SCAN_MAX_FRAMES", 20))
+        self.confidence_threshold = confidence_threshold or float(os.getenv("SCAN_CONFIDENCE_THRESHOLD", 1.5))
+        self.expired = 0
+
+        # Ordered by last use, least recent first
+        self._sessions: "OrderedDict[str, ScanSession]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def create(self,
+               product_id: str,
+               coordinates: Dict[str, float],
+               backend: Optional[str] = None,
+               user_id: Optional[str] = None) -> ScanSession:
+        """
+        Open a session.
+
+        Raises:
+            ScanSessionLimitError: max_sessions sessions are live
+        """
+        self.expire()
+        if len(self._sessions) >= self.max_sessions:
+            raise ScanSessionLimitError(f"{len(self._sessions)} scan sessions are open, limit is {self.max_sessions}")
+        session = ScanSession(secrets.token_urlsafe(16), product_id, coordinates, backend, user_id,
+                              self.max_frames, self.confidence_threshold)
+        self._sessions[session.session_id] = session
+        return session
+
+    def get(self, session_id: str) -> Optional[ScanSession]:
+        """Live session with this id, or None; marks the session as used."""
+        self.expire()
+        session = self._sessions.get(session_id)
+        if session is not None:
+            session.last_seen = time.monotonic()
+            self._sessions.move_to_end(session_id)
+        return session
+
+    def close(self, session_id: str) -> Optional[ScanSession]:
+        """Remove a session, returning it if it was live."""
+        return self._sessions.pop(session_id, None)
+
+    def expire(self) -> int:
+        """Drop sessions idle for longer than idle_timeout; returns how many."""
+        deadline = time.monotonic() - self.idle_timeout
+        dropped = 0
+        while self._sessions:
+            session = next(iter(self._sessions.values()))
+            if session.last_seen > deadline:
+                break
+            del self._sessions[session.session_id]
+            dropped += 1
+        self.expired += dropped
+        return dropped
+
+    def stats(self) -> Dict:
+        return {
+            "sessions": len(self),
+            "maxSessions": self.max_sessions,
+            "idleTimeoutSeconds": self.idle_timeout,
+            "expired": self.expired
+        }
@@ -1,13 +1,42 @@
 import pytest
+from fastapi import HTTPException
 from fastapi.testclient import TestClient
 import base64
 import json
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 import os
+import subprocess
+import sys
+import time
+import asyncio
+import cv2
+import joblib
+import numpy as np
+import pandas as pd
+from bson import ObjectId
+from sklearn.ensemble import IsolationForest
 
+import app as app_module
+from compiled_forest import CompiledIsolationForest
+from datasets.synthetic_generator import SyntheticDataGenerator, _relocate_label, write_chunks
 from app import app
+from benchmarks.images import rescan, synthetic_label_photo
+from benchmarks.suite import compare
+from feature_store import HISTORY_FEATURES, ReturnHistoryStore
+from image_decoder import ImageDecoder, ImageTooLargeError
+from label_coordinates import LabelCoordinateStore
+from metrics import MetricsRegistry
+from reference_store import ReferenceStore
+from result_cache import ResultCache, SharedResultCache, result_cache_key
+from scan_session import ScanSession, ScanSessionLimitError, ScanSessionStore
 from label_analyzer import LabelAnalyzer
+from model_reload import ModelValidationError, TrustModelReloader, canary_batch
+from photo_index import PhotoIndex, hamming_distances, perceptual_hash
+from trust_batcher import TrustBatcher
+from trust_retrainer import BackgroundTrainer, IncrementalTrainer, acquire_trainer_lock
 from trust_scorer import TrustScorer
+from trust_training import ReservoirSample, frame_features, read_chunks, train_streaming
+from vision_pool import VisionPool, PoolSaturatedError, PoolTimeoutError
 
 # Initialize test client
 client = TestClient(app)
@@ -21,6 +50,27 @@ SAMPLE_COORDINATES = {
     "height": 100
 }
 
+class FakeProductCollection:
+    """In-memory stand-in for the backend's products collection."""
+
+    def __init__(self, documents):
+        self.documents = {document["_id"]: document for document in documents}
+        self.queries = []
+
+    def find(self, query, projection=None):
+        ids = query["_id"]["$in"]
+        self.queries.append(ids)
+        return [document for key, document in self.documents.items() if key in ids]
+
+def make_label_image(seed: int = 0) -> bytes:
+    """Build a PNG with a textured label inside a plainer garment region."""
+    rng = np.random.default_rng(seed)
+    image = cv2.GaussianBlur(rng.integers(0, 256, (400, 500, 3), dtype=np.uint8), (9, 9), 0)
+    label = rng.integers(0, 256, (100, 200, 3), dtype=np.uint8)
+    image[100:200, 100:300] = cv2.resize(label, (200, 100), interpolation=cv2.INTER_NEAREST)
+    cv2.putText(image, "TRUETAG", (110, 160), cv2.FONT_HERSHEY_SIMPLEX, 1.2, (255, 255, 255), 3)
+    return cv2.imencode(".png", image)[1].tobytes()
+
 def test_health_check():
     """Test the health check endpoint."""
     response = client.get("/")
@@ -44,14 +94,525 @@ def test_label_analysis():
     assert "confidence" in data
     assert "timestamp" in data
 
+def test_label_analysis_upload():
+    """Test the multipart label analysis endpoint."""
+    response = client.post(
+        "/analyze/label/upload",
+        data={"productId": "TEST123", "expectedCoordinates": json.dumps(SAMPLE_COORDINATES)},
+        files={"image": ("label.png", make_label_image(), "image/png")}
+    )
+    assert response.status_code == 200
+    
+    data = response.json()
+    assert data["productId"] == "TEST123"
+    assert "labelMatch" in data
+    assert "score" in data
+
+def test_label_analysis_raw():
+    """Test the raw-bytes label analysis endpoint."""
+    response = client.post(
+        "/analyze/label/raw",
+        params={"productId": "TEST123", **SAMPLE_COORDINATES},
+        content=make_label_image(),
+        headers={"Content-Type": "application/octet-stream"}
+    )
+    assert response.status_code == 200
+    assert response.json()["score"] > 0
+
+def test_bytes_and_base64_decode_match():
+    """Test that raw-bytes and base64 decoding produce the same pixels."""
+    analyzer = LabelAnalyzer()
+    image_bytes = make_label_image()
+    from_bytes, _ = analyzer._decode_image_bytes(image_bytes)
+    from_base64, _ = analyzer._decode_base64_image(base64.b64encode(image_bytes).decode())
+    assert np.array_equal(from_bytes, from_base64)
+
+def test_decoder_rejects_oversized_image_before_decoding():
+    """Test that the header check rejects images over the pixel limit."""
+    decoder = ImageDecoder(max_pixels=100 * 100)
+    with pytest.raises(ImageTooLargeError):
+        decoder.probe(make_label_image())
+
+def test_decoder_reduces_jpeg_for_large_labels():
+    """Test DCT-scaled grayscale decode and coordinate scaling."""
+    image = np.random.default_rng(0).integers(0, 256, (1600, 2000, 3), dtype=np.uint8)
+    jpeg = cv2.imencode(".jpg", image)[1].tobytes()
+    decoder = ImageDecoder(min_label_side=100)
+
+    gray, scale = decoder.decode(jpeg, {"x": 0, "y": 0, "width": 800, "height": 400})
+    assert gray.ndim == 2
+    assert gray.shape == (400, 500)
+    assert scale == 0.25
+
+def test_decoder_applies_exif_orientation():
+    """Test that EXIF orientation 6 (rotate 90 degrees clockwise) is applied."""
+    from PIL import Image
+    import io
+    buffer = io.BytesIO()
+    exif = Image.Exif()
+    exif[0x0112] = 6
+    Image.new("L", (300, 200), 128).save(buffer, format="JPEG", exif=exif.tobytes())
+
+    gray, scale = ImageDecoder().decode(buffer.getvalue())
+    assert gray.shape == (300, 200)
+    assert scale == 1.0
+
+def test_normalized_coordinates_match_pixels():
+    """Test that normalized label coordinates give the same analysis as pixel ones."""
+    image = make_label_image(seed=5)
+    analyzer = LabelAnalyzer()
+    normalized = {"x": 100 / 500, "y": 100 / 400, "width": 200 / 500, "height": 100 / 400}
+    assert analyzer.analyze_label_bytes(image, normalized) == analyzer.analyze_label_bytes(image, SAMPLE_COORDINATES)
+
+    # Only the 3x3 label window is preprocessed, colour included
+    photo = cv2.imdecode(np.frombuffer(image, np.uint8), cv2.IMREAD_COLOR)
+    window, coordinates = analyzer._preprocess_window(photo, normalized)
+    assert window.shape == (300, 500)
+    assert (coordinates["x"], coordinates["y"]) == (100, 100)
+
+    # The decoder sizes its reduction from normalized coordinates too
+    decoder = ImageDecoder(min_label_side=128)
+    header = decoder.probe(cv2.imencode(".jpg", np.zeros((3000, 4000), np.uint8))[1].tobytes())
+    assert decoder.reduction_factor(header, {"x": 0.1, "y": 0.1, "width": 0.2, "height": 0.2}) == 4
+
+def test_label_analysis_rejects_oversized_upload():
+    """Test that uploads over MAX_IMAGE_SIZE get 413."""
+    response = client.post(
+        "/analyze/label/raw",
+        params={"productId": "TEST123", **SAMPLE_COORDINATES},
+        content=b"0" * (app_module.image_decoder.max_bytes + 1),
+        headers={"Content-Type": "application/octet-stream"}
+    )
+    assert response.status_code == 413
+
+def test_label_analysis_rejects_oversized_photo(monkeypatch, tmp_path):
+    """Test that photos over the pixel limit, found by the vision workers, get 413 too."""
+    # Workers read the limits and the store when they start
+    monkeypatch.setenv("MAX_IMAGE_PIXELS", "10000")
+    monkeypatch.setenv("REFERENCE_STORE_PATH", str(tmp_path))
+    pool = VisionPool(max_workers=1)
+    monkeypatch.setattr(app_module, "vision_pool", pool)
+    try:
+        image = make_label_image(seed=4)
+        response = client.post("/analyze/label/raw", params={"productId": "TEST123", **SAMPLE_COORDINATES},
+                               content=image)
+        assert response.status_code == 413 and "pixels" in response.json()["detail"]
+
+        items = [{"productId": "BIG", "image": base64.b64encode(image).decode(), "expectedCoordinates": SAMPLE_COORDINATES}]
+        line = json.loads(client.post("/analyze/label/batch", json={"items": items}).text.splitlines()[0])
+        assert line["status"] == 413
+
+        response = client.post("/reference/enroll", json={
+            "productId": "BIG", "image": base64.b64encode(image).decode(), "labelCoordinates": SAMPLE_COORDINATES
+        })
+        assert response.status_code == 413
+    finally:
+        pool.shutdown()
+
+def test_label_batch_streams_results(monkeypatch):
+    """Test that batch label results stream back as NDJSON and failures stay per item."""
+    image = base64.b64encode(make_label_image(seed=4)).decode()
+    items = [
+        {"productId": "GOOD1", "image": image, "expectedCoordinates": SAMPLE_COORDINATES},
+        {"productId": "BAD", "image": SAMPLE_IMAGE_BASE64, "expectedCoordinates": SAMPLE_COORDINATES},
+        {"productId": "GOOD2", "image": image, "expectedCoordinates": SAMPLE_COORDINATES},
+        {"productId": "BACKEND", "image": image, "expectedCoordinates": SAMPLE_COORDINATES,
+         "featureBackend": "surf"},
+    ]
+    response = client.post("/analyze/label/batch", json={"items": items})
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+
+    lines = {line["index"]: line for line in map(json.loads, response.text.splitlines())}
+    assert sorted(lines) == [0, 1, 2, 3]
+    single = client.post("/analyze/label", json=items[0]).json()
+    for index in (0, 2):
+        assert lines[index]["score"] == single["score"] and "error" not in lines[index]
+    assert lines[1]["productId"] == "BAD" and lines[1]["labelMatch"] is False and "error" in lines[1]
+    assert lines[3]["status"] == 400
+
+    monkeypatch.setenv("LABEL_BATCH_MAX_SIZE", "3")
+    assert client.post("/analyze/label/batch", json={"items": items}).status_code == 413
+
+def test_reference_store_roundtrip(tmp_path):
+    """Test that reference features survive reopening and compaction."""
+    store = ReferenceStore(str(tmp_path), compact_threshold=3)
+    points = np.arange(20, dtype=np.float32).reshape(10, 2)
+    descriptors = np.arange(1280).reshape(10, 128) % 256
+    store.put("PROD1", points, descriptors)
+    first_version = store.version("PROD1")
+    store.put("PROD2", points[:5], descriptors[:5])
+    store.put("PROD1", points[:3], descriptors[:3])  # re-enrollment, triggers compaction
+    assert store.version("PROD1") != first_version and store.version("PROD3") is None
+
+    # A second handle sees the same data, as another worker would
+    other = ReferenceStore(str(tmp_path))
+    assert len(other) == 2
+    assert "PROD3" not in other
+    reference = other.get("PROD1")
+    assert len(reference) == 3
+    assert np.array_equal(reference.points, points[:3])
+    assert np.array_equal(reference.descriptors, descriptors[:3].astype(np.uint8))
+
+def test_label_analysis_against_reference(tmp_path):
+    """Test that scans are matched against the enrolled reference label."""
+    analyzer = LabelAnalyzer(reference_store=ReferenceStore(str(tmp_path)))
+    enrolled = analyzer.enroll_reference("PROD1", make_label_image(seed=1), SAMPLE_COORDINATES)
+    assert enrolled["features"] >= 10
+
+    genuine = analyzer.analyze_label_bytes(make_label_image(seed=1), SAMPLE_COORDINATES, "PROD1")
+    other_label = analyzer.analyze_label_bytes(make_label_image(seed=2), SAMPLE_COORDINATES, "PROD1")
+    assert genuine["reference"] and genuine["labelMatch"]
+    assert not other_label["labelMatch"]
+    assert genuine["score"] > other_label["score"]
+
+def test_single_pass_matches_two_pass():
+    """Test that single-pass extraction scores within the documented tolerance of two passes."""
+    analyzer = LabelAnalyzer()
+    analyzer.cascade = False
+    # The label, and boxes that miss it to the right and diagonally
+    boxes = [SAMPLE_COORDINATES, {**SAMPLE_COORDINATES, "x": 300}, {**SAMPLE_COORDINATES, "x": 250, "y": 250}]
+    for seed in range(3):
+        image_bytes = make_label_image(seed)
+        for coordinates in boxes:
+            analyzer.single_pass = False
+            two_pass = analyzer.analyze_label_bytes(image_bytes, coordinates)
+            analyzer.single_pass = True
+            single_pass = analyzer.analyze_label_bytes(image_bytes, coordinates)
+            assert single_pass["labelMatch"] == two_pass["labelMatch"]
+            assert abs(single_pass["score"] - two_pass["score"]) <= 0.1
+        assert two_pass["score"] > 0.5
+
+def test_cascade_matches_full_stage():
+    """Test that the coarse stage settles clear matches and leaves mismatches to the full stage."""
+    analyzer = LabelAnalyzer()
+    stages = set()
+    for seed in range(3):
+        photo, coordinates = synthetic_label_photo(1280, 960, seed)
+        off_label = dict(coordinates, x=coordinates["x"] + coordinates["width"])
+        # Without a reference an off-label box scores like the label, so only agreement is checked
+        scans = [
+            (photo, coordinates, True),
+            (_relocate_label(photo, coordinates), coordinates, False),
+            (photo, off_label, None),
+        ]
+        for scan, box, genuine in scans:
+            image_bytes = cv2.imencode(".jpg", rescan(scan, seed))[1].tobytes()
+            analyzer.cascade = False
+            full = analyzer.analyze_label_bytes(image_bytes, box)
+            analyzer.cascade = True
+            cascade = analyzer.analyze_label_bytes(image_bytes, box)
+            assert full["stage"] == "full"
+            assert cascade["labelMatch"] == full["labelMatch"]
+            if genuine is not None:
+                assert full["labelMatch"] == genuine
+            if genuine:
+                stages.add(cascade["stage"])
+            elif genuine is False:
+                # The coarse stage only ever accepts, so a mismatch always reaches the full stage
+                assert cascade["stage"] == "full"
+    assert "coarse" in stages
+
+def test_scan_session_skips_frames_and_stops_when_confident():
+    """Test that a burst scan skips blurry and repeated frames and decides early."""
+    frame = cv2.imdecode(np.frombuffer(make_label_image(seed=5), dtype=np.uint8), cv2.IMREAD_COLOR)
+    blurry = cv2.imencode(".png", cv2.GaussianBlur(frame, (0, 0), 8))[1].tobytes()
+    sharp = cv2.imencode(".png", frame)[1].tobytes()
+    brighter = cv2.imencode(".png", cv2.add(frame, 20))[1].tobytes()
+
+    response = client.post("/scan/sessions", json={
+        "productId": "TEST123", "userId": "USER456", "expectedCoordinates": SAMPLE_COORDINATES
+    })
+    assert response.status_code == 200
+    frames_url = f"/scan/sessions/{response.json()['sessionId']}/frames"
+
+    assert client.post(frames_url, content=blurry).json()["lastFrame"] == "blurry"
+    state = client.post(frames_url, content=sharp).json()
+    # No single frame decides a session, however confident
+    assert state["lastFrame"] == "analyzed" and not state["done"]
+    assert client.post(frames_url, content=sharp).json()["lastFrame"] == "duplicate"
+    while not state["done"]:
+        state = client.post(frames_url, content=brighter if state["lastFrame"] != "analyzed" else sharp).json()
+        assert state["frames"] <= app_module.scan_sessions.max_frames
+    assert state["verdict"]["labelMatch"]
+    assert state["skipped"]["blurry"] == 1
+
+    # A decided session analyzes no more frames
+    frames = state["frames"]
+    assert client.post(frames_url, content=brighter).json()["frames"] == frames
+    assert client.delete(frames_url.rsplit("/", 1)[0]).status_code == 200
+    assert client.post(frames_url, content=sharp).status_code == 404
+
+def test_scan_session_store_bounds_and_votes():
+    """Test session limits, idle expiry and the confidence-weighted verdict."""
+    store = ScanSessionStore(max_sessions=2, idle_timeout=0.05)
+    store.create("P1", SAMPLE_COORDINATES)
+    store.create("P2", SAMPLE_COORDINATES)
+    with pytest.raises(ScanSessionLimitError):
+        store.create("P3", SAMPLE_COORDINATES)
+    time.sleep(0.1)
+    session = store.create("P3", SAMPLE_COORDINATES)
+    assert len(store) == 1 and store.stats()["expired"] == 2
+    assert store.get(session.session_id) is session
+
+    # By default a fully confident frame needs a second one agreeing
+    certain = {"labelMatch": True, "score": 1.0, "confidence": 1.0}
+    session = ScanSessionStore().create("P1", SAMPLE_COORDINATES)
+    assert session.add(certain) == "analyzed" and not session.done
+    session.add(certain)
+    assert session.done and session.verdict["labelMatch"]
+
+    session = ScanSession("s", "P1", SAMPLE_COORDINATES, None, None, max_frames=4, confidence_threshold=1.0)
+    match = {"labelMatch": True, "score": 0.9, "confidence": 0.6}
+    assert session.add(match) == "analyzed" and not session.done
+    # Opposing evidence cancels out; unusable frames add none
+    session.add({"labelMatch": False, "score": 0.2, "confidence": 0.4})
+    assert session.add({"labelMatch": False, "score": 0.0, "confidence": 1.0, "error": "x"}) == "unusable"
+    assert not session.done
+    # The frame limit decides on the evidence so far
+    session.add(match)
+    assert session.done
+    assert session.verdict["labelMatch"] and session.verdict["confidence"] == pytest.approx(0.8)
+    assert session.verdict["score"] == pytest.approx((0.6 * 0.9 * 2 + 0.4 * 0.2) / 1.6)
+
+def test_binary_backend_against_reference(tmp_path):
+    """Test that a binary backend verifies against its own enrolled reference."""
+    analyzer = LabelAnalyzer(reference_store=ReferenceStore(str(tmp_path)))
+    analyzer.enroll_reference("PROD1", make_label_image(seed=1), SAMPLE_COORDINATES, backend="orb")
+
+    genuine = analyzer.analyze_label_bytes(make_label_image(seed=1), SAMPLE_COORDINATES, "PROD1", "orb")
+    other_label = analyzer.analyze_label_bytes(make_label_image(seed=2), SAMPLE_COORDINATES, "PROD1", "orb")
+    assert genuine["backend"] == "orb" and genuine["reference"] and genuine["labelMatch"]
+    assert not other_label["labelMatch"]
+
+    # No SIFT reference was enrolled, so SIFT falls back to the surroundings
+    sift = analyzer.analyze_label_bytes(make_label_image(seed=1), SAMPLE_COORDINATES, "PROD1", "sift")
+    assert "reference" not in sift
+
+def test_label_analysis_unknown_backend():
+    """Test that an unknown feature backend is rejected."""
+    request_data = {
+        "productId": "TEST123",
+        "image": SAMPLE_IMAGE_BASE64,
+        "expectedCoordinates": SAMPLE_COORDINATES,
+        "featureBackend": "surf"
+    }
+    response = client.post("/analyze/label", json=request_data)
+    assert response.status_code == 400
+
+def test_result_cache_lru_and_ttl():
+    """Test LRU and TTL eviction of cached results."""
+    cache = ResultCache(max_entries=2, ttl=60)
+    cache.put("a", {"score": 1.0})
+    cache.put("b", {"score": 0.5})
+    assert cache.get("a") == {"score": 1.0}  # a is now most recently used
+    cache.put("c", {"score": 0.1})
+    assert cache.get("b") is None
+    assert cache.stats()["evictions"] == 1
+
+    expiring = ResultCache(max_entries=2, ttl=0)
+    expiring.put("a", {"score": 1.0})
+    assert expiring.get("a") is None
+
+def test_shared_result_cache(tmp_path):
+    """Test that workers share results and invalidation through the SQLite cache."""
+    path = str(tmp_path / "results.db")
+    key = result_cache_key(b"image", SAMPLE_COORDINATES, "PROD1")
+    SharedResultCache(path, max_entries=10, ttl=60).put(key, {"score": 0.9}, "PROD1")
+
+    other = SharedResultCache(path, max_entries=10, ttl=60)
+    assert other.get(key) == {"score": 0.9}
+    other.invalidate_product("PROD1")
+    assert other.get(key) is None
+    assert other.stats()["hits"] == 1 and other.stats()["misses"] == 1
+
+def test_label_analysis_cache_hit(monkeypatch, tmp_path):
+    """Test that a resubmitted image is answered from the cache until its product's reference changes."""
+    monkeypatch.setattr(app_module, "result_cache", ResultCache(max_entries=10, ttl=60))
+    monkeypatch.setattr(app_module, "reference_store", ReferenceStore(str(tmp_path)))
+    params = {"productId": "TEST123", **SAMPLE_COORDINATES}
+    image = make_label_image(seed=3)
+    first = client.post("/analyze/label/raw", params=params, content=image).json()
+    second = client.post("/analyze/label/raw", params=params, content=image).json()
+
+    stats = client.get("/cache/stats").json()
+    assert stats["hits"] == 1 and stats["misses"] == 1
+    del first["timestamp"], second["timestamp"]
+    assert first == second
+
+    # An enrollment through another process, whose invalidation this cache never sees
+    ReferenceStore(str(tmp_path)).put("TEST123", np.zeros((10, 2), dtype=np.float32), np.zeros((10, 128)))
+    client.post("/analyze/label/raw", params=params, content=image)
+    assert client.get("/cache/stats").json()["misses"] == 2
+
+def test_shared_result_cache_runs_off_event_loop(monkeypatch, tmp_path):
+    """Test that the SQLite result cache is never queried on the event loop."""
+    on_loop = []
+
+    class RecordingCache(SharedResultCache):
+        def _connection(self):
+            try:
+                asyncio.get_running_loop()
+                on_loop.append(True)
+            except RuntimeError:
+                on_loop.append(False)
+            return super()._connection()
+
+    monkeypatch.setattr(app_module, "result_cache", RecordingCache(str(tmp_path / "results.db"), ttl=60))
+    monkeypatch.setattr(app_module, "reference_store", ReferenceStore(str(tmp_path / "references")))
+    # Workers read the store when they start
+    monkeypatch.setenv("REFERENCE_STORE_PATH", str(tmp_path / "references"))
+    pool = VisionPool(max_workers=1)
+    monkeypatch.setattr(app_module, "vision_pool", pool)
+    try:
+        on_loop.clear()
+        params = {"productId": "TEST123", **SAMPLE_COORDINATES}
+        image = make_label_image(seed=3)
+        client.post("/analyze/label/raw", params=params, content=image)
+        client.post("/analyze/label/raw", params=params, content=image)
+        stats = client.get("/cache/stats").json()
+        assert stats["backend"] == "sqlite" and stats["hits"] == 1
+        response = client.post("/reference/enroll", json={
+            "productId": "TEST123", "image": base64.b64encode(image).decode(), "labelCoordinates": SAMPLE_COORDINATES
+        })
+        assert response.status_code == 200
+        assert on_loop and not any(on_loop)
+    finally:
+        pool.shutdown()
+
+def test_label_coordinate_store_caches_lookups():
+    """Test that coordinates are cached, misses are cached negatively and batched, and lookups are shared."""
+    product_id = "64b7f0c2a1e4c3d2b1a09f8e"
+    products = FakeProductCollection([
+        {"_id": ObjectId(product_id), "labelCoordinates": SAMPLE_COORDINATES},
+        {"_id": "PROD2", "labelCoordinates": {"x": 0.1, "y": 0.2, "width": 0.5, "height": 0.25}},
+        {"_id": "NOLABEL", "labelCoordinates": {"x": 10, "y": 10}},
+    ])
+    store = LabelCoordinateStore(products, max_entries=10, ttl=60, negative_ttl=60)
+
+    async def scenario():
+        first, again = await asyncio.gather(store.get(product_id), store.get(product_id))
+        batch = await store.get_many(["PROD2", "NOLABEL", "MISSING", product_id])
+        return first, again, batch, await store.get("MISSING")
+
+    first, again, batch, missing = asyncio.run(scenario())
+    assert first == again == {key: float(value) for key, value in SAMPLE_COORDINATES.items()}
+    assert batch["PROD2"]["width"] == 0.5 and batch[product_id] == first
+    assert batch["NOLABEL"] is None and batch["MISSING"] is None and missing is None
+    # One query for the concurrent lookups, one for the batch's misses, then the cache
+    assert products.queries == [[ObjectId(product_id)], ["PROD2", "NOLABEL", "MISSING"]]
+    stats = store.stats()
+    assert stats["queries"] == 2 and stats["hits"] == 1 and stats["negativeHits"] == 1
+
+    # Expired entries and failed queries are looked up again after their TTL
+    expiring = LabelCoordinateStore(products, max_entries=10, ttl=60, negative_ttl=1e-9)
+    assert asyncio.run(expiring.get("MISSING")) is None
+    assert asyncio.run(expiring.get("MISSING")) is None
+    assert expiring.stats()["queries"] == 2
+
+    failing = LabelCoordinateStore(products)
+    products.find = None
+    assert asyncio.run(failing.get("PROD2")) is None and failing.stats()["errors"] == 1
+    assert failing.failed("PROD2") and not store.failed("MISSING")
+
+def test_label_analysis_uses_stored_coordinates(monkeypatch):
+    """Test that requests without expectedCoordinates use the product's stored ones."""
+    products = FakeProductCollection([{"_id": "PROD1", "labelCoordinates": SAMPLE_COORDINATES}])
+    monkeypatch.setattr(app_module, "label_coordinates", LabelCoordinateStore(products, max_entries=10))
+    image = base64.b64encode(make_label_image(seed=5)).decode()
+
+    given = client.post("/analyze/label", json={"productId": "PROD1", "image": image,
+                                                "expectedCoordinates": SAMPLE_COORDINATES}).json()
+    stored = client.post("/analyze/label", json={"productId": "PROD1", "image": image}).json()
+    assert stored["score"] == given["score"]
+    response = client.post("/analyze/label", json={"productId": "UNKNOWN", "image": image})
+    assert response.status_code == 400
+    # A photo sent for trust scoring is never taken as verified without coordinates
+    trust = {"userId": "USER1", "activationTime": datetime.now().isoformat(), "returnAttempts": 0, "image": image}
+    assert client.post("/analyze/trust", json={**trust, "productId": "UNKNOWN"}).status_code == 400
+
+    items = [{"productId": product_id, "image": image} for product_id in ("PROD1", "OTHER", "PROD1")]
+    lines = [json.loads(line) for line in client.post("/analyze/label/batch", json={"items": items}).text.splitlines()]
+    assert sorted(line.get("status", 200) for line in lines) == [200, 200, 400]
+    assert products.queries == [["PROD1"], ["UNKNOWN"], ["OTHER"]]
+
+    # Empty coordinates are given ones, not a lookup
+    items = [{"productId": "PROD1", "image": image, "expectedCoordinates": {}}]
+    line = json.loads(client.post("/analyze/label/batch", json={"items": items}).text)
+    assert line["labelMatch"] is False and products.queries[-1] == ["OTHER"]
+
+    # While the database is unreachable, lookups are a 503 rather than a 400
+    products.find = None
+    monkeypatch.setattr(app_module, "label_coordinates", LabelCoordinateStore(products, max_entries=10))
+    assert client.post("/analyze/label", json={"productId": "PROD1", "image": image}).status_code == 503
+    assert client.post("/analyze/trust", json={**trust, "productId": "PROD1"}).status_code == 503
+
+def test_stage_timings_and_metrics(monkeypatch):
+    """Test the per-request stage breakdown header and the Prometheus metrics."""
+    monkeypatch.setattr(app_module, "result_cache", ResultCache(max_entries=0))
+    # The cascade is opt-in; workers read the setting when they start
+    monkeypatch.setenv("LABEL_CASCADE", "true")
+    pool = VisionPool(max_workers=1)
+    monkeypatch.setattr(app_module, "vision_pool", pool)
+    try:
+        params = {"productId": "TEST123", **SAMPLE_COORDINATES}
+        response = client.post("/analyze/label/raw", params=params, content=make_label_image(seed=4),
+                               headers={"X-Debug-Timing": "1"})
+        assert response.status_code == 200
+        assert "timing" not in response.json()
+        assert response.json()["stage"] == "coarse"
+        stages = dict(entry.split(";dur=") for entry in response.headers["server-timing"].split(", "))
+        assert {"image_decode", "coarse_detect", "coarse_match", "vision_wait"} <= set(stages)
+        assert all(float(duration) >= 0 for duration in stages.values())
+
+        # Labels too small to downscale go straight to the full stage
+        params = {"productId": "TEST123", "x": 100, "y": 100, "width": 80, "height": 40}
+        response = client.post("/analyze/label/raw", params=params, content=make_label_image(seed=4),
+                               headers={"X-Debug-Timing": "1"})
+        assert response.json()["stage"] == "full"
+        stages = dict(entry.split(";dur=") for entry in response.headers["server-timing"].split(", "))
+        assert {"clahe", "detect_window", "match"} <= set(stages)
+
+        # Without the header, no breakdown is returned
+        response = client.post("/analyze/trust", json={
+            "productId": "TEST123", "userId": "USER456",
+            "activationTime": datetime.now().isoformat(), "returnAttempts": 0
+        })
+        assert "server-timing" not in response.headers
+
+        text = client.get("/metrics").text
+        assert 'truetag_stage_seconds_count{route="/analyze/label/raw",stage="clahe"}' in text
+        assert 'truetag_stage_seconds_count{route="/analyze/trust",stage="features"}' in text
+        assert 'truetag_label_keypoints_bucket{route="/analyze/label/raw",le="+Inf"}' in text
+        assert 'truetag_cascade_stage_total{cascade_stage="coarse",route="/analyze/label/raw"}' in text
+        assert 'truetag_cascade_stage_total{cascade_stage="full",route="/analyze/label/raw"}' in text
+        assert 'truetag_requests_total{route="/analyze/trust",status="200"}' in text
+        assert "truetag_trust_batch_size_count" in text
+    finally:
+        pool.shutdown()
+
+def test_metrics_render_full_precision():
+    """Test that counters, gauges and histogram sums keep every digit."""
+    registry = MetricsRegistry()
+    registry.inc("requests_total", {"route": "/"}, value=1234567)
+    registry.inc("bytes_total", value=0.1)
+    registry.inc("bytes_total", value=0.2)
+    registry.register_callback("cache_entries", "gauge", lambda: {(): 9876543210})
+    registry.histogram("latency_seconds").observe(1.23456789012)
+    lines = registry.render().splitlines()
+    assert 'truetag_requests_total{route="/"} 1234567' in lines
+    assert "truetag_bytes_total 0.30000000000000004" in lines
+    assert "truetag_cache_entries 9876543210" in lines
+    assert "truetag_latency_seconds_sum 1.23456789012" in lines
+    assert 'truetag_latency_seconds_bucket{le="0.0005"} 0' in lines
+
 def test_trust_score():
     """Test the trust score endpoint."""
     request_data = {
         "productId": "TEST123",
         "userId": "USER456",
         "activationTime": datetime.now().isoformat(),
-        "returnAttempts": 0,
-        "image": SAMPLE_IMAGE_BASE64
+        "returnAttempts": 0
     }
     
     response = client.post("/analyze/trust", json=request_data)
@@ -70,8 +631,7 @@ def test_trust_score_high_risk():
         "productId": "TEST123",
         "userId": "USER456",
         "activationTime": datetime.now().isoformat(),  # Just activated
-        "returnAttempts": 3,  # Multiple attempts
-        "image": SAMPLE_IMAGE_BASE64
+        "returnAttempts": 3  # Multiple attempts
     }
     
     response = client.post("/analyze/trust", json=request_data)
@@ -87,8 +647,7 @@ def test_trust_score_low_risk():
         "productId": "TEST123",
         "userId": "USER456",
         "activationTime": (datetime.now() - timedelta(days=14)).isoformat(),  # 2 weeks ago
-        "returnAttempts": 0,  # First attempt
-        "image": SAMPLE_IMAGE_BASE64
+        "returnAttempts": 0  # First attempt
     }
     
     response = client.post("/analyze/trust", json=request_data)
@@ -97,5 +656,608 @@ def test_trust_score_low_risk():
     data = response.json()
     assert data["riskLevel"] == "low"
 
+def test_batch_trust_scores_match_per_row():
+    """Test that the vectorized batch path matches per-row scoring exactly."""
+    rng = np.random.default_rng(0)
+    scorer = TrustScorer()
+    now = datetime.now()
+    training = [
+        {
+            "activation_time": now - timedelta(hours=float(hours)),
+            "return_timestamp": now,
+            "return_attempts": int(attempts),
+            "label_match_score": float(score)
+        }
+        for hours, attempts, score in zip(rng.uniform(1, 1000, 200), rng.integers(0, 3, 200), rng.uniform(0, 1, 200))
+    ]
+    scorer.train(training)
+
+    columns = ([row["activation_time"] for row in training], [now] * len(training),
+               [row["return_attempts"] for row in training], [row["label_match_score"] for row in training])
+    batch = scorer.calculate_trust_scores(*columns)
+    per_row = [scorer.calculate_trust_score(*row) for row in zip(*columns)]
+    assert batch == per_row
+
+def test_batch_trust_scores_isolate_bad_rows():
+    """Test that a row that cannot be scored fails alone, and aware timestamps count as UTC."""
+    scorer = TrustScorer()
+    now = datetime.now()
+    scorer.train([
+        {"activation_time": now - timedelta(hours=hours), "return_timestamp": now, "return_attempts": hours % 3}
+        for hours in range(1, 200)
+    ])
+    activated = now - timedelta(days=3)
+    columns = (
+        [activated, activated.replace(tzinfo=timezone.utc), None, activated],
+        [now] * 4,
+        [0, 0, 0, "many"],
+        [0.9] * 4
+    )
+    batch = scorer.calculate_trust_scores(*columns)
+    assert "error" not in batch[0] and batch[1] == batch[0]
+    assert "error" in batch[2] and "error" in batch[3]
+    assert batch[2]["riskFactors"] == ["Error in trust calculation"]
+    assert batch[:2] == [scorer.calculate_trust_score(*row) for row in list(zip(*columns))[:2]]
+
+def test_trust_score_batch_endpoint():
+    """Test the batch trust score endpoint."""
+    activation_times = [datetime.now().isoformat(), (datetime.now() - timedelta(days=14)).isoformat()]
+    request_data = {
+        "productIds": ["TEST1", "TEST2"],
+        "userIds": ["USER1", "USER2"],
+        "activationTimes": activation_times,
+        "returnAttempts": [3, 0]
+    }
+    response = client.post("/analyze/trust/batch", json=request_data)
+    assert response.status_code == 200
+
+    results = response.json()["results"]
+    assert [result["productId"] for result in results] == ["TEST1", "TEST2"]
+    assert results[0]["riskLevel"] == "high"
+
+    request_data["userIds"] = ["USER1"]
+    assert client.post("/analyze/trust/batch", json=request_data).status_code == 400
+
+def test_compiled_forest_is_bit_identical():
+    """Test that the compiled forest reproduces sklearn's scores exactly."""
+    from sklearn.ensemble import IsolationForest
+    rng = np.random.default_rng(0)
+    X = np.column_stack([rng.exponential(200, 3000), rng.integers(0, 4, 3000), rng.uniform(0, 1, 3000)])
+    model = IsolationForest(contamination=0.1, random_state=42).fit(X[:1000])
+    compiled = CompiledIsolationForest(model)
+
+    assert np.array_equal(compiled.score_samples(X), model.score_samples(X))
+    assert np.array_equal(compiled.predict(X), model.predict(X))
+    for row in X[:20]:
+        assert np.array_equal(compiled.score_samples(row[None, :]), model.score_samples(row[None, :]))
+
+def test_trust_batcher_batches_concurrent_requests():
+    """Test that concurrent requests share one model call and match per-row scores."""
+    scorer = TrustScorer()
+    now = datetime.now()
+    scorer.train([
+        {"activation_time": now - timedelta(hours=hours), "return_timestamp": now, "return_attempts": hours % 3}
+        for hours in range(1, 200)
+    ])
+    batcher = TrustBatcher(scorer, max_batch_size=64, window=0.05)
+    requests = [(now - timedelta(hours=hours), now, hours % 2, 0.5 + hours / 40) for hours in range(1, 21)]
+
+    async def scenario():
+        return await asyncio.gather(*(batcher.score(*request) for request in requests))
+
+    results = asyncio.run(scenario())
+    assert results == [scorer.calculate_trust_score(*request) for request in requests]
+    assert batcher.batch_sizes.count == 1
+    assert batcher.batch_sizes.sum == len(requests)
+
+def test_incremental_trainer_refits_on_drift(tmp_path):
+    """Test that drifting scored rows trigger a validated refit that replaces the model file."""
+    path = str(tmp_path / "trust.pkl")
+    rng = np.random.default_rng(0)
+    scores = np.full(64, 0.9)
+
+    def scored_rows(mean_hours: float) -> np.ndarray:
+        return np.column_stack([rng.gamma(2, mean_hours / 2, 64), rng.poisson(0.3, 64), np.ones(64)])
+
+    options = dict(reservoir_rows=2000, min_rows=500, min_interval=0, drift_window=1000, baseline_rows=1000)
+    trainer = IncrementalTrainer(path, retrain_rows=10 ** 6, **options)
+    for _ in range(40):
+        trainer.add(scored_rows(200), scores)
+    assert trainer.due() is None and max(trainer.stats()["drift"].values()) < 0.05
+
+    # Products start coming back ten times later
+    for _ in range(40):
+        trainer.add(scored_rows(2000), scores)
+        if trainer.due():
+            break
+    assert trainer.due() == "drift"
+    assert trainer.stats()["drift"]["hours_since_activation"] >= 0.2
+    record = trainer.retrain("drift")
+    assert record["outcome"] == "saved" and record["sampled"] == 2000
+    assert TrustScorer(model_path=path).fitted
+    assert trainer.stats()["rows"] == 0 and trainer.stats()["drift"] is None
+    # Its own model is no reason to start over
+    assert not trainer.check_model()
+
+    # A model saved by another trainer resets the rows and the drift baseline
+    for _ in range(20):
+        trainer.add(scored_rows(2000), scores)
+    assert trainer.stats()["rows"] == 1280
+    other = TrustScorer()
+    other.fit(np.column_stack([rng.gamma(2, 100, 512), rng.poisson(0.3, 512), np.ones(512)]))
+    other.save_model(path)
+    assert trainer.check_model()
+    assert trainer.stats()["rows"] == 0 and trainer.stats()["replaced"] == 1
+
+    # The rows budget forces a refit; one that moves canary scores too far is not saved
+    strict = IncrementalTrainer(path, retrain_rows=640, max_score_shift=1e-9, **options)
+    for _ in range(10):
+        strict.add(np.column_stack([rng.gamma(2, 2, 64), rng.poisson(3, 64), np.full(64, 0.3)]), scores)
+    assert strict.due() == "rows"
+    modified = os.stat(path).st_mtime_ns
+    assert strict.retrain("rows")["outcome"] == "rejected"
+    assert os.stat(path).st_mtime_ns == modified and strict.stats()["rows"] == 640
+
+def test_background_trainer_saves_model_from_scored_rows(tmp_path):
+    """Test that batches scored through the batcher reach the training process, which saves a model."""
+    path = str(tmp_path / "trust.pkl")
+    scorer = TrustScorer()
+    now = datetime.now()
+    scorer.train([
+        {"activation_time": now - timedelta(hours=hours), "return_timestamp": now, "return_attempts": 0}
+        for hours in range(1, 200)
+    ])
+    trainer = BackgroundTrainer(path, min_rows=200, retrain_rows=256, min_interval=0)
+    trainer.start()
+    try:
+        batcher = TrustBatcher(scorer, max_batch_size=64, observer=trainer.submit)
+
+        async def scenario():
+            await asyncio.gather(*(batcher.score(now - timedelta(hours=h), now, 0, 1.0) for h in range(48, 348)))
+
+        asyncio.run(scenario())
+        deadline = time.monotonic() + 60
+        while not trainer.status.get("saved") and time.monotonic() < deadline:
+            time.sleep(0.1)
+            trainer.poll()
+        stats = trainer.stats()
+    finally:
+        trainer.stop()
+    assert stats["submittedRows"] == 300 and stats["droppedRows"] == 0
+    assert stats["saved"] == 1 and stats["lastRetrain"]["reason"] == "rows"
+    assert stats["trainSeconds"]["count"] == 1
+    assert TrustScorer(model_path=path).fitted and not trainer.running
+
+def test_trainer_lock_elects_one_trainer(tmp_path):
+    """Test that only one process trains a model path, and another takes over when it stops."""
+    path = str(tmp_path / "models" / "trust.pkl")
+    lock = acquire_trainer_lock(path)
+    assert lock is not None and acquire_trainer_lock(path) is None
+    lock.close()
+
+    trainers = [BackgroundTrainer(path), BackgroundTrainer(path)]
+
+    def poll_until(condition):
+        deadline = time.monotonic() + 60
+        while not condition():
+            assert time.monotonic() < deadline
+            time.sleep(0.1)
+            for trainer in trainers:
+                trainer.poll()
+
+    for trainer in trainers:
+        trainer.start()
+    try:
+        poll_until(lambda: all("elected" in trainer.status for trainer in trainers))
+        leader, standby = sorted(trainers, key=lambda trainer: not trainer.status["elected"])
+        assert leader.status["elected"] and not standby.status["elected"]
+        # A standby's rows are not sent to its process
+        standby.submit(np.ones((4, 3)), np.ones(4))
+        assert standby.submitted == 0
+
+        # The standby takes over once the trainer's process has exited
+        leader.stop()
+        poll_until(lambda: standby.status["elected"])
+    finally:
+        for trainer in trainers:
+            trainer.stop()
+
+def test_trust_batcher_isolates_failing_requests():
+    """Test that a request that cannot be scored fails alone, not the requests batched with it."""
+    class FailingScorer(TrustScorer):
+        def calculate_trust_scores(self, *columns, **kwargs):
+            if "BAD" in columns[4]:
+                raise RuntimeError("history lookup failed")
+            return super().calculate_trust_scores(*columns, **kwargs)
+
+    scorer = FailingScorer()
+    now = datetime.now()
+    scorer.train([
+        {"activation_time": now - timedelta(hours=hours), "return_timestamp": now, "return_attempts": 0}
+        for hours in range(1, 200)
+    ])
+    batcher = TrustBatcher(scorer, max_batch_size=64, window=0.05)
+    requests = [(now - timedelta(days=days), now, 0, 0.9, f"USER{days}") for days in range(1, 6)]
+
+    async def scenario(bad_request):
+        return await asyncio.gather(*(batcher.score(*request) for request in [*requests, bad_request]),
+                                    return_exceptions=True)
+
+    # A row that cannot be turned into features
+    *good, bad = asyncio.run(scenario((None, now, 0, 0.9, "USER0")))
+    assert "error" in bad and not any("error" in result for result in good)
+    # A failure of the whole batch call
+    *good, bad = asyncio.run(scenario((now, now, 0, 0.9, "BAD")))
+    assert isinstance(bad, RuntimeError)
+    assert good == [scorer.calculate_trust_score(*request) for request in requests]
+    assert batcher.batch_sizes.count == 2
+
+def test_trust_batcher_keeps_error_rows_in_one_call():
+    """Test that a batch whose rows all come back as errors is not scored again row by row."""
+    class CountingScorer(TrustScorer):
+        calls = 0
+
+        def calculate_trust_scores(self, *columns, **kwargs):
+            CountingScorer.calls += 1
+            return super().calculate_trust_scores(*columns, **kwargs)
+
+    # Never trained, so every row gets an error result
+    batcher = TrustBatcher(CountingScorer(), max_batch_size=64, window=0.05)
+    now = datetime.now()
+
+    async def scenario():
+        return await asyncio.gather(*(batcher.score(now - timedelta(days=days), now, 0, 0.9) for days in range(1, 6)))
+
+    results = asyncio.run(scenario())
+    assert all("error" in result for result in results)
+    assert CountingScorer.calls == 1
+
+def test_trust_batcher_flushes_lone_request():
+    """Test that a lone request is scored after one window, without waiting for a full batch."""
+    batcher = TrustBatcher(TrustScorer(), max_batch_size=64, window=0.01)
+    result = asyncio.run(batcher.score(datetime.now(), datetime.now(), 0, 1.0))
+    assert "trustScore" in result
+    assert batcher.wait_times.sum < 0.5
+
+def test_return_history_store(tmp_path):
+    """Test rolling return aggregates, eviction and snapshot restore."""
+    path = str(tmp_path / "history.npz")
+    store = ReturnHistoryStore(path, max_entities=64)
+    now = datetime.now()
+    for days_ago, score in ((40, 0.2), (20, 0.4), (3, 0.6), (0, 0.8)):
+        returned = now - timedelta(days=days_ago)
+        store.record("USER1", "PROD1", returned, returned - timedelta(hours=30), score)
+
+    returns_7d, returns_30d, mean_label, median_hours, product_30d = store.features(["USER1"], ["PROD1"], [now])[0]
+    assert (returns_7d, returns_30d, product_30d) == (2, 3, 3)
+    assert mean_label == pytest.approx(0.5)
+    assert 24 < median_hours < 48
+
+    store.save()
+    assert os.listdir(os.path.dirname(path)) == [os.path.basename(path)]
+    restored = ReturnHistoryStore(path, max_entities=64)
+    assert np.array_equal(restored.features(["USER1", "NOBODY"], ["PROD1", None], [now, now]),
+                          store.features(["USER1", "NOBODY"], ["PROD1", None], [now, now]))
+
+    # Filling the store evicts the least recently updated users
+    for i in range(100):
+        store.record(f"USER{i + 2}", "PROD2", now, now, 1.0)
+    assert len(store.users) <= 64
+    assert store.stats()["evictions"] > 0
+
+def test_trust_scorer_uses_history_features():
+    """Test that history features reach the model and batch scoring still matches per-row."""
+    store = ReturnHistoryStore(max_entities=64)
+    scorer = TrustScorer(history=store)
+    now = datetime.now()
+    scorer.train([
+        {"activation_time": now - timedelta(hours=hours), "return_timestamp": now, "return_attempts": hours % 3}
+        for hours in range(1, 200)
+    ])
+    assert scorer.model.n_features_in_ == 3 + len(HISTORY_FEATURES)
+
+    store.record("USER1", "PROD1", now, now - timedelta(hours=2), 0.3)
+    rows = [(now - timedelta(hours=5), now, 1, 0.9, None, "USER1", "PROD1"),
+            (now - timedelta(hours=50), now, 0, 0.9, None, "USER2", "PROD2")]
+    per_row = [scorer.calculate_trust_score(*row) for row in rows]
+    batch = scorer.calculate_trust_scores(*[list(column) for column in zip(*rows)][:4],
+                                          user_ids=["USER1", "USER2"], product_ids=["PROD1", "PROD2"])
+    assert batch == per_row
+
+def test_photo_index_matches_brute_force(tmp_path):
+    """Test near-duplicate lookups over merged and unmerged entries, and snapshot restore."""
+    rng = np.random.default_rng(0)
+    path = str(tmp_path / "photos.npz")
+    index = PhotoIndex(path, max_distance=7, tail_size=500)
+    hashes = rng.integers(0, 2**64, 3000, dtype=np.uint64)
+    for i, photo_hash in enumerate(hashes):
+        index.add(int(photo_hash), f"USER{i}", f"PROD{i}")
+    index.compact()
+    for photo_hash in hashes[:200]:
+        index.add(int(photo_hash) ^ 0b10110, "USER0", "PROD0")
+    assert 0 < index.stats()["unmerged"] < 500
+
+    stored = np.concatenate([hashes, hashes[:200] ^ np.uint64(0b10110)])
+    for _ in range(200):
+        photo_hash = int(hashes[rng.integers(len(hashes))])
+        for bit in rng.choice(64, rng.integers(0, 8), replace=False):
+            photo_hash ^= 1 << int(bit)
+        expected = np.sort(hamming_distances(stored, photo_hash))
+        assert [match["distance"] for match in index.query(photo_hash, limit=len(stored))] == \
+            [int(d) for d in expected[expected <= 7]]
+
+    # Rescans of the same return are not counted; other products and users are
+    photo_hash = int(hashes[2500])
+    assert index.record(photo_hash ^ 1, "USER2500", "PROD2500") == 0
+    assert index.record(photo_hash, None, "PROD2500") == 0
+    assert index.record(photo_hash, "USER9", "PROD2500") == 2
+    assert index.record(photo_hash, None, "PROD6") == 4
+
+    index.save()
+    restored = PhotoIndex(path, max_distance=7)
+    assert len(restored) == len(index)
+    assert restored.query(photo_hash) == index.query(photo_hash)
+
+def test_reused_photo_lowers_trust_score(monkeypatch):
+    """Test that a photo submitted for another return is flagged as a risk factor."""
+    monkeypatch.setattr(app_module, "photo_index", PhotoIndex(path=None))
+    products = FakeProductCollection([
+        {"_id": product_id, "labelCoordinates": SAMPLE_COORDINATES} for product_id in ("PROD1", "PROD2")
+    ])
+    monkeypatch.setattr(app_module, "label_coordinates", LabelCoordinateStore(products))
+    scorer = TrustScorer()
+    now = datetime.now()
+    scorer.train([
+        {"activation_time": now - timedelta(hours=hours), "return_timestamp": now, "return_attempts": 0}
+        for hours in range(48, 300)
+    ])
+    monkeypatch.setattr(app_module.trust_batcher, "scorer", scorer)
+
+    # Recompressing and resizing a photo keeps its hash within the match distance
+    photo = cv2.imdecode(np.frombuffer(make_label_image(seed=7), np.uint8), cv2.IMREAD_GRAYSCALE)
+    resized = cv2.imdecode(cv2.imencode(".jpg", cv2.resize(photo, (300, 240)))[1], cv2.IMREAD_GRAYSCALE)
+    assert bin(perceptual_hash(photo) ^ perceptual_hash(resized)).count("1") <= 6
+
+    def submit(product_id: str, user_id: str) -> dict:
+        return client.post("/analyze/trust/upload", data={
+            "productId": product_id,
+            "userId": user_id,
+            "activationTime": (now - timedelta(days=5)).isoformat(),
+            "returnAttempts": 0
+        }, files={"image": ("label.png", make_label_image(seed=7), "image/png")}).json()
+
+    assert "Photo reused from another return" not in submit("PROD1", "USER1")["riskFactors"]
+    assert "Photo reused from another return" not in submit("PROD1", "USER1")["riskFactors"]
+    assert "Photo reused from another return" in submit("PROD2", "USER2")["riskFactors"]
+
+    label = client.post("/analyze/label/raw", params={"productId": "PROD3", **SAMPLE_COORDINATES},
+                        content=make_label_image(seed=7)).json()
+    assert label["photoMatches"] == 3
+    assert client.get("/photos/index/stats").json()["entries"] == 4
+
+    # Batch scoring applies the same rule
+    columns = ([now - timedelta(days=5)] * 2, [now] * 2, [0, 0], [0.9, 0.9], [None, None], [None, None], [0, 2])
+    batch = scorer.calculate_trust_scores(*columns)
+    assert batch == [scorer.calculate_trust_score(*row[:4], None, *row[4:]) for row in zip(*columns)]
+    assert batch[1]["trustScore"] == pytest.approx(batch[0]["trustScore"] * 0.5)
+
+def test_streaming_training(tmp_path):
+    """Test chunked training: vectorized features match the per-row path and the sample is bounded."""
+    now = datetime(2024, 1, 1)
+    rows = [{
+        "productId": f"PROD{i}",
+        "activation_time": (now - timedelta(hours=i % 500, minutes=i % 7)).isoformat(),
+        "return_timestamp": now.isoformat(),
+        "return_attempts": i % 4,
+        "label_match_score": (i % 10) / 10
+    } for i in range(2000)]
+    path = tmp_path / "returns.jsonl"
+    path.write_text("\n".join(json.dumps(row) for row in rows))
+
+    chunks = list(read_chunks(str(path), chunk_size=300))
+    assert [len(chunk) for chunk in chunks] == [300] * 6 + [200]
+    scorer = TrustScorer()
+    expected = np.vstack([scorer._extract_features(datetime.fromisoformat(row["activation_time"]),
+                                                   datetime.fromisoformat(row["return_timestamp"]),
+                                                   row["return_attempts"], row["label_match_score"])
+                          for row in rows[:300]])
+    assert np.allclose(frame_features(chunks[0]), expected)
+
+    scorer.model.set_params(n_estimators=4)
+    stats = train_streaming(scorer, chunks)
+    assert stats["rows"] == 2000
+    assert stats["sampled"] == 4 * 256
+    assert scorer.model.max_samples_ == 256
+    assert "trustScore" in scorer.calculate_trust_score(now - timedelta(hours=3), now, 0, 0.9)
+
+    # Every row is equally likely to end up in the reservoir
+    counts = np.zeros(1000)
+    for seed in range(200):
+        reservoir = ReservoirSample(100, 1, random_state=seed)
+        for start in range(0, 1000, 64):
+            reservoir.add(np.arange(start, min(start + 64, 1000), dtype=np.float64)[:, None])
+        assert len(np.unique(reservoir.sample())) == 100
+        counts[reservoir.sample()[:, 0].astype(int)] += 1
+    assert abs(counts[:500].sum() - counts[500:].sum()) < 0.1 * counts.sum()
+
+def test_synthetic_generator_streams_reproducibly(tmp_path):
+    """Test that generated returns are seeded, chunked and readable by the training pipeline."""
+    now = datetime(2024, 1, 1)
+    generator = SyntheticDataGenerator(25000, fraud_ratio=0.3, seed=7, chunk_size=10000, now=now)
+    chunks = list(generator.return_data_chunks())
+    assert [len(chunk) for chunk in chunks] == [10000, 10000, 5000]
+    frame = pd.concat(chunks, ignore_index=True)
+    assert frame.equals(pd.concat(SyntheticDataGenerator(25000, 0.3, 7, 10000, now).return_data_chunks(),
+                                  ignore_index=True))
+    assert frame["productId"].is_unique
+    assert abs((~frame["is_legitimate"]).mean() - 0.3) < 0.02
+    assert (frame.loc[~frame["is_legitimate"], "return_attempts"] >= 2).all()
+
+    for name in ("returns.jsonl", "returns.csv"):
+        path = str(tmp_path / name)
+        assert write_chunks(generator.return_data_chunks(), path) == 25000
+        read = list(read_chunks(path, chunk_size=10000))
+        assert sum(len(chunk) for chunk in read) == 25000
+        assert np.allclose(frame_features(read[0]), frame_features(chunks[0]))
+
+    rows = SyntheticDataGenerator(10, seed=1).generate_return_data()
+    assert len(rows) == 10 and datetime.fromisoformat(rows[0]["activation_time"])
+    positions = SyntheticDataGenerator(10, seed=1).generate_label_positions()
+    assert set(positions[0]["labelPosition"]) == {"x", "y", "width", "height"}
+
+def test_saved_compiled_forest_is_memory_mapped(tmp_path):
+    """Test that a saved model reloads its compiled forest from a shared mapping, and detects staleness."""
+    now = datetime.now()
+    training = [{"activation_time": now - timedelta(hours=hours), "return_timestamp": now, "return_attempts": hours % 3}
+                for hours in range(1, 300)]
+    scorer = TrustScorer()
+    scorer.train(training)
+    path = str(tmp_path / "trust.pkl")
+    scorer.save_model(path)
+
+    loaded = TrustScorer(model_path=path)
+    assert isinstance(loaded.predictor.threshold, np.memmap)
+    assert loaded._model is None  # not needed for scoring
+    X = np.array([[1.0, 0, 0.9], [500.0, 2, 0.3]])
+    assert np.array_equal(loaded.predictor.score_samples(X), scorer.model.score_samples(X))
+
+    # A model file replaced without its compiled forest is compiled afresh
+    other = TrustScorer()
+    other.model.set_params(random_state=7)
+    other.train(training)
+    joblib.dump(other.model, path)
+    assert not isinstance(TrustScorer(model_path=path).predictor.threshold, np.memmap)
+
+def test_trust_model_reload(tmp_path):
+    """Test that a reload validates the candidate and swaps it in, and a bad model keeps the old one."""
+    now = datetime.now()
+    path = str(tmp_path / "trust.pkl")
+    first = TrustScorer()
+    first.train([{"activation_time": now - timedelta(hours=hours), "return_timestamp": now,
+                  "return_attempts": hours % 3} for hours in range(1, 300)])
+    first.save_model(path)
+
+    serving = {"scorer": TrustScorer()}
+    reloader = TrustModelReloader(path,
+                                  load=lambda model_path: TrustScorer(model_path=model_path),
+                                  install=lambda scorer: serving.update(scorer=scorer),
+                                  current=lambda: serving["scorer"],
+                                  poll_interval=0)
+    result = asyncio.run(reloader.reload())
+    assert result["canarySize"] == len(canary_batch()[0])
+    assert serving["scorer"] is not first and serving["scorer"].fitted
+    assert reloader.stats()["version"] == 2
+
+    installed = serving["scorer"]
+    joblib.dump(IsolationForest(), path)
+    with pytest.raises(ModelValidationError):
+        asyncio.run(reloader.reload())
+    assert serving["scorer"] is installed
+    assert reloader.stats()["failures"] == 1
+
+def test_trust_reload_endpoint_without_model():
+    """Test that reloading without TRUST_MODEL_PATH is a 404 and stats are served."""
+    if app_module.trust_reloader.model_path:
+        pytest.skip("TRUST_MODEL_PATH is set")
+    assert client.post("/admin/trust/reload").status_code == 404
+    assert client.get("/trust/model/stats").json()["version"] == 1
+
+def test_readiness_after_warm_up(monkeypatch):
+    """Test that readiness fails until the warm-up pass has started the vision workers."""
+    pool = VisionPool(max_workers=2)
+    monkeypatch.setattr(app_module, "vision_pool", pool)
+    monkeypatch.setattr(app_module, "warm_up_state", {"ready": False, "seconds": None, "visionWorkers": 0, "error": None})
+    assert client.get("/health/live").status_code == 200
+    assert client.get("/health/ready").status_code == 503
+
+    async def scenario():
+        warm_up = asyncio.ensure_future(app_module.warm_up())
+        seen = set()
+        while not warm_up.done():
+            seen.add(pool.in_flight)
+            await asyncio.sleep(0.01)
+        # Warm-up jobs occupy the workers, so they count against the capacity
+        assert max(seen) == 2
+
+    try:
+        asyncio.run(scenario())
+        assert pool.in_flight == 0
+        response = client.get("/health/ready")
+        assert response.status_code == 200
+        assert response.json()["warmUp"]["visionWorkers"] == 2
+        assert response.json()["warmUp"]["error"] is None
+    finally:
+        pool.shutdown()
+
+def test_app_import_skips_pymongo():
+    """Test that importing the app loads pymongo only once a database is configured."""
+    env = {key: value for key, value in os.environ.items() if key != "MONGODB_URI"}
+    code = "import sys, app; assert 'pymongo' not in sys.modules"
+    subprocess.run([sys.executable, "-c", code], cwd=os.path.dirname(os.path.dirname(__file__)), env=env, check=True)
+
+def test_vision_pool_rejects_when_saturated():
+    """Test that a full vision pool sheds load instead of queueing."""
+    pool = VisionPool(max_workers=1, queue_depth=0, timeout=5)
+
+    async def scenario():
+        slow = asyncio.ensure_future(pool.run(time.sleep, 0.5))
+        await asyncio.sleep(0.05)
+        with pytest.raises(PoolSaturatedError):
+            await pool.run(time.sleep, 0)
+        await slow
+
+    try:
+        asyncio.run(scenario())
+        assert pool.in_flight == 0
+    finally:
+        pool.shutdown()
+
+def test_vision_pool_timeout():
+    """Test that slow vision jobs time out."""
+    pool = VisionPool(max_workers=1, queue_depth=1, timeout=0.2)
+    try:
+        with pytest.raises(PoolTimeoutError):
+            asyncio.run(pool.run(time.sleep, 2))
+    finally:
+        pool.shutdown()
+
+def test_vision_pool_restarts_after_worker_crash(monkeypatch):
+    """Test that a dead worker gets a retryable 503 and the next job runs on fresh workers."""
+    pool = VisionPool(max_workers=1, queue_depth=1, timeout=10)
+    monkeypatch.setattr(app_module, "vision_pool", pool)
+
+    async def scenario():
+        first_pid = await pool.run(os.getpid)
+        with pytest.raises(HTTPException) as crash:
+            await app_module.run_vision_job(os._exit, 1)
+        return first_pid, crash.value, await pool.run(os.getpid)
+
+    try:
+        first_pid, crash, pid = asyncio.run(scenario())
+        assert crash.status_code == 503 and crash.headers["Retry-After"] == "1"
+        assert pid != first_pid
+        assert pool.in_flight == 0
+    finally:
+        pool.shutdown()
+
+def test_benchmark_regression_check():
+    """Test that the benchmark comparison flags only regressions beyond the thresholds."""
+    def run(p50_ms, p99_ms, throughput, peak_memory_mb):
+        return {"cases": {"case": {"p50_ms": p50_ms, "p99_ms": p99_ms,
+                                   "throughput": throughput, "peak_memory_mb": peak_memory_mb}}}
+
+    baseline = run(10.0, 20.0, 100.0, 5.0)
+    assert not any(row["regression"] for row in compare(run(11.0, 25.0, 95.0, 5.5), baseline))
+
+    regressed = {row["metric"] for row in compare(run(15.0, 35.0, 60.0, 8.0), baseline) if row["regression"]}
+    assert regressed == {"p50_ms", "p99_ms", "throughput", "peak_memory_mb"}
+
+    # Sub-noise-floor latency changes never count, however large relative to the baseline
+    tiny = compare(run(0.05, 0.1, 100.0, 5.0), run(0.01, 0.02, 100.0, 5.0))
+    assert not any(row["regression"] for row in tiny)
+
+    # Cases missing from the baseline are skipped
+    assert compare(run(10.0, 20.0, 100.0, 5.0), {"cases": {}}) == []
+
 if __name__ == "__main__":
     pytest.main([__file__])
\ No newline at end of file
@@ -0,0 +1,156 @@
+import asyncio
+import os
+import time
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from metrics import NULL_TIMER, Histogram, StageTimer
+from trust_scorer import TrustScorer
+
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+WAIT_BUCKETS = (0.0005, 0.001, 0.002, 0.005, 0.01, 0.025, 0.05, 0.1)
+
+
+class TrustBatcher:
+    """
+    Micro-batcher for single trust score requests.
+
+    Concurrent requests are collected until the batch is full or the window
+    since the first one has passed, then scored with one model call. A lone
+    request waits at most one window; the model call runs in a thread so
+    the next batch keeps collecting meanwhile. A request that cannot be
+    scored fails alone: a bad row gets its own error result, and only if
+    the batch call raises is each request scored again on its own.
+    """
+
+    def __init__(self,
+                 scorer: TrustScorer,
+                 max_batch_size: Optional[int] = None,
+                 window: Optional[float] = None,
+                 observer: Optional[Callable[[np.ndarray, np.ndarray], None]] = None):
+        """
+        Args:
+            scorer: Trust scorer that runs the batches
+            max_batch_size: Requests per model call (default: TRUST_MICROBATCH_SIZE or 64)
+            window: Seconds to wait for more requests after the first
+                (default: TRUST_MICROBATCH_WINDOW_MS / 1000, or 2 ms)
+            observer: Gets the features and trust scores of every batch
+                (see TrustScorer.calculate_trust_scores)
+        """
+        if max_batch_size is None:
+            max_batch_size = int(os.getenv("TRUST_MICROBATCH_SIZE", 64))
+        if window is None:
+            window = float(os.getenv("TRUST_MICROBATCH_WINDOW_MS", 2)) / 1000
+
+        self.scorer = scorer
+        self.max_batch_size = max(1, max_batch_size)
+        self.window = max(0.0, window)
+        self.observer = observer
+
+        self.batch_sizes = Histogram(BATCH_SIZE_BUCKETS)
+        self.wait_times = Histogram(WAIT_BUCKETS)
+
+        # (enqueue time, scorer arguments, future, timer) of the batch being collected
+        self._pending: List[Tuple[float, Tuple, asyncio.Future, StageTimer]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+    async def score(self,
+                    activation_time: datetime,
+                    return_timestamp: datetime,
+                    return_attempts: int,
+                    label_match_score: float,
+                    user_id: Optional[str] = None,
+                    product_id: Optional[str] = None,
+                    photo_matches: int = 0,
+                    timer: StageTimer = NULL_TIMER) -> Dict:
+        """
+        Same as TrustScorer.calculate_trust_score, scored as part of a batch.
+
+        The timer gets the time spent waiting for the batch to fill
+        ("trust_queue") and the stage timings of the whole batch.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((
+            time.perf_counter(),
+            (activation_time, return_timestamp, return_attempts, label_match_score, user_id, product_id,
+             photo_matches),
+            future,
+            timer
+        ))
+
+        if len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._flush)
+        result = await future
+        timer.skip()
+        return result
+
+    def _flush(self):
+        """Start scoring the collected batch."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+
+        now = time.perf_counter()
+        self.batch_sizes.observe(len(batch))
+        for enqueued, _, _, timer in batch:
+            self.wait_times.observe(now - enqueued)
+            timer.add("trust_queue", now - enqueued)
+        asyncio.ensure_future(self._run(batch))
+
+    async def _run(self, batch: List[Tuple[float, Tuple, asyncio.Future, StageTimer]]):
+        columns = list(zip(*(arguments for _, arguments, _, _ in batch)))
+        timed = any(timer.enabled for _, _, _, timer in batch)
+        batch_timer = StageTimer() if timed else NULL_TIMER
+        failed = False
+        try:
+            # Bad rows come back as error results and fail alone
+            results = await asyncio.to_thread(self.scorer.calculate_trust_scores, *columns,
+                                              timer=batch_timer, observer=self.observer)
+        except Exception:
+            # Score each request on its own, so the one that broke the batch
+            # fails alone and the others still get their scores
+            failed = True
+            results = await asyncio.to_thread(self._score_each, batch)
+
+        if timed:
+            state = dict(batch_timer.state(), error=None) if failed else batch_timer.state()
+            for _, _, _, timer in batch:
+                timer.merge(state)
+        for (_, _, future, timer), result in zip(batch, results):
+            if isinstance(result, Exception):
+                timer.fail(type(result).__name__)
+            # The caller may have been cancelled while the batch ran
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    def _score_each(self, batch: List[Tuple[float, Tuple, asyncio.Future, StageTimer]]) -> List:
+        """Result or exception of each request of a batch, scored as a batch of one."""
+        results = []
+        for _, arguments, _, _ in batch:
+            try:
+                results.append(self.scorer.calculate_trust_scores(*([value] for value in arguments),
+                                                                  observer=self.observer)[0])
+            except Exception as e:
+                results.append(e)
+        return results
+
+    def stats(self) -> Dict:
+        """Batch size and per-request wait time histograms."""
+        return {
+            "maxBatchSize": self.max_batch_size,
+            "windowSeconds": self.window,
+            "batchSize": self.batch_sizes.snapshot(),
+            "waitSeconds": self.wait_times.snapshot()
+        }
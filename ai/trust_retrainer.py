@@ -0,0 +1,465 @@
+import fcntl
+import multiprocessing
+import os
+import queue
+import signal
+import time
+from datetime import datetime
+from typing import IO, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from feature_store import HISTORY_FEATURES, ReturnHistoryStore
+from metrics import Histogram
+from model_reload import ModelValidationError, validate_scorer
+from trust_scorer import BASE_FEATURES, TrustScorer
+
+# Names of the model input columns, in TrustScorer._extract_features order
+FEATURE_NAMES = ("hours_since_activation", "return_attempts", "label_match_score") + tuple(HISTORY_FEATURES)
+# Baseline quantiles used as bin edges of each feature
+DRIFT_QUANTILES = np.linspace(0.1, 0.9, 9)
+# Fixed bin edges of the trust score
+SCORE_EDGES = np.linspace(0.1, 0.9, 9)
+# Floor of bin proportions, so an empty bin does not make the PSI infinite
+PSI_EPSILON = 1e-4
+# Refits take from a fraction of a second to minutes
+TRAIN_SECONDS_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+# Seconds between status reports of the training process
+STATUS_INTERVAL = 1.0
+
+
+def model_file_state(path: str) -> Optional[Tuple[int, int, int]]:
+    """Identity of the model file (inode, size, mtime), or None when it does not exist."""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+
+def acquire_trainer_lock(model_path: str) -> Optional[IO]:
+    """
+    Try to become the one trainer of model_path.
+
+    Takes an exclusive lock on <model_path>.trainer.lock without waiting. The
+    lock lasts as long as the returned file is open, and the kernel drops it
+    when the holding process dies.
+
+    Returns:
+        The open lock file, or None when another process holds the lock
+    """
+    directory = os.path.dirname(model_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    lock = open(model_path + ".trainer.lock", "a")
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock.close()
+        return None
+    return lock
+
+
+def population_stability(expected: np.ndarray, actual: np.ndarray) -> float:
+    """Population stability index between two bin proportion vectors."""
+    expected = np.maximum(expected, PSI_EPSILON)
+    actual = np.maximum(actual, PSI_EPSILON)
+    return float(np.sum((actual - expected) * np.log(actual / expected)))
+
+
+class DriftMonitor:
+    """
+    Population stability index (PSI) of each feature and of the trust score,
+    between a baseline and a window of recent rows.
+
+    The baseline is the first baseline_rows rows after a reset. Its deciles
+    become the bin edges of each feature, so a discrete feature gets one bin
+    per value, and trust scores use ten fixed bins over [0, 1]. After that a
+    chunk costs one searchsorted and one bincount per column. Window counts
+    decay by 1 - 1 / window per row, so older rows fade out.
+    """
+
+    def __init__(self, baseline_rows: int, window: int):
+        self.baseline_rows = baseline_rows
+        self.window = window
+        self.reset()
+
+    def reset(self):
+        self._buffer: List[np.ndarray] = []
+        self._buffered = 0
+        self.edges: Optional[List[np.ndarray]] = None
+        self.baseline: Optional[List[np.ndarray]] = None
+        self.counts: Optional[List[np.ndarray]] = None
+        # Rows added since the baseline was complete
+        self.rows = 0
+
+    @property
+    def ready(self) -> bool:
+        """Whether the window holds enough rows to compare with the baseline."""
+        return self.edges is not None and self.rows >= self.window
+
+    def _bin_counts(self, column: int, values: np.ndarray) -> np.ndarray:
+        edges = self.edges[column]
+        # Bins are (edge[i - 1], edge[i]], so each baseline value closes a bin
+        return np.bincount(np.searchsorted(edges, values, side="left"), minlength=len(edges) + 1)
+
+    def add(self, features: np.ndarray, scores: np.ndarray):
+        columns = np.column_stack([features, scores])
+        if self.edges is None:
+            self._buffer.append(columns)
+            self._buffered += len(columns)
+            if self._buffered < self.baseline_rows:
+                return
+            baseline = np.concatenate(self._buffer)
+            self._buffer = []
+            self.edges = [np.unique(np.quantile(column, DRIFT_QUANTILES)) for column in baseline.T[:-1]]
+            self.edges.append(SCORE_EDGES)
+            self.baseline = [
+                self._bin_counts(i, column) / len(column) for i, column in enumerate(baseline.T)
+            ]
+            self.counts = [np.zeros(len(edges) + 1) for edges in self.edges]
+            return
+
+        decay = (1 - 1 / self.window) ** len(columns)
+        for i, column in enumerate(columns.T):
+            self.counts[i] *= decay
+            self.counts[i] += self._bin_counts(i, column)
+        self.rows += len(columns)
+
+    def psi(self) -> Optional[np.ndarray]:
+        """PSI of each feature, then of the trust score; None until the window is full."""
+        if not self.ready:
+            return None
+        return np.array([
+            population_stability(baseline, counts / counts.sum())
+            for baseline, counts in zip(self.baseline, self.counts)
+        ])
+
+
+class IncrementalTrainer:
+    """
+    Refits the trust model from a reservoir sample of the rows it scored,
+    when their distribution drifts or enough of them have been scored.
+
+    The reservoir is a uniform sample of at most reservoir_rows of the rows
+    scored since the last saved model, so a refit costs the same however
+    much history has gone by. A candidate has to pass the canary check of a
+    hot reload before it replaces the model file; serving processes then
+    pick it up through their model file watcher.
+    """
+
+    def __init__(self,
+                 model_path: str,
+                 reservoir_rows: Optional[int] = None,
+                 retrain_rows: Optional[int] = None,
+                 min_rows: Optional[int] = None,
+                 min_interval: Optional[float] = None,
+                 drift_threshold: Optional[float] = None,
+                 drift_window: Optional[int] = None,
+                 baseline_rows: Optional[int] = None,
+                 max_score_shift: Optional[float] = None,
+                 random_state: int = 42):
+        """
+        Args:
+            model_path: Model file to replace
+            reservoir_rows: Rows sampled for a refit (default:
+                TRUST_RETRAIN_RESERVOIR_ROWS, or as many as the forest's trees draw)
+            retrain_rows: Rows scored after which the model is refitted even
+                without drift (default: TRUST_RETRAIN_ROWS or 100000)
+            min_rows: Rows scored before any refit (default: TRUST_RETRAIN_MIN_ROWS or 1000)
+            min_interval: Seconds between refits (default: TRUST_RETRAIN_MIN_SECONDS or 300)
+            drift_threshold: PSI of any feature or of the trust score that
+                counts as drift (default: TRUST_DRIFT_THRESHOLD or 0.2)
+            drift_window: Recent rows compared with the baseline (default:
+                TRUST_DRIFT_WINDOW or 5000)
+            baseline_rows: Rows after a saved model that form the drift
+                baseline (default: TRUST_DRIFT_BASELINE_ROWS or 5000)
+            max_score_shift: Largest accepted mean canary score change
+                (default: TRUST_RELOAD_MAX_SCORE_SHIFT or 0.5)
+        """
+        # Imported here: it loads sklearn, which only the training process needs
+        from trust_training import ReservoirSample, reservoir_size
+
+        self.model_path = model_path
+        self.reservoir_rows = reservoir_rows or int(
+            os.getenv("TRUST_RETRAIN_RESERVOIR_ROWS", 0)) or reservoir_size(TrustScorer().model)
+        self.retrain_rows = retrain_rows or int(os.getenv("TRUST_RETRAIN_ROWS", 100000))
+        self.min_rows = min_rows or int(os.getenv("TRUST_RETRAIN_MIN_ROWS", 1000))
+        self.min_interval = min_interval if min_interval is not None else float(
+            os.getenv("TRUST_RETRAIN_MIN_SECONDS", 300))
+        self.drift_threshold = drift_threshold or float(os.getenv("TRUST_DRIFT_THRESHOLD", 0.2))
+        self.max_score_shift = max_score_shift or float(os.getenv("TRUST_RELOAD_MAX_SCORE_SHIFT", 0.5))
+        self.random_state = random_state
+
+        self._reservoir_class = ReservoirSample
+        self.reservoir = None
+        self.monitor = DriftMonitor(
+            baseline_rows or int(os.getenv("TRUST_DRIFT_BASELINE_ROWS", 5000)),
+            drift_window or int(os.getenv("TRUST_DRIFT_WINDOW", 5000))
+        )
+        self.total_rows = 0
+        self.saved = 0
+        self.rejected = 0
+        self.failed = 0
+        # Models written to model_path by another process
+        self.replaced = 0
+        self.last_retrain: Optional[Dict] = None
+        self._last_attempt = float("-inf")
+        self._model_state = model_file_state(model_path)
+
+    def _reset(self, n_features: int):
+        """Start a new reservoir and drift baseline."""
+        self.reservoir = self._reservoir_class(self.reservoir_rows, n_features, self.random_state)
+        self.monitor.reset()
+
+    def add(self, features: np.ndarray, scores: np.ndarray):
+        """Take in the feature rows and trust scores of one scored batch."""
+        if self.reservoir is None or features.shape[1] != self.reservoir.rows.shape[1]:
+            # A model with a different feature set started serving
+            self._reset(features.shape[1])
+        self.reservoir.add(features)
+        self.monitor.add(features, scores)
+        self.total_rows += len(features)
+
+    def check_model(self) -> bool:
+        """
+        Start over when another process replaced the model file.
+
+        The rows taken in so far were scored by the previous model, so
+        neither they nor a drift baseline built from them describe the
+        model now serving.
+
+        Returns:
+            Whether the model file changed
+        """
+        state = model_file_state(self.model_path)
+        if state == self._model_state:
+            return False
+        self._model_state = state
+        self.replaced += 1
+        if self.reservoir is not None:
+            self._reset(self.reservoir.rows.shape[1])
+        return True
+
+    def due(self) -> Optional[str]:
+        """Why the model should be refitted now (drift or rows), or None."""
+        if self.reservoir is None or self.reservoir.seen < self.min_rows:
+            return None
+        if time.monotonic() - self._last_attempt < self.min_interval:
+            return None
+        psi = self.monitor.psi()
+        if psi is not None and psi.max() >= self.drift_threshold:
+            return "drift"
+        if self.reservoir.seen >= self.retrain_rows:
+            return "rows"
+        return None
+
+    def retrain(self, reason: str) -> Dict:
+        """
+        Fit a model on the reservoir, validate it against the current model
+        and save it to model_path.
+
+        Returns:
+            What happened: the outcome (saved, rejected or failed), the rows
+            behind it and how long it took
+        """
+        start = time.perf_counter()
+        self._last_attempt = time.monotonic()
+        sample = self.reservoir.sample()
+        psi = self.monitor.psi()
+        record = {
+            "reason": reason,
+            "rows": int(self.reservoir.seen),
+            "sampled": len(sample),
+            "drift": float(psi.max()) if psi is not None else None
+        }
+        # Canary rows need the history columns the model was trained with
+        history = ReturnHistoryStore(path="", max_entities=1) if sample.shape[1] > BASE_FEATURES else None
+        try:
+            candidate = TrustScorer(history=history)
+            candidate.fit(sample)
+            record["fitSeconds"] = time.perf_counter() - start
+            current = TrustScorer(model_path=self.model_path, history=history) \
+                if os.path.exists(self.model_path) else None
+            record.update(validate_scorer(candidate, current, self.max_score_shift))
+            directory = os.path.dirname(self.model_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            candidate.save_model(self.model_path)
+            self._model_state = model_file_state(self.model_path)
+        except ModelValidationError as e:
+            self.rejected += 1
+            record.update(outcome="rejected", error=str(e))
+        except Exception as e:
+            self.failed += 1
+            record.update(outcome="failed", error=str(e))
+        else:
+            self.saved += 1
+            record["outcome"] = "saved"
+            self._reset(sample.shape[1])
+
+        record["seconds"] = time.perf_counter() - start
+        record["completedAt"] = datetime.now().isoformat()
+        self.last_retrain = record
+        return record
+
+    def stats(self) -> Dict:
+        psi = self.monitor.psi()
+        drift = None
+        if psi is not None:
+            names = FEATURE_NAMES[:len(psi) - 1] + ("trust_score",)
+            drift = {name: float(value) for name, value in zip(names, psi)}
+        return {
+            "modelPath": self.model_path,
+            "rows": int(self.reservoir.seen) if self.reservoir is not None else 0,
+            "totalRows": self.total_rows,
+            "reservoirRows": self.reservoir_rows,
+            "retrainRows": self.retrain_rows,
+            "driftThreshold": self.drift_threshold,
+            "drift": drift,
+            "saved": self.saved,
+            "rejected": self.rejected,
+            "failed": self.failed,
+            "replaced": self.replaced,
+            "lastRetrain": self.last_retrain
+        }
+
+
+def run_trainer(rows: multiprocessing.Queue, status: multiprocessing.Queue, model_path: str, options: Dict):
+    """
+    Training process: consume scored rows until a None arrives, refitting when due.
+
+    Every server worker starts one, but only the process holding the trainer
+    lock trains. The others stand by, discard their rows and retry the lock
+    at each status report, so one takes over when the trainer's worker exits.
+    """
+    # Interrupts go to the server, which stops this process on shutdown
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    trainer = IncrementalTrainer(model_path, **options)
+    lock = acquire_trainer_lock(model_path)
+    last_report = 0.0
+    while True:
+        try:
+            batch = rows.get(timeout=STATUS_INTERVAL)
+        except queue.Empty:
+            batch = ()
+        if batch is None:
+            break
+        reason = None
+        if lock is not None:
+            trainer.check_model()
+            if batch:
+                trainer.add(*batch)
+            reason = trainer.due()
+            if reason is not None:
+                trainer.retrain(reason)
+        if reason is not None or time.monotonic() - last_report >= STATUS_INTERVAL:
+            if lock is None:
+                lock = acquire_trainer_lock(model_path)
+            status.put({**trainer.stats(), "elected": lock is not None})
+            last_report = time.monotonic()
+    if lock is not None:
+        lock.close()
+
+
+class BackgroundTrainer:
+    """
+    Runs an IncrementalTrainer in its own process, fed with the rows the
+    service scores, so refits never compete with requests for the GIL.
+
+    submit() never blocks: rows go through a bounded queue and are dropped,
+    and counted, while the trainer is behind. With several server workers,
+    only the one whose process was elected trainer (see run_trainer) sends
+    its rows.
+    """
+
+    def __init__(self, model_path: str, queue_size: Optional[int] = None, **options):
+        """
+        Args:
+            model_path: Model file the trainer replaces
+            queue_size: Scored batches queued for the trainer before new ones
+                are dropped (default: TRUST_RETRAIN_QUEUE_SIZE or 1000)
+            options: IncrementalTrainer settings
+        """
+        self.model_path = model_path
+        self.queue_size = queue_size or int(os.getenv("TRUST_RETRAIN_QUEUE_SIZE", 1000))
+        self.options = options
+        self.submitted = 0
+        self.dropped = 0
+        self.train_times = Histogram(TRAIN_SECONDS_BUCKETS)
+        # Latest IncrementalTrainer.stats() reported by the process
+        self.status: Dict = {}
+        self._rows: Optional[multiprocessing.Queue] = None
+        self._status: Optional[multiprocessing.Queue] = None
+        self._process: Optional[multiprocessing.Process] = None
+
+    @property
+    def running(self) -> bool:
+        return self._process is not None and self._process.is_alive()
+
+    def start(self):
+        if self._process is not None:
+            return
+        self._rows = multiprocessing.Queue(self.queue_size)
+        self._status = multiprocessing.Queue()
+        self._process = multiprocessing.Process(
+            target=run_trainer,
+            args=(self._rows, self._status, self.model_path, self.options),
+            name="trust-retrainer",
+            daemon=True
+        )
+        self._process.start()
+
+    def submit(self, features: np.ndarray, scores: np.ndarray):
+        """Queue the rows of a scored batch; called from the scoring threads."""
+        if self._process is None:
+            return
+        if self.status.get("elected") is False:
+            # Another worker's process trains; rows of a standby are discarded anyway
+            return
+        try:
+            self._rows.put_nowait((features, scores))
+            self.submitted += len(features)
+        except queue.Full:
+            self.dropped += len(features)
+
+    def poll(self):
+        """Take in the status reports of the process. Call from the event loop."""
+        if self._status is None:
+            return
+        while True:
+            try:
+                status = self._status.get_nowait()
+            except queue.Empty:
+                break
+            attempts = status["saved"] + status["rejected"] + status["failed"]
+            previous = self.status.get("saved", 0) + self.status.get("rejected", 0) + self.status.get("failed", 0)
+            if attempts > previous:
+                self.train_times.observe(status["lastRetrain"]["seconds"])
+            self.status = status
+
+    def stop(self, timeout: float = 5.0):
+        if self._process is None:
+            return
+        try:
+            self._rows.put(None, timeout=timeout)
+        except queue.Full:
+            pass
+        self._process.join(timeout)
+        if self._process.is_alive():
+            self._process.terminate()
+            self._process.join()
+        # Rows still buffered for the dead process would block interpreter exit
+        self._rows.cancel_join_thread()
+        self._process = None
+
+    def stats(self) -> Dict:
+        self.poll()
+        return {
+            "running": self.running,
+            "submittedRows": self.submitted,
+            "droppedRows": self.dropped,
+            "queueSize": self.queue_size,
+            "trainSeconds": self.train_times.snapshot(),
+            **self.status
+        }
@@ -1,39 +1,159 @@
 import numpy as np
-from sklearn.ensemble import IsolationForest
-from typing import Dict, List, Optional
+from typing import Callable, Dict, List, Optional, Sequence
+import hashlib
 import joblib
 import os
 from datetime import datetime
 
+from compiled_forest import CompiledIsolationForest
+from feature_store import HISTORY_FEATURES, NO_HISTORY, ReturnHistoryStore, hours_between
+from metrics import NULL_TIMER, StageTimer
+
+# Features computed from the request itself
+BASE_FEATURES = 3
+
+def compiled_model_path(model_path: str) -> str:
+    """File holding the compiled forest saved alongside model_path."""
+    return model_path + ".compiled"
+
+def error_result(error: Exception) -> Dict:
+    """Result of a return request that could not be scored."""
+    return {
+        "trustScore": 0.0,
+        "riskLevel": "high",
+        "riskFactors": ["Error in trust calculation"],
+        "confidence": 0.0,
+        "error": str(error)
+    }
+
+def file_digest(path: str) -> str:
+    """Content hash of a model file."""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
 class TrustScorer:
-    def __init__(self, model_path: Optional[str] = None):
+    def __init__(self,
+                 model_path: Optional[str] = None,
+                 compiled: Optional[bool] = None,
+                 history: Optional[ReturnHistoryStore] = None):
         """
         Initialize TrustScorer with optional pre-trained model.
+        
+        Args:
+            model_path: Path of a joblib-saved IsolationForest
+            compiled: Score with a CompiledIsolationForest built from the fitted
+                model (default: TRUST_COMPILED_MODEL or true)
+            history: Per-user and per-product return aggregates appended to the
+                model input; models trained without them keep working
         """
+        if compiled is None:
+            compiled = os.getenv("TRUST_COMPILED_MODEL", "true").lower() == "true"
+        self.compiled = compiled
+        self.history = history
+
+        # The model and predictor are built on first use, so constructing a
+        # scorer is cheap; scoring with a saved compiled forest never loads
+        # the sklearn model, or sklearn itself
+        self._model = None
+        self._model_path = None
+        self._predictor = None
         if model_path and os.path.exists(model_path):
-            self.model = joblib.load(model_path)
-        else:
-            self.model = IsolationForest(
-                contamination=0.1,
-                random_state=42
-            )
+            self._model_path = model_path
+            if compiled:
+                self._predictor = self._load_compiled(model_path)
+
+    @property
+    def model(self):
+        """The sklearn model, loaded from model_path or created unfitted."""
+        if self._model is None:
+            if self._model_path:
+                self._model = joblib.load(self._model_path)
+            else:
+                from sklearn.ensemble import IsolationForest
+                self._model = IsolationForest(
+                    contamination=0.1,
+                    random_state=42
+                )
+        return self._model
+
+    @property
+    def predictor(self):
+        """Model used for scoring: the compiled forest once the model is fitted."""
+        if self._predictor is None:
+            self._predictor = self._build_predictor()
+        return self._predictor
+
+    @property
+    def fitted(self) -> bool:
+        """Whether a model has been trained or loaded."""
+        return isinstance(self.predictor, CompiledIsolationForest) or hasattr(self.model, "estimators_")
+
+    @staticmethod
+    def _load_compiled(model_path: str) -> Optional[CompiledIsolationForest]:
+        """
+        Compiled forest saved with the model, memory-mapped so all workers
+        share its arrays; None if there is none or it is stale.
+        """
+        path = compiled_model_path(model_path)
+        if not os.path.exists(path):
+            return None
+        try:
+            forest = CompiledIsolationForest.load(path)
+        except Exception:
+            return None
+        # Stale if the model file was replaced without it
+        if getattr(forest, "source_digest", None) != file_digest(model_path):
+            return None
+        return forest
+
+    def _build_predictor(self):
+        from sklearn.ensemble import IsolationForest
+
+        if self.compiled and isinstance(self.model, IsolationForest) and hasattr(self.model, "estimators_"):
+            return CompiledIsolationForest(self.model)
+        return self.model
+
+    @property
+    def uses_history(self) -> bool:
+        """Whether the model input includes HISTORY_FEATURES."""
+        if self.history is None:
+            return False
+        n_features = getattr(self.predictor, "n_features", None) or getattr(self.model, "n_features_in_", None)
+        return n_features is None or n_features == BASE_FEATURES + len(HISTORY_FEATURES)
+
+    def _history_features(self,
+                          user_ids: Optional[Sequence[Optional[str]]],
+                          product_ids: Optional[Sequence[Optional[str]]],
+                          return_timestamps: Sequence[datetime]) -> np.ndarray:
+        """History features for each return, from the store."""
+        count = len(return_timestamps)
+        return self.history.features(
+            user_ids if user_ids is not None else [None] * count,
+            product_ids if product_ids is not None else [None] * count,
+            return_timestamps
+        )
     
     def _extract_features(self, 
                          activation_time: datetime,
                          return_timestamp: datetime,
                          return_attempts: int,
-                         label_match_score: float) -> np.ndarray:
+                         label_match_score: float,
+                         history: Optional[np.ndarray] = None) -> np.ndarray:
         """
         Extract features for trust scoring.
         """
         # Calculate time difference in hours
-        time_diff = (return_timestamp - activation_time).total_seconds() / 3600
+        time_diff = hours_between(activation_time, return_timestamp)
         
         # Create feature vector
         features = np.array([
             time_diff,  # Time since activation
             return_attempts,  # Number of previous return attempts
             label_match_score,  # Label verification score
+            *(history if history is not None else ())  # Return history aggregates
         ]).reshape(1, -1)
         
         return features
@@ -43,7 +163,11 @@ class TrustScorer:
                             return_timestamp: datetime,
                             return_attempts: int,
                             label_match_score: float,
-                            previous_returns: List[Dict] = None) -> Dict[str, float]:
+                            previous_returns: List[Dict] = None,
+                            user_id: Optional[str] = None,
+                            product_id: Optional[str] = None,
+                            photo_matches: int = 0,
+                            timer: StageTimer = NULL_TIMER) -> Dict[str, float]:
         """
         Calculate trust score for a return request.
         
@@ -53,21 +177,33 @@ class TrustScorer:
             return_attempts: Number of previous return attempts
             label_match_score: Score from label verification (0-1)
             previous_returns: List of previous return attempts (optional)
+            user_id: User requesting the return, for history features
+            product_id: Product being returned, for history features
+            photo_matches: Earlier returns that submitted a near-identical photo
+            timer: Records the time of each stage
             
         Returns:
             Dict containing trust score and risk factors
         """
+        timer.skip()
         try:
             # Extract features
+            history = None
+            if self.uses_history:
+                history = self._history_features([user_id], [product_id], [return_timestamp])[0]
+                timer.lap("history")
             features = self._extract_features(
                 activation_time,
                 return_timestamp,
                 return_attempts,
-                label_match_score
+                label_match_score,
+                history
             )
+            timer.lap("features")
             
             # Calculate anomaly score (-1 for anomalies, 1 for normal samples)
-            anomaly_score = self.model.predict(features)[0]
+            anomaly_score = self.predictor.predict(features)[0]
+            timer.lap("predict")
             
             # Convert to trust score (0-1 range)
             trust_score = (anomaly_score + 1) / 2
@@ -94,8 +230,14 @@ class TrustScorer:
                 trust_score *= 0.6
                 risk_factors.append("Label verification failed")
                 
+            # Check for a photo reused from other returns
+            if photo_matches > 0:
+                trust_score *= 0.5
+                risk_factors.append("Photo reused from another return")
+                
             # Ensure score is in [0,1] range
             trust_score = max(0.0, min(1.0, trust_score))
+            timer.lap("rules")
             
             return {
                 "trustScore": float(trust_score),
@@ -105,13 +247,128 @@ class TrustScorer:
             }
             
         except Exception as e:
-            return {
-                "trustScore": 0.0,
-                "riskLevel": "high",
-                "riskFactors": ["Error in trust calculation"],
-                "confidence": 0.0,
-                "error": str(e)
+            timer.fail(type(e).__name__)
+            return error_result(e)
+    
+    def calculate_trust_scores(self,
+                               activation_times: Sequence[datetime],
+                               return_timestamps: Sequence[datetime],
+                               return_attempts: Sequence[int],
+                               label_match_scores: Sequence[float],
+                               user_ids: Optional[Sequence[Optional[str]]] = None,
+                               product_ids: Optional[Sequence[Optional[str]]] = None,
+                               photo_matches: Optional[Sequence[int]] = None,
+                               timer: StageTimer = NULL_TIMER,
+                               observer: Optional[Callable[[np.ndarray, np.ndarray], None]] = None) -> List[Dict]:
+        """
+        Calculate trust scores for many return requests at once.
+        
+        Takes one sequence per input of calculate_trust_score. Builds the
+        feature matrix in one pass, calls the model once and applies the
+        business rules as array operations. Each result equals what
+        calculate_trust_score returns for that row: a row whose inputs
+        cannot be turned into features gets an error result of its own, and
+        the other rows are scored without it.
+        
+        Args:
+            activation_times: When each product was activated
+            return_timestamps: When each return was requested
+            return_attempts: Number of previous return attempts per request
+            label_match_scores: Score from label verification (0-1) per request
+            user_ids: User of each request, for history features
+            product_ids: Product of each request, for history features
+            photo_matches: Earlier returns that submitted a near-identical photo, per request (default 0)
+            timer: Records the time of each stage of the whole batch
+            observer: Called with the feature matrix and the trust scores of
+                the scored rows once they are scored, e.g. to feed background retraining
+            
+        Returns:
+            List of dicts containing trust score and risk factors, in input order
+        """
+        count = len(activation_times)
+        if not (len(return_timestamps) == len(return_attempts) == len(label_match_scores) == count) or (
+                photo_matches is not None and len(photo_matches) != count):
+            raise ValueError("All input columns must have the same length")
+        if not count:
+            return []
+        
+        timer.skip()
+        # Base features row by row, so a bad row fails alone; time since
+        # activation in hours, computed as in _extract_features
+        rows = []
+        errors: Dict[int, Exception] = {}
+        for i in range(count):
+            try:
+                rows.append((
+                    hours_between(activation_times[i], return_timestamps[i]),
+                    float(return_attempts[i]),
+                    float(label_match_scores[i])
+                ))
+            except Exception as e:
+                errors[i] = e
+        valid = [i for i in range(count) if i not in errors]
+        if not valid:
+            return [error_result(errors[i]) for i in range(count)]
+        
+        try:
+            base = np.array(rows, dtype=np.float64).reshape(len(valid), 3)
+            hours_since_activation, attempts, label_scores = base.T
+            columns = [base]
+            timer.lap("features")
+            if self.uses_history:
+                columns.append(self._history_features(
+                    [user_ids[i] for i in valid] if user_ids is not None else None,
+                    [product_ids[i] for i in valid] if product_ids is not None else None,
+                    [return_timestamps[i] for i in valid]
+                ))
+                timer.lap("history")
+            features = np.column_stack(columns)
+            
+            # Calculate anomaly scores (-1 for anomalies, 1 for normal samples)
+            trust_scores = (self.predictor.predict(features) + 1) / 2
+            timer.lap("predict")
+        except Exception as e:
+            timer.fail(type(e).__name__)
+            return [error_result(errors.get(i, e)) for i in range(count)]
+        
+        # Apply business rules, in the same order as calculate_trust_score
+        quick = hours_since_activation < 24
+        late = ~quick & (hours_since_activation > 720)
+        repeated = attempts > 0
+        label_failed = label_scores < 0.7
+        reused = np.asarray(photo_matches if photo_matches is not None else np.zeros(count))[valid] > 0
+        trust_scores = trust_scores * np.where(quick, 0.7, np.where(late, 0.9, 1.0))
+        trust_scores = trust_scores * np.where(repeated, 0.8, 1.0)
+        trust_scores = trust_scores * np.where(label_failed, 0.6, 1.0)
+        trust_scores = trust_scores * np.where(reused, 0.5, 1.0)
+        trust_scores = np.clip(trust_scores, 0.0, 1.0)
+        
+        risk_levels = np.where(trust_scores < 0.5, "high", np.where(trust_scores < 0.8, "medium", "low"))
+        confidences = np.where(label_scores > 0.8, 0.8, 0.6)
+        
+        results = [error_result(errors[i]) if i in errors else None for i in range(count)]
+        for row, i in enumerate(valid):
+            risk_factors = []
+            if quick[row]:
+                risk_factors.append("Very quick return")
+            elif late[row]:
+                risk_factors.append("Late return")
+            if repeated[row]:
+                risk_factors.append("Multiple return attempts")
+            if label_failed[row]:
+                risk_factors.append("Label verification failed")
+            if reused[row]:
+                risk_factors.append("Photo reused from another return")
+            results[i] = {
+                "trustScore": float(trust_scores[row]),
+                "riskLevel": str(risk_levels[row]),
+                "riskFactors": risk_factors,
+                "confidence": float(confidences[row])
             }
+        timer.lap("rules")
+        if observer is not None:
+            observer(features, trust_scores)
+        return results
     
     def train(self, training_data: List[Dict]):
         """
@@ -122,19 +379,39 @@ class TrustScorer:
             
         features_list = []
         for data in training_data:
+            # History features come precomputed with each row, if at all
+            history = None
+            if self.history is not None:
+                history = [data.get(name, default) for name, default in zip(HISTORY_FEATURES, NO_HISTORY)]
             features = self._extract_features(
                 data["activation_time"],
                 data["return_timestamp"],
                 data["return_attempts"],
-                data.get("label_match_score", 1.0)
+                data.get("label_match_score", 1.0),
+                history
             )
             features_list.append(features[0])
             
-        X = np.array(features_list)
+        self.fit(np.array(features_list))
+
+    def fit(self, X: np.ndarray):
+        """
+        Fit the model on a feature matrix in _extract_features column order.
+        """
         self.model.fit(X)
+        self._predictor = self._build_predictor()
     
     def save_model(self, model_path: str):
         """
         Save the trained model to disk.
+
+        The compiled forest is written next to the model, tagged with the
+        model file's hash, before the model file is atomically replaced, so a
+        process watching model_path never reads a partial model.
         """
-        joblib.dump(self.model, model_path)
\ No newline at end of file
+        tmp_path = model_path + ".tmp"
+        joblib.dump(self.model, tmp_path)
+        if isinstance(self.predictor, CompiledIsolationForest):
+            self.predictor.source_digest = file_digest(tmp_path)
+            self.predictor.save(compiled_model_path(model_path))
+        os.replace(tmp_path, model_path)
\ No newline at end of file
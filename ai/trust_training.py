@@ -0,0 +1,194 @@
+"""
+Train the trust model by streaming a large return history file.
+
+Run from the ai/ directory:
+
+    python trust_training.py returns.jsonl --model models/trust_scorer.pkl
+
+Rows need activation_time, return_timestamp and return_attempts, and may
+carry label_match_score (default 1.0) and the history features of
+feature_store.HISTORY_FEATURES. JSONL, CSV and Parquet are read in chunks;
+Parquet needs pyarrow.
+"""
+import argparse
+import os
+import resource
+import time
+from typing import Dict, Iterable, Iterator, Optional
+
+import numpy as np
+import pandas as pd
+from sklearn.ensemble import IsolationForest
+
+from feature_store import HISTORY_FEATURES, NO_HISTORY
+from trust_scorer import TrustScorer
+
+DEFAULT_CHUNK_SIZE = 100_000
+
+
+def read_chunks(path: str, chunk_size: int = DEFAULT_CHUNK_SIZE, format: Optional[str] = None) -> Iterator[pd.DataFrame]:
+    """
+    Read a JSONL, CSV or Parquet file as DataFrames of at most chunk_size rows.
+
+    Args:
+        path: Input file
+        chunk_size: Rows per chunk
+        format: jsonl, csv or parquet (default: from the file extension)
+    """
+    format = format or os.path.splitext(path)[1].lstrip(".").lower()
+    if format in ("jsonl", "ndjson", "json"):
+        with pd.read_json(path, lines=True, chunksize=chunk_size, dtype=False) as reader:
+            yield from reader
+    elif format == "csv":
+        with pd.read_csv(path, chunksize=chunk_size) as reader:
+            yield from reader
+    elif format == "parquet":
+        try:
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError("Reading Parquet needs pyarrow (pip install pyarrow)")
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_size):
+            yield batch.to_pandas()
+    else:
+        raise ValueError(f"Unsupported training data format '{format}' (use jsonl, csv or parquet)")
+
+
+def frame_features(frame: pd.DataFrame, with_history: bool = False) -> np.ndarray:
+    """
+    Trust model features of a chunk, in the column order of TrustScorer._extract_features.
+
+    Args:
+        frame: Chunk of return records
+        with_history: Append HISTORY_FEATURES columns (missing ones take their no-history value)
+    """
+    activation = pd.to_datetime(frame["activation_time"], format="ISO8601", utc=True)
+    returned = pd.to_datetime(frame["return_timestamp"], format="ISO8601", utc=True)
+    columns = [
+        (returned - activation).dt.total_seconds().to_numpy(np.float64) / 3600,
+        frame["return_attempts"].to_numpy(np.float64),
+        (frame["label_match_score"].to_numpy(np.float64) if "label_match_score" in frame
+         else np.ones(len(frame))),
+    ]
+    if with_history:
+        for name, default in zip(HISTORY_FEATURES, NO_HISTORY):
+            columns.append(frame[name].to_numpy(np.float64) if name in frame else np.full(len(frame), default))
+    return np.column_stack(columns)
+
+
+def reservoir_size(model: IsolationForest) -> int:
+    """
+    Rows to keep so every tree can draw its max_samples rows.
+
+    IsolationForest fits each tree on max_samples rows drawn without
+    replacement, so a uniform sample of n_estimators * max_samples rows
+    gives the trees the same distribution as the full data.
+    """
+    max_samples = model.max_samples
+    if max_samples == "auto":
+        max_samples = 256
+    elif not isinstance(max_samples, (int, np.integer)):
+        raise ValueError("Streaming training needs max_samples='auto' or an int, not a fraction")
+    return model.n_estimators * int(max_samples)
+
+
+class ReservoirSample:
+    """Uniform fixed-size sample of a stream of feature rows (Algorithm R, vectorized per chunk)."""
+
+    def __init__(self, size: int, n_features: int, random_state: int = 42):
+        self.size = size
+        self.rows = np.empty((size, n_features), dtype=np.float64)
+        self.seen = 0
+        self._rng = np.random.default_rng(random_state)
+
+    def add(self, chunk: np.ndarray):
+        # Fill the reservoir first
+        fill = min(len(chunk), max(0, self.size - self.seen))
+        self.rows[self.seen:self.seen + fill] = chunk[:fill]
+        rest = chunk[fill:]
+        start = self.seen + fill
+        self.seen += len(chunk)
+        if not len(rest):
+            return
+
+        # Row i of the stream replaces a random slot with probability size / (i + 1)
+        slots = self._rng.integers(0, np.arange(start, start + len(rest)) + 1)
+        keep = slots < self.size
+        slots, rest = slots[keep], rest[keep]
+        # A later row overwrites an earlier one that drew the same slot
+        last = len(slots) - 1 - np.unique(slots[::-1], return_index=True)[1]
+        self.rows[slots[last]] = rest[last]
+
+    def sample(self) -> np.ndarray:
+        return self.rows[:min(self.seen, self.size)]
+
+
+def train_streaming(scorer: TrustScorer,
+                    chunks: Iterable[pd.DataFrame],
+                    random_state: int = 42) -> Dict:
+    """
+    Train a TrustScorer on a stream of chunks without materializing them.
+
+    Returns:
+        Rows read, rows sampled, seconds taken and throughput
+    """
+    with_history = scorer.history is not None
+    n_features = 3 + (len(HISTORY_FEATURES) if with_history else 0)
+    reservoir = ReservoirSample(reservoir_size(scorer.model), n_features, random_state)
+
+    start = time.perf_counter()
+    for chunk in chunks:
+        reservoir.add(frame_features(chunk, with_history))
+    read_seconds = time.perf_counter() - start
+
+    sample = reservoir.sample()
+    if not len(sample):
+        raise ValueError("No training rows")
+    scorer.fit(sample)
+    seconds = time.perf_counter() - start
+
+    return {
+        "rows": reservoir.seen,
+        "sampled": len(sample),
+        "readSeconds": read_seconds,
+        "seconds": seconds,
+        "rowsPerSecond": reservoir.seen / read_seconds if read_seconds else float("inf")
+    }
+
+
+def peak_memory_mb() -> float:
+    """Peak resident memory of this process (Linux reports KiB)."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("input", help="JSONL, CSV or Parquet file of return records")
+    parser.add_argument("--model", default=os.getenv("TRUST_MODEL_PATH", "models/trust_scorer.pkl"),
+                        help="Where to save the trained model")
+    parser.add_argument("--format", choices=["jsonl", "csv", "parquet"], help="Input format (default: from extension)")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE)
+    parser.add_argument("--history", action="store_true",
+                        help="Train with the return history features as well")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    # The store is only a marker here; history features come from the input rows
+    history = None
+    if args.history:
+        from feature_store import ReturnHistoryStore
+        history = ReturnHistoryStore(path="", max_entities=1)
+    scorer = TrustScorer(history=history)
+
+    stats = train_streaming(scorer, read_chunks(args.input, args.chunk_size, args.format), args.seed)
+    directory = os.path.dirname(args.model)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    scorer.save_model(args.model)
+
+    print(f"Trained on {stats['sampled']:,} of {stats['rows']:,} rows in {stats['seconds']:.1f}s "
+          f"({stats['rowsPerSecond']:,.0f} rows/s), peak memory {peak_memory_mb():.0f} MB")
+    print(f"Saved model to {args.model}")
+
+
+if __name__ == "__main__":
+    main()
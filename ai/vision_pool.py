@@ -0,0 +1,247 @@
+import asyncio
+import multiprocessing
+import os
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, Dict, Optional, Union
+
+from metrics import NULL_TIMER, StageTimer
+
+# Analyzer owned by the current worker process, built by the pool initializer
+_worker_analyzer = None
+# Barrier shared by all workers of a pool, used by warm-up jobs
+_worker_barrier = None
+
+
+def _init_worker(barrier=None):
+    """Build and warm up the per-process LabelAnalyzer."""
+    global _worker_analyzer, _worker_barrier
+    _worker_barrier = barrier
+    from label_analyzer import LabelAnalyzer
+    from reference_store import ReferenceStore
+
+    # Every worker maps the same store files, so their pages are shared
+    store_path = os.getenv("REFERENCE_STORE_PATH")
+    reference_store = ReferenceStore(store_path) if store_path else None
+
+    _worker_analyzer = LabelAnalyzer(reference_store=reference_store)
+    _worker_analyzer.warm_up()
+
+
+def _worker_ready(timeout: float) -> int:
+    """
+    Warm-up job. Waits until every worker runs one, so each job lands on a
+    different, fully initialized worker.
+    """
+    try:
+        _worker_barrier.wait(timeout)
+    except threading.BrokenBarrierError:
+        pass
+    return os.getpid()
+
+
+def analyze_label_task(image: Union[str, bytes],
+                       expected_coordinates: Dict[str, float],
+                       product_id: Optional[str] = None,
+                       backend: Optional[str] = None,
+                       timed: bool = False) -> Dict:
+    """
+    Run label analysis inside a pool worker.
+
+    Args:
+        image: Base64 encoded image, or raw encoded image bytes from an upload
+        expected_coordinates: Expected label coordinates (x, y, width, height)
+        product_id: Product whose enrolled reference label is matched, if any
+        backend: Feature backend name (default: the worker's default backend)
+        timed: Add the stage timings and sizes (StageTimer.state) under "timing"
+    """
+    timer = StageTimer() if timed else NULL_TIMER
+    if isinstance(image, (bytes, bytearray)):
+        result = _worker_analyzer.analyze_label_bytes(image, expected_coordinates, product_id, backend, timer)
+    else:
+        result = _worker_analyzer.analyze_label(image, expected_coordinates, product_id, backend, timer)
+    if timed:
+        result["timing"] = timer.state()
+    return result
+
+
+def scan_frame_task(image: bytes,
+                    expected_coordinates: Dict[str, float],
+                    product_id: Optional[str] = None,
+                    backend: Optional[str] = None,
+                    previous: Any = None,
+                    timed: bool = False) -> Dict:
+    """
+    Check and analyze one burst scan frame inside a pool worker.
+
+    Args:
+        image: Raw encoded frame
+        expected_coordinates: Expected label coordinates (x, y, width, height)
+        product_id: Product whose enrolled reference label is matched, if any
+        backend: Feature backend name (default: the worker's default backend)
+        previous: Label thumbnail of the scan's last analyzed frame
+        timed: Add the stage timings and sizes (StageTimer.state) under "timing"
+    """
+    timer = StageTimer() if timed else NULL_TIMER
+    result = _worker_analyzer.analyze_frame_bytes(image, expected_coordinates, product_id, backend, previous, timer)
+    if timed:
+        result["timing"] = timer.state()
+    return result
+
+
+def enroll_reference_task(product_id: str,
+                          image: Union[str, bytes],
+                          label_coordinates: Dict[str, float],
+                          backend: Optional[str] = None) -> Dict:
+    """Extract and store a product's reference label features inside a pool worker."""
+    return _worker_analyzer.enroll_reference(product_id, image, label_coordinates, backend)
+
+
+class PoolSaturatedError(Exception):
+    """Raised when the pool already holds its maximum number of queued jobs."""
+
+
+class PoolTimeoutError(Exception):
+    """Raised when a job does not finish within the configured timeout."""
+
+
+class PoolBrokenError(Exception):
+    """Raised when a worker process died; the next job starts fresh workers."""
+
+
+class VisionPool:
+    """
+    Process pool for CPU-bound vision work.
+
+    Keeps OpenCV work off the event loop. Every worker process holds its own
+    warmed LabelAnalyzer. The number of jobs in flight (running plus queued)
+    is bounded so callers can shed load instead of queueing without limit.
+    """
+
+    def __init__(self,
+                 max_workers: Optional[int] = None,
+                 queue_depth: Optional[int] = None,
+                 timeout: Optional[float] = None):
+        """
+        Args:
+            max_workers: Worker processes (default: VISION_WORKERS or CPU count)
+            queue_depth: Jobs allowed to wait for a free worker (default: VISION_QUEUE_DEPTH or 4 per worker)
+            timeout: Seconds a caller waits for a job (default: VISION_TIMEOUT_SECONDS or 30)
+        """
+        if max_workers is None:
+            max_workers = int(os.getenv("VISION_WORKERS", os.cpu_count() or 1))
+        if queue_depth is None:
+            queue_depth = int(os.getenv("VISION_QUEUE_DEPTH", max_workers * 4))
+        if timeout is None:
+            timeout = float(os.getenv("VISION_TIMEOUT_SECONDS", 30))
+
+        self.max_workers = max(1, max_workers)
+        self.queue_depth = max(0, queue_depth)
+        self.timeout = timeout
+
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
+        self._in_flight = 0
+
+    @property
+    def capacity(self) -> int:
+        """Maximum number of jobs running or queued at once."""
+        return self.max_workers + self.queue_depth
+
+    @property
+    def in_flight(self) -> int:
+        """Jobs currently running or queued in the pool."""
+        return self._in_flight
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        # Workers are started lazily so importing the app stays cheap
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.max_workers,
+                initializer=_init_worker,
+                initargs=(multiprocessing.Barrier(self.max_workers),)
+            )
+        return self._executor
+
+    async def warm_up(self) -> int:
+        """
+        Start every worker process and wait until each has built and warmed
+        its analyzer, so the first requests do not pay for it.
+
+        Returns:
+            Number of distinct worker processes that answered
+        """
+        # Not bounded by the capacity: every worker has to take one
+        futures = [self._submit(_worker_ready, self.timeout, bounded=False) for _ in range(self.max_workers)]
+        pids = await asyncio.gather(*(asyncio.wrap_future(future) for future in futures))
+        return len(set(pids))
+
+    def _reset_executor(self, executor: ProcessPoolExecutor):
+        """Drop a broken executor so the next job starts a fresh one."""
+        # Jobs of the broken executor fail one by one; only the first drops it
+        if self._executor is executor:
+            self._executor = None
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def _release(self, _future):
+        with self._lock:
+            self._in_flight -= 1
+
+    def _submit(self, fn: Callable, *args: Any, bounded: bool = True) -> Future:
+        """
+        Submit fn(*args), counting it in flight until it finishes.
+
+        Raises:
+            PoolSaturatedError: The pool is full and the job is bounded
+        """
+        with self._lock:
+            if bounded and self._in_flight >= self.capacity:
+                raise PoolSaturatedError(
+                    f"Vision pool saturated ({self._in_flight} jobs in flight)"
+                )
+            self._in_flight += 1
+
+        executor = self._get_executor()
+        try:
+            future = executor.submit(fn, *args)
+        except BrokenProcessPool:
+            # A worker died; start a fresh pool for the next request
+            self._reset_executor(executor)
+            self._release(None)
+            raise
+        except BaseException:
+            self._release(None)
+            raise
+        future.add_done_callback(self._release)
+        return future
+
+    async def run(self, fn: Callable, *args: Any) -> Any:
+        """
+        Run fn(*args) in a worker process.
+
+        A slot is held until the job really finishes, even if the caller
+        timed out, so abandoned jobs still count against the pool capacity.
+
+        Raises:
+            PoolSaturatedError: The pool is full
+            PoolTimeoutError: The job did not finish within the timeout
+            PoolBrokenError: A worker process died; the pool restarts on the next job
+        """
+        executor = self._get_executor()
+        try:
+            future = self._submit(fn, *args)
+            return await asyncio.wait_for(asyncio.wrap_future(future), self.timeout)
+        except asyncio.TimeoutError:
+            # Drop the job if it has not started yet
+            future.cancel()
+            raise PoolTimeoutError(f"Vision job exceeded {self.timeout:.1f}s")
+        except BrokenProcessPool as e:
+            self._reset_executor(executor)
+            raise PoolBrokenError(f"Vision worker died ({e})") from e
+
+    def shutdown(self):
+        """Stop all worker processes."""
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None